@@ -161,6 +161,16 @@ SWAGGER_SETTINGS = {
 }
 
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
+# Cache shared by the web server and the workers, e.g. for locks. Falls back to a per-process cache without redis
+CACHE_URL = os.getenv('CACHE_URL', CELERY_BROKER_URL)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    } if CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
@@ -229,4 +239,46 @@ LOGGING = {
 
 DAYS_RETRIEVABLE = int(os.getenv('DAYS_RETRIEVABLE', 7))
 MAXIMUM_RETRY = int(os.getenv('MAXIMUM_RETRY', 2))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', 2))  # Delay before the first retry of a failed update in seconds
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', 3600))  # Longest delay between retries in seconds
 UPDATE_INTERVAL = float(os.getenv('UPDATE_INTERVAL', 1200))  # Update feeds at background in seconds
+MIN_UPDATE_INTERVAL = float(os.getenv('MIN_UPDATE_INTERVAL', 300))  # Shortest interval of a fast feed in seconds
+MAX_UPDATE_INTERVAL = float(os.getenv('MAX_UPDATE_INTERVAL', 86400))  # Longest interval of an idle feed in seconds
+EMPTY_POLL_BACKOFF = float(os.getenv('EMPTY_POLL_BACKOFF', 1.5))  # Interval factor per update without new entries
+SCHEDULER_INTERVAL = float(os.getenv('SCHEDULER_INTERVAL', 60))  # Collect feeds due to update in seconds
+SCHEDULER_CHUNK_SIZE = int(os.getenv('SCHEDULER_CHUNK_SIZE', 1000))  # Number of due feeds dispatched at a time
+POLL_JITTER = float(os.getenv('POLL_JITTER', 0.05))  # Random shift of the next update, relative to the interval
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))  # Number of entries created per transaction
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', 50))  # Number of feeds downloaded together by one worker
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 10))  # Maximum concurrent downloads of a batch
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 30))  # Timeout of downloading a feed in seconds
+FETCH_POOL_HOSTS = int(os.getenv('FETCH_POOL_HOSTS', 100))  # Number of hosts a worker keeps connections open to
+FETCH_POOL_CONNECTIONS = int(os.getenv('FETCH_POOL_CONNECTIONS', FETCH_CONCURRENCY))  # Keep-alive connections per host
+HOST_CONCURRENCY = int(os.getenv('HOST_CONCURRENCY', 2))  # Maximum concurrent downloads from the same host
+HOST_DELAY = float(os.getenv('HOST_DELAY', 1))  # Minimum delay between two downloads from the same host in seconds
+HOST_RETRY_AFTER = float(os.getenv('HOST_RETRY_AFTER', 300))  # Wait after a 429 without 'Retry-After' in seconds
+FEED_UPDATE_LOCK_TIMEOUT = int(os.getenv('FEED_UPDATE_LOCK_TIMEOUT', 900))  # Longest lock of an update in seconds
+MAX_FEED_BYTES = int(os.getenv('MAX_FEED_BYTES', 20 * 1024 * 1024))  # Largest feed downloaded, in bytes
+STREAM_PARSE_MIN_BYTES = int(os.getenv('STREAM_PARSE_MIN_BYTES', 1024 * 1024))  # Parse larger feeds incrementally
+MAX_FEED_ENTRIES = int(os.getenv('MAX_FEED_ENTRIES', 1000))  # Most entries parsed incrementally from one feed
+FEED_PARSER = os.getenv('FEED_PARSER', 'fast')  # 'fast' falls back to 'feedparser' for malformed or other feeds
+PIPELINE = os.getenv('PIPELINE', 'False') == 'True'  # Parse feeds of a batch in a process pool while downloading
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', os.cpu_count() or 1))  # Size of the process pool of a worker
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 20))  # Most feeds waiting between two stages
+CELERY_WORKER_POOL = 'threads' if PIPELINE else 'prefork'  # Prefork children cannot start the parse processes
+SINGLE_WRITER_INGEST = os.getenv('SINGLE_WRITER_INGEST', 'False') == 'True'  # Store parsed feeds by one worker only
+FETCH_RESULT_CACHE_TIMEOUT = int(os.getenv('FETCH_RESULT_CACHE_TIMEOUT', 300))  # Keep a subscribed feed in seconds
+ASYNC_SUBSCRIBE = os.getenv('ASYNC_SUBSCRIBE', 'False') == 'True'  # Validate new feeds at background on subscribe
+IMPORT_MAX_FEEDS = int(os.getenv('IMPORT_MAX_FEEDS', 1000))  # Most feeds imported from one OPML file
+IMPORT_BATCH_INTERVAL = float(os.getenv('IMPORT_BATCH_INTERVAL', 10))  # Delay between batches of imported feeds
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))  # Rows read from the database at a time by exports
+WEBSUB_CALLBACK_BASE_URL = os.getenv('WEBSUB_CALLBACK_BASE_URL', '')  # Public url of the web server, enables WebSub
+WEBSUB_LEASE_SECONDS = int(os.getenv('WEBSUB_LEASE_SECONDS', 864000))  # Lease asked to hubs in seconds
+WEBSUB_POLL_INTERVAL = float(os.getenv('WEBSUB_POLL_INTERVAL', MAX_UPDATE_INTERVAL))  # Polls of pushed feeds
+CIRCUIT_BREAKER_FAILURES = int(os.getenv('CIRCUIT_BREAKER_FAILURES', 5))  # Failures in a row which open a host circuit
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', 300))  # Fail fast before a probe
+KNOWN_ENTRIES_CACHE_TIMEOUT = int(os.getenv('KNOWN_ENTRIES_CACHE_TIMEOUT', 86400))  # Known guids of a feed
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', DAYS_RETRIEVABLE))  # Entries older are deleted, per feed override
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))  # Delete expired entries in seconds
+RETENTION_CHUNK_SIZE = int(os.getenv('RETENTION_CHUNK_SIZE', 500))  # Number of entries deleted per transaction
+RETENTION_ARCHIVE = os.getenv('RETENTION_ARCHIVE', 'False') == 'True'  # Keep a compact copy of deleted entries
@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Entry, Feed, FeedSubscription, ReadEntry
+from .models import Entry, Feed, FeedSubscription, ReadEntry, ImportJob, ArchivedEntry
 
 admin.site.register(Entry)
 admin.site.register(Feed)
 admin.site.register(FeedSubscription)
 admin.site.register(ReadEntry)
+admin.site.register(ImportJob)
+admin.site.register(ArchivedEntry)
@@ -0,0 +1,79 @@
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from rssfeed.settings import EXPORT_CHUNK_SIZE
+from .models import FeedSubscription, ReadEntry
+
+# Exports are streamed: each generator yields the export piece by piece while reading the database in chunks of
+# 'EXPORT_CHUNK_SIZE' rows, so that memory stays constant however large the export is.
+
+
+def get_export_entries(user, entries):
+    """
+    Entries to export, with their feed and whether the user has read them, read in chunks
+    :param user: user who exports
+    :param entries: queryset of the entries to export
+    :return: iterator of Entry, each one with 'is_read' annotated
+    """
+    return entries.select_related('feed').annotate(
+        is_read=Exists(ReadEntry.objects.filter(user=user, entry=OuterRef('pk')))
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def iter_opml(user):
+    """
+    Export the subscriptions of a user as OPML, which other feed readers import, see 'parsers.parse_opml()'
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n<opml version="2.0">\n'
+           f'<head><title>Subscriptions of {escape(user.username)}</title>'
+           f'<dateCreated>{timezone.now().strftime("%a, %d %b %Y %H:%M:%S %z")}</dateCreated></head>\n<body>\n')
+    subscriptions = FeedSubscription.objects.filter(user=user).select_related('feed').order_by('id')
+    for subscription in subscriptions.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        feed = subscription.feed
+        title = quoteattr(feed.title or feed.feed_url)
+        html_url = f' htmlUrl={quoteattr(feed.link)}' if feed.link else ''
+        yield f'<outline type="rss" text={title} title={title} xmlUrl={quoteattr(feed.feed_url)}{html_url}/>\n'
+    yield '</body>\n</opml>\n'
+
+
+def iter_ndjson(user, entries):
+    """
+    Export entries as newline delimited json, one entry with its read state per line
+    """
+    for entry in get_export_entries(user, entries):
+        yield json.dumps({
+            'id': entry.id, 'guid': entry.guid, 'title': entry.title, 'link': entry.link, 'author': entry.author,
+            'description': entry.description, 'published_time': entry.published_time,
+            'created_time': entry.created_time, 'feed_url': entry.feed.feed_url, 'read': entry.is_read,
+        }, cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_atom(user, entries):
+    """
+    Export entries as an Atom feed. Read entries are marked with the category 'read'.
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+           f'<id>urn:rssfeed:export:{user.id}</id><title>Entries of {escape(user.username)}</title>'
+           f'<updated>{timezone.now().isoformat()}</updated>\n')
+    for entry in get_export_entries(user, entries):
+        published = (entry.published_time or entry.created_time).isoformat()
+        yield (f'<entry><id>{escape(entry.guid)}</id><title>{escape(entry.title)}</title>'
+               + (f'<link href={quoteattr(entry.link)}/>' if entry.link else '')
+               + (f'<author><name>{escape(entry.author)}</name></author>' if entry.author else '')
+               + f'<published>{published}</published><updated>{published}</updated>'
+               f'<summary type="html">{escape(entry.description)}</summary>'
+               f'<source><id>{escape(entry.feed.feed_url)}</id><title>{escape(entry.feed.title or "")}</title>'
+               f'</source>'
+               + ('<category term="read"/>' if entry.is_read else '')
+               + '</entry>\n')
+    yield '</feed>\n'
+
+
+ENTRY_EXPORTERS = {
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'atom': (iter_atom, 'application/atom+xml'),
+}
@@ -0,0 +1,425 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import feedparser
+import requests
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from rest_framework.exceptions import ValidationError, Throttled
+from rest_framework.status import HTTP_304_NOT_MODIFIED, HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE, \
+    HTTP_301_MOVED_PERMANENTLY, HTTP_308_PERMANENT_REDIRECT
+
+from rssfeed.settings import FETCH_CONCURRENCY, FETCH_TIMEOUT, FETCH_POOL_HOSTS, FETCH_POOL_CONNECTIONS, \
+    HOST_CONCURRENCY, HOST_DELAY, HOST_RETRY_AFTER, MAX_FEED_BYTES, FETCH_RESULT_CACHE_TIMEOUT, \
+    CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_OPEN_SECONDS
+from . import parsers
+from .utils import get_host
+
+logger = logging.getLogger(__name__)
+
+PERMANENT_REDIRECT_STATUSES = (HTTP_301_MOVED_PERMANENTLY, HTTP_308_PERMANENT_REDIRECT)
+CIRCUIT_STATE_TIMEOUT = 24 * 3600  # seconds the state of a circuit is kept, a host forgotten longer starts closed
+HOST_POLL_INTERVAL = 0.1  # seconds between two attempts to take a turn of a busy host
+ACCEPT_HEADER = ('application/atom+xml,application/rss+xml,application/rdf+xml,application/xml;q=0.9,text/xml;q=0.8,'
+                 '*/*;q=0.1')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    HTTP session shared by all downloads of a worker process. It keeps a pool of keep-alive connections per host
+    (up to 'FETCH_POOL_HOSTS' hosts, 'FETCH_POOL_CONNECTIONS' connections each), so feeds hosted together reuse
+    connections. A new session is created after the worker is forked, connections are never shared across processes.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_POOL_HOSTS, pool_maxsize=FETCH_POOL_CONNECTIONS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # requests decompresses the body transparently
+            session.headers.update({'User-Agent': feedparser.USER_AGENT, 'Accept': ACCEPT_HEADER,
+                                    'Accept-Encoding': 'gzip, deflate'})
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+@dataclass
+class FetchResult:
+    """
+    Raw response of downloading a feed. 'error' is set instead of raised when the feed is fetched in a batch
+    """
+    url: str
+    status: Optional[int] = None
+    body: bytes = b''
+    headers: dict = field(default_factory=dict)
+    error: Optional[Exception] = None
+    redirect_url: Optional[str] = None  # url the feed permanently moved to, if it is redirected
+
+    @property
+    def not_modified(self):
+        return self.status == HTTP_304_NOT_MODIFIED
+
+    @property
+    def content_hash(self):
+        """
+        Fast hash of the raw body, to detect an unchanged feed when its server ignores conditional requests
+        """
+        return hashlib.blake2b(self.body, digest_size=16).hexdigest()
+
+    def parse(self):
+        """
+        Parse the downloaded body, see 'parsers.parse()'.
+        :return: the same result as 'feedparser.parse()' would return if it downloaded the feed itself,
+        including 'status', 'etag' and 'modified' of the response, 'content_hash' of the body, and 'hub' and
+        'topic' of the WebSub hub the feed advertises, see 'parsers.get_websub_hub()'
+        """
+        if self.not_modified:
+            return feedparser.FeedParserDict(status=self.status, href=self.url, feed=feedparser.FeedParserDict(),
+                                             entries=[])
+        d = parsers.parse(self.body, base_url=self.url, response_headers=self.headers)
+        d['status'] = self.status
+        d['href'] = self.url
+        d['etag'] = self.headers.get('etag')
+        d['modified'] = self.headers.get('last-modified')
+        d['content_hash'] = self.content_hash
+        d['hub'], d['topic'] = parsers.get_websub_hub(d, self.headers)
+        return d
+
+
+def get_retry_after(response):
+    """
+    Seconds to wait before requesting the host again, according to the 'Retry-After' header of a response.
+    :return: seconds to wait, or 'HOST_RETRY_AFTER' if the header is missing or invalid
+    """
+    retry_after = response.headers.get('Retry-After', '').strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return HOST_RETRY_AFTER
+
+
+def read_body(response, max_bytes):
+    """
+    Read the body of a streamed response, giving up as soon as it is too large
+    :param response: response of a request with 'stream=True'
+    :param max_bytes: maximum size of the body in bytes, after decompression
+    :return: the body
+    :raise ValidationError: the body is larger than 'max_bytes'
+    """
+    error_msg = f'Feed {response.url} is larger than {max_bytes} bytes'
+    content_length = response.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise ValidationError(error_msg)
+
+    chunks, size = [], 0
+    for chunk in response.iter_content(chunk_size=parsers.CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValidationError(error_msg)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def get_circuit_key(host, name):
+    return f'circuit:{name}:{hashlib.md5(host.encode()).hexdigest()}'
+
+
+def check_circuit(host):
+    """
+    Per host circuit breaker, shared by all workers through the cache. After 'CIRCUIT_BREAKER_FAILURES' failures
+    in a row, the circuit of the host opens: its feeds fail fast for 'CIRCUIT_BREAKER_OPEN_SECONDS', without
+    opening a connection. Then the circuit is half-open: a single request probes whether the host recovered,
+    see 'record_success()' and 'record_failure()'.
+    :raise Throttled: the circuit of the host is open, or another request is probing it. 'wait' is in seconds
+    """
+    opened_at = cache.get(get_circuit_key(host, 'opened_at'))
+    if opened_at is None:
+        return
+    wait = opened_at + CIRCUIT_BREAKER_OPEN_SECONDS - time.time()
+    if wait > 0:
+        raise Throttled(wait=wait, detail=f'{host} is down, its circuit is open')
+    if not cache.add(get_circuit_key(host, 'probe'), 1, timeout=FETCH_TIMEOUT + 1):
+        raise Throttled(wait=FETCH_TIMEOUT, detail=f'{host} is down, another request probes it')
+    logger.info(f'Probe whether {host} recovered')
+
+
+def record_success(host):
+    """
+    The host answered: close its circuit
+    """
+    keys = [get_circuit_key(host, name) for name in ('failures', 'opened_at')]
+    if cache.get_many(keys):
+        cache.delete_many(keys + [get_circuit_key(host, 'probe')])
+        logger.info(f'{host} recovered, its circuit is closed')
+
+
+def record_failure(host):
+    """
+    The host did not answer, or failed with a server error. Open its circuit after too many failures in a row.
+    A failed probe opens it again.
+    """
+    if not CIRCUIT_BREAKER_FAILURES:
+        return
+    key = get_circuit_key(host, 'failures')
+    cache.add(key, 0, timeout=CIRCUIT_STATE_TIMEOUT)
+    failures = cache.incr(key)
+    if failures >= CIRCUIT_BREAKER_FAILURES:
+        cache.set(get_circuit_key(host, 'opened_at'), time.time(), timeout=CIRCUIT_STATE_TIMEOUT)
+        cache.delete(get_circuit_key(host, 'probe'))
+        logger.warning(f'{host} failed {failures} times in a row, its circuit is open')
+
+
+def get_host_key(host, name):
+    return f'host:{name}:{hashlib.md5(host.encode()).hexdigest()}'
+
+
+def block_host(host, wait):
+    """
+    The host asked to retry later: no worker requests it for 'wait' seconds, see 'host_turn()'
+    """
+    key = get_host_key(host, 'blocked_until')
+    blocked_until = max(cache.get(key, 0.0), time.time() + wait)
+    cache.set(key, blocked_until, timeout=math.ceil(blocked_until - time.time()) + 1)
+
+
+def _take_host_slot(host):
+    """
+    Take one of the 'HOST_CONCURRENCY' request slots of a host. A slot expires by itself if its worker dies.
+    :return: cache key of the slot, or None if all slots are taken
+    """
+    for i in range(max(HOST_CONCURRENCY, 1)):
+        key = get_host_key(host, f'slot{i}')
+        if cache.add(key, 1, timeout=math.ceil(FETCH_TIMEOUT) + 1):
+            return key
+    return None
+
+
+def _take_host_start(host):
+    """
+    Take the start of a request to a host, one per 'HOST_DELAY' seconds window
+    :return: 0 if the request may start, else seconds until the next window
+    """
+    if not HOST_DELAY:
+        return 0.0
+    window = int(time.time() / HOST_DELAY)
+    if cache.add(get_host_key(host, f'start{window}'), 1, timeout=math.ceil(HOST_DELAY) + 1):
+        return 0.0
+    return max((window + 1) * HOST_DELAY - time.time(), HOST_POLL_INTERVAL)
+
+
+@contextmanager
+def host_turn(host):
+    """
+    Politeness limits of a host, shared by all workers through the cache like its circuit breaker: no request while
+    the host asked to retry later, see 'block_host()', at most 'HOST_CONCURRENCY' requests in flight, and at most
+    one request started every 'HOST_DELAY' seconds. Waits up to 'FETCH_TIMEOUT' seconds for a turn.
+    :raise Throttled: the host asked to retry later, or it stays busy with other requests. 'wait' is in seconds
+    """
+    blocked_until = cache.get(get_host_key(host, 'blocked_until'))
+    if blocked_until is not None and blocked_until > time.time():
+        raise Throttled(wait=blocked_until - time.time(), detail=f'{host} is rate limited')
+
+    slot_key = None
+    waited = 0.0
+    while True:
+        slot_key = slot_key or _take_host_slot(host)
+        wait = _take_host_start(host) if slot_key else HOST_POLL_INTERVAL
+        if not wait:
+            break
+        if waited >= FETCH_TIMEOUT:
+            if slot_key:
+                cache.delete(slot_key)
+            raise Throttled(wait=FETCH_TIMEOUT, detail=f'{host} is busy with other requests')
+        time.sleep(wait)
+        waited += wait
+    try:
+        yield
+    finally:
+        cache.delete(slot_key)
+
+
+def fetch_feed(feed_url, etag=None, modified=None):
+    """
+    Download a feed. Send conditional request headers if validators of the previous fetch are given.
+    :param feed_url: url of the feed
+    :param etag: 'ETag' header returned by the previous fetch
+    :param modified: 'Last-Modified' header returned by the previous fetch
+    :return: FetchResult. Its body is empty if the feed is not modified. If all redirects followed are permanent,
+    'redirect_url' is the final url
+    :raise Throttled: the host asks to slow down (429, or 503 with 'Retry-After'), it is down, see
+    'check_circuit()', or it is busy, see 'host_turn()'. 'wait' is in seconds
+    :raise ValidationError: the download failed, or the feed is larger than 'MAX_FEED_BYTES'
+    """
+    host = get_host(feed_url)
+    check_circuit(host)
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    try:
+        with host_turn(host), \
+                get_session().get(feed_url, headers=headers, timeout=FETCH_TIMEOUT, stream=True) as response:
+            if response.status_code == HTTP_429_TOO_MANY_REQUESTS or (
+                    response.status_code == HTTP_503_SERVICE_UNAVAILABLE and 'Retry-After' in response.headers):
+                wait = get_retry_after(response)
+                block_host(host, wait)
+                raise Throttled(wait=wait, detail=f'{feed_url} is rate limited')
+            if response.status_code >= 500:
+                record_failure(host)
+            else:
+                record_success(host)
+            response.raise_for_status()
+            body = read_body(response, MAX_FEED_BYTES)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        record_failure(host)
+        raise ValidationError(f'Failed to fetch feed: {e}')
+    except requests.RequestException as e:
+        raise ValidationError(f'Failed to fetch feed: {e}')
+
+    permanent = response.history and all(
+        redirect.status_code in PERMANENT_REDIRECT_STATUSES for redirect in response.history)
+    return FetchResult(url=feed_url, status=response.status_code, body=body,
+                       headers={key.lower(): value for key, value in response.headers.items()},
+                       redirect_url=response.url if permanent else None)
+
+
+def get_result_cache_key(feed_url):
+    return f'fetch_result:{hashlib.md5(feed_url.encode()).hexdigest()}'
+
+
+def cache_result(result, timeout=FETCH_RESULT_CACHE_TIMEOUT, feed_url=None):
+    """
+    Keep a download for a short while, so that an update which follows soon, e.g. the first update of a feed
+    which was downloaded when it was subscribed to, does not download the feed again. See 'pop_cached_result()'
+    :param feed_url: url the download is kept for, if not the url it was downloaded from, e.g. after a redirect
+    """
+    cache.set(get_result_cache_key(feed_url or result.url), result, timeout=timeout)
+
+
+def pop_cached_result(feed_url):
+    """
+    Take a download kept by 'cache_result()'. It is used once only.
+    :return: FetchResult, or None if the feed was not downloaded recently
+    """
+    key = get_result_cache_key(feed_url)
+    result = cache.get(key)
+    if result is not None:
+        cache.delete(key)
+        logger.info(f'Use the download of {feed_url} from {FETCH_RESULT_CACHE_TIMEOUT} seconds ago at most')
+    return result
+
+
+class _HostThrottle:
+    """
+    Politeness limits of one host within a batch: at most 'max_concurrency' requests in flight, at least
+    'min_delay' seconds between the start of two requests, and no request at all while the host asked to retry later.
+    Feeds of a batch wait for their turn here without taking a thread; the limits shared with other workers are
+    enforced by 'fetch_feed()', see 'host_turn()'.
+    """
+    def __init__(self, max_concurrency, min_delay):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.min_delay = min_delay
+        self.next_start = 0.0
+        self.blocked_until = 0.0
+
+    def blocked_for(self, loop):
+        return max(self.blocked_until - loop.time(), 0.0)
+
+    def block(self, loop, wait):
+        self.blocked_until = max(self.blocked_until, loop.time() + wait)
+
+    async def wait_turn(self, loop):
+        start = max(self.next_start, loop.time())
+        self.next_start = start + self.min_delay
+        await asyncio.sleep(start - loop.time())
+
+
+async def _fetch_feeds(feeds, concurrency, host_concurrency, host_delay, on_result):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    throttles = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetch_feed') as executor:
+        async def fetch_one(feed_url, validators):
+            host = get_host(feed_url)
+            throttle = throttles.setdefault(host, _HostThrottle(host_concurrency, host_delay))
+            acquired = False
+            # Take a slot of the host first, so feeds waiting for a busy host do not hold connections of others
+            async with throttle.semaphore:
+                try:
+                    if throttle.blocked_for(loop):
+                        raise Throttled(wait=throttle.blocked_for(loop), detail=f'{host} is rate limited')
+                    await throttle.wait_turn(loop)
+                    await semaphore.acquire()
+                    acquired = True
+                    result = await loop.run_in_executor(
+                        executor, functools.partial(fetch_feed, feed_url, **validators))
+                except Throttled as e:
+                    # Defer all other feeds of the host instead of hammering it
+                    throttle.block(loop, e.wait)
+                    logger.info(f'Fetch {feed_url} is deferred for {e.wait} seconds: {e.detail}')
+                    result = FetchResult(url=feed_url, error=e)
+                except Exception as e:
+                    logger.warning(f'Fetch {feed_url} failed with exception: {e}')
+                    result = FetchResult(url=feed_url, error=e)
+            try:
+                if on_result is not None:
+                    # The download slot stays taken while 'on_result' blocks, which pauses the downloads
+                    await loop.run_in_executor(executor, on_result, result)
+            finally:
+                if acquired:
+                    semaphore.release()
+            return result
+
+        tasks = [asyncio.ensure_future(fetch_one(feed_url, validators)) for feed_url, validators in feeds]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # e.g. 'on_result' gave up: do not start the remaining downloads
+            for task in tasks:
+                task.cancel()
+            raise
+
+
+def fetch_feeds(feeds, concurrency=FETCH_CONCURRENCY, host_concurrency=HOST_CONCURRENCY, host_delay=HOST_DELAY,
+                on_result=None):
+    """
+    Download a batch of feeds concurrently, with at most 'concurrency' requests in flight, and at most
+    'host_concurrency' requests started at least 'host_delay' seconds apart per host.
+    Once a host answers with 'Throttled', its remaining feeds are not requested but returned with the same error.
+    The limits of each host are shared with the downloads of other batches and workers, see 'host_turn()'.
+    Must not be called from a running event loop. The database is not touched while downloading, so the
+    caller is free to parse and store the results afterwards.
+    :param feeds: list of (feed_url, validators) tuples, validators as returned by 'Feed.get_validators()'
+    :param concurrency: maximum number of concurrent connections
+    :param host_concurrency: maximum number of concurrent connections per host
+    :param host_delay: minimum delay in seconds between two requests to the same host
+    :param on_result: optional callable called with each FetchResult as soon as it is downloaded. It may block to
+    slow down the downloads, e.g. to put the result into a bounded queue
+    :return: list of FetchResult in the same order as 'feeds'
+    """
+    if not feeds:
+        return []
+    return asyncio.run(_fetch_feeds(feeds, concurrency, host_concurrency, host_delay, on_result))
@@ -0,0 +1,55 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rssfeedapi.parsers import PARSERS
+from rssfeedapi.utils import normalize_entry
+
+
+class Command(BaseCommand):
+    help = 'Compare the speed and the results of the feed parsers on a corpus of saved feeds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='feed files, or directories of feed files')
+        parser.add_argument('--repeat', type=int, default=10, help='number of times each feed is parsed')
+
+    def get_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                yield from sorted(os.path.join(path, name) for name in os.listdir(path)
+                                  if os.path.isfile(os.path.join(path, name)))
+            elif os.path.isfile(path):
+                yield path
+            else:
+                raise CommandError(f'{path} does not exist')
+
+    def handle(self, *args, **options):
+        totals = dict.fromkeys(PARSERS, 0.0)
+        num_files = num_mismatches = 0
+        for file_path in self.get_files(options['paths']):
+            with open(file_path, 'rb') as f:
+                body = f.read()
+
+            timings, results = {}, {}
+            for name, parse in PARSERS.items():
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    results[name] = parse(body, base_url=file_path)
+                timings[name] = (time.perf_counter() - start) / options['repeat']
+                totals[name] += timings[name]
+
+            # Only the stored fields are compared
+            entries = {name: [normalize_entry(entry) for entry in d.entries] for name, d in results.items()}
+            same = all(value == entries['feedparser'] for value in entries.values())
+            num_files += 1
+            num_mismatches += not same
+            self.stdout.write(f'{file_path}: {len(entries["feedparser"])} entries, ' + ', '.join(
+                f'{name} {timing * 1000:.2f} ms' for name, timing in timings.items()) + ('' if same else ', MISMATCH'))
+
+        if not num_files:
+            raise CommandError('No feed files found')
+        self.stdout.write(self.style.SUCCESS(
+            f'{num_files} feeds, {num_mismatches} with different entries. Total: ' + ', '.join(
+                f'{name} {total * 1000:.2f} ms' for name, total in totals.items())
+            + f'. fast is {totals["feedparser"] / totals["fast"]:.1f}x faster than feedparser'))
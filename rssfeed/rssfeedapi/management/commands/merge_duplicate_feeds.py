@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from rssfeedapi.models import Feed
+
+
+class Command(BaseCommand):
+    help = 'Merge feeds which are variants of the same url, e.g. subscribed before urls were normalized'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only list the feeds which would be merged')
+
+    def get_canonical_feed(self, feeds):
+        """
+        The feed the others are merged into: an https one if any, then the one with the most subscribers
+        """
+        return min(feeds, key=lambda feed: (not feed.feed_url.startswith('https://'), -feed.subscriber_count, feed.id))
+
+    def handle(self, *args, **options):
+        url_keys = Feed.objects.values('url_key').annotate(num_feeds=Count('id')).filter(
+            num_feeds__gt=1).values_list('url_key', flat=True)
+        num_merged = 0
+        for url_key in list(url_keys):
+            feeds = list(Feed.objects.filter(url_key=url_key))
+            canonical_feed = self.get_canonical_feed(feeds)
+            aliases = [feed for feed in feeds if feed.id != canonical_feed.id]
+            self.stdout.write(f'{canonical_feed.feed_url} <- {", ".join(feed.feed_url for feed in aliases)}')
+            if not options['dry_run']:
+                canonical_feed.merge(aliases)
+            num_merged += len(aliases)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{num_merged} feeds {"would be" if options["dry_run"] else "are"} merged'))
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.3 on 2026-10-16 22:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0002_sync_model_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='etag',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.3 on 2026-10-16 22:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Changes of the models which were made without a migration before 0002_feed_http_validators
+
+    dependencies = [
+        ('rssfeedapi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='feedsubscription',
+            options={'ordering': ('-id',)},
+        ),
+        migrations.RenameIndex(
+            model_name='feed',
+            new_name='feed url index',
+            old_name='feed_url index',
+        ),
+        migrations.AlterField(
+            model_name='entry',
+            name='title',
+            field=models.CharField(max_length=512),
+        ),
+        migrations.AlterField(
+            model_name='feed',
+            name='status',
+            field=models.CharField(choices=[('creating', 'creating'), ('updated', 'Updated'), ('error', 'Error')], default='updated', max_length=16),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0002_feed_http_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='empty_polls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='next_poll_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='poll_interval',
+            field=models.FloatField(default=1200.0),
+        ),
+    ]
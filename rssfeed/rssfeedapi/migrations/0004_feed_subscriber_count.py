@@ -0,0 +1,29 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:03
+
+from django.db import migrations, models
+
+
+def count_subscribers(apps, schema_editor):
+    Feed = apps.get_model('rssfeedapi', 'Feed')
+    for feed in Feed.objects.annotate(num_subscribers=models.Count('subscribers')).filter(num_subscribers__gt=0):
+        Feed.objects.filter(id=feed.id).update(subscriber_count=feed.num_subscribers)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0003_feed_adaptive_poll_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='subscriber_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['next_poll_at'], name='feed next poll index'),
+        ),
+        migrations.RunPython(count_subscribers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0004_feed_subscriber_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='failed_updates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
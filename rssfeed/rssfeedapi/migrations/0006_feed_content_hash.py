@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0005_feed_failed_updates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rssfeedapi', '0006_feed_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_new_feeds', models.PositiveIntegerField(default=0)),
+                ('num_skipped', models.PositiveIntegerField(default=0)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('feeds', models.ManyToManyField(related_name='+', to='rssfeedapi.feed')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-id',),
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:36
+
+from django.db import migrations, models
+
+from rssfeedapi.utils import get_url_key
+
+
+def set_url_keys(apps, schema_editor):
+    Feed = apps.get_model('rssfeedapi', 'Feed')
+    for feed in Feed.objects.only('id', 'feed_url').iterator():
+        Feed.objects.filter(id=feed.id).update(url_key=get_url_key(feed.feed_url))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0007_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='url_key',
+            field=models.CharField(default='', max_length=256),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['url_key'], name='feed url key index'),
+        ),
+        migrations.RunPython(set_url_keys, migrations.RunPython.noop),
+    ]
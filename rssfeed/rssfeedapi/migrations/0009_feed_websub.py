@@ -0,0 +1,33 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0008_feed_url_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='hub_url',
+            field=models.URLField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='websub_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='websub_secret',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='websub_topic',
+            field=models.URLField(blank=True, max_length=256, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:42
+
+from django.db import migrations, models
+
+from rssfeedapi.utils import chunked, get_content_hash
+
+CONTENT_FIELDS = ('title', 'link', 'author', 'description')  # 'Entry.CONTENT_FIELDS' of this migration
+
+
+def set_content_hashes(apps, schema_editor):
+    # Entries store their parsed fields as they are: an unchanged entry hashes the same at its next update,
+    # and is not rewritten
+    Entry = apps.get_model('rssfeedapi', 'Entry')
+    entries = Entry.objects.only('id', *CONTENT_FIELDS).iterator(chunk_size=1000)
+    for chunk in chunked(entries, 1000):
+        for entry in chunk:
+            entry.content_hash = get_content_hash(getattr(entry, field) for field in CONTENT_FIELDS)
+        Entry.objects.bulk_update(chunk, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0009_feed_websub'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(set_content_hashes, migrations.RunPython.noop),
+    ]
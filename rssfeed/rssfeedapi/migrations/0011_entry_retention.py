@@ -0,0 +1,35 @@
+# Generated by Django 4.1.3 on 2026-10-16 23:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0010_entry_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ArchivedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('guid', models.CharField(max_length=256, unique=True)),
+                ('title', models.CharField(max_length=512)),
+                ('link', models.URLField(blank=True, max_length=256, null=True)),
+                ('published_time', models.DateTimeField(blank=True, null=True)),
+                ('archived_time', models.DateTimeField(auto_now_add=True)),
+                ('feed', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_entries', to='rssfeedapi.feed')),
+            ],
+            options={
+                'verbose_name_plural': 'archived entries',
+                'ordering': ('-published_time',),
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.3 on 2026-10-17 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0011_entry_retention'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='feed',
+            name='feed next poll index',
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['next_poll_at', 'id'], name='feed next poll index'),
+        ),
+    ]
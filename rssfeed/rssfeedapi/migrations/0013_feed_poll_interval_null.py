@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-17 00:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rssfeedapi', '0012_feed_next_poll_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='feed',
+            name='poll_interval',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
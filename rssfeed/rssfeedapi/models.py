@@ -1,17 +1,28 @@
+import hashlib
 import logging
-from datetime import timedelta
-
-import feedparser
+import random
+import statistics
+from datetime import datetime, timedelta, timezone as dt_timezone
 
+from django.core.cache import cache
 from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.exceptions import ValidationError, APIException
 
-from rssfeed.settings import DAYS_RETRIEVABLE
-from .utils import get_published_parsed
+from rssfeed.settings import DAYS_RETRIEVABLE, INGEST_BATCH_SIZE, UPDATE_INTERVAL, MIN_UPDATE_INTERVAL, \
+    MAX_UPDATE_INTERVAL, EMPTY_POLL_BACKOFF, POLL_JITTER, WEBSUB_POLL_INTERVAL, KNOWN_ENTRIES_CACHE_TIMEOUT, \
+    MAX_FEED_ENTRIES, RETENTION_DAYS, FEED_UPDATE_LOCK_TIMEOUT
+from . import fetcher
+from .utils import get_published_parsed, chunked, get_backoff, canonicalize_url, get_url_key, get_content_hash
 logger = logging.getLogger(__name__)
 
+CADENCE_SAMPLE_SIZE = 20  # number of recent entries the publish cadence of a feed is computed from
+MAX_EMPTY_POLLS_BACKOFF = 10
+GOLDEN_RATIO = (5 ** 0.5 - 1) / 2  # consecutive ids get phases far apart
+KNOWN_ENTRIES_MAX = 2 * MAX_FEED_ENTRIES  # most entries remembered per feed, the least recently seen are dropped
+
 
 class FeedSubscription(models.Model):
     user = models.ForeignKey('users.User', on_delete=models.CASCADE)
@@ -51,6 +62,7 @@ class Entry(models.Model):
     author = models.URLField(max_length=64, blank=True, null=True)
     published_time = models.DateTimeField(blank=True, null=True)
     created_time = models.DateTimeField(auto_now_add=True)
+    content_hash = models.CharField(max_length=32, blank=True, null=True)  # hash of the content fields, see below
     feed = models.ForeignKey('Feed', on_delete=models.CASCADE, related_name='entries')
     read_by = models.ManyToManyField('users.User', through=ReadEntry, related_name='read_entries')
     objects = models.Manager()  # The default manager.
@@ -61,25 +73,95 @@ class Entry(models.Model):
         verbose_name_plural = 'entries'
         indexes = [models.Index(name="entry guid index", fields=["guid", ],)]
 
+    # Fields rewritten when an entry is edited. The published time is kept: some feeds change it at every fetch
+    CONTENT_FIELDS = ('title', 'link', 'author', 'description')
+
     def __str__(self):
         return self.title
 
+    @classmethod
+    def get_content_hash(cls, parsed_entry):
+        """
+        Fast hash of the content fields of a parsed entry, to detect an edited entry without comparing its fields
+        :param parsed_entry: one parsed entry from 'feedparser.parse()' (d.entries)
+        """
+        return get_content_hash(parsed_entry.get(field) for field in cls.CONTENT_FIELDS)
+
+    @classmethod
+    def from_parsed(cls, parsed_entry, feed_id):
+        """
+        Build an unsaved entry from a parsed entry
+        :param parsed_entry: one parsed entry from 'feedparser.parse()' (d.entries)
+        :param feed_id: id of the feed the entry belongs to
+        :return: Entry instance, not saved in the database yet
+        """
+        published_parsed = get_published_parsed(parsed_entry)
+        return cls(
+            guid=parsed_entry.get('id'), title=parsed_entry.get('title', ''),
+            link=parsed_entry.get('link', ''), author=parsed_entry.get('author', ''),
+            description=parsed_entry.get('description', ''), published_time=published_parsed,
+            content_hash=cls.get_content_hash(parsed_entry), feed_id=feed_id)
+
     @classmethod
     def get_or_create(cls, parsed_entry, feed_id):
         try:
             entry = cls.objects.get(guid=parsed_entry.get('id'))
             logger.info(f'Find Entry {entry.guid}: {entry.title} in DB')
         except cls.DoesNotExist:
-            published_parsed = get_published_parsed(parsed_entry)
-            entry = cls.objects.create(
-                guid=parsed_entry.get('id'), title=parsed_entry.get('title', ''),
-                link=parsed_entry.get('link', ''), author=parsed_entry.get('author', ''),
-                description=parsed_entry.get('description', ''), published_time=published_parsed,
-                feed_id=feed_id)
+            entry = cls.from_parsed(parsed_entry, feed_id)
+            entry.save(force_insert=True)
 
             logger.info(f'New Entry {entry.guid}: {entry.title} is created')
         return entry
 
+    @classmethod
+    def get_expired(cls):
+        """
+        Entries older than the retention of their feed: 'Feed.retention_days' if set, otherwise 'RETENTION_DAYS'.
+        An entry expires once both its published time (if any) and its creation are older than that, so that an old
+        entry which is still listed by its feed and created again is kept for a whole retention period
+        :return: queryset of expired entries
+        """
+        now = timezone.now()
+        retentions = Feed.objects.filter(retention_days__isnull=False).values_list(
+            'retention_days', flat=True).distinct()
+        expired = models.Q(feed__retention_days__isnull=True, last_time__lt=now - timedelta(days=RETENTION_DAYS))
+        for retention_days in retentions:
+            expired |= models.Q(feed__retention_days=retention_days,
+                                last_time__lt=now - timedelta(days=retention_days))
+        return cls.objects.annotate(
+            last_time=Greatest(Coalesce('published_time', 'created_time'), 'created_time')).filter(expired)
+
+
+class ArchivedEntry(models.Model):
+    """
+    Compact copy of an expired entry: its content and read state are dropped, see 'RETENTION_ARCHIVE'
+    """
+    guid = models.CharField(max_length=256, unique=True)
+    title = models.CharField(max_length=512)
+    link = models.URLField(max_length=256, blank=True, null=True)
+    published_time = models.DateTimeField(blank=True, null=True)
+    feed = models.ForeignKey('Feed', on_delete=models.CASCADE, related_name='archived_entries')
+    archived_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-published_time', )
+        verbose_name_plural = 'archived entries'
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def archive(cls, entry_ids):
+        """
+        Copy entries into the archive in one insert. Entries archived already, e.g. created again after they
+        expired, are skipped
+        :param entry_ids: ids of the entries to archive
+        """
+        cls.objects.bulk_create([
+            cls(**fields) for fields in Entry.objects.filter(id__in=entry_ids).values(
+                'guid', 'title', 'link', 'published_time', 'feed_id')], ignore_conflicts=True)
+
 
 class Feed(models.Model):
     class Status(models.TextChoices):
@@ -88,6 +170,7 @@ class Feed(models.Model):
         ERROR = 'error', 'Error'
 
     feed_url = models.URLField(max_length=256, unique=True)
+    url_key = models.CharField(max_length=256, default='')  # shared by the urls of the same feed, see 'get_url_key()'
     title = models.CharField(max_length=512, blank=True, null=True)
     link = models.URLField(max_length=256, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
@@ -95,53 +178,261 @@ class Feed(models.Model):
     last_updated = models.DateTimeField(auto_now_add=True)
     language = models.CharField(max_length=16, blank=True, null=True)
     status = models.CharField(max_length=16, choices=Status.choices, default=Status.UPDATED)
+    etag = models.CharField(max_length=256, blank=True, null=True)
+    last_modified = models.CharField(max_length=64, blank=True, null=True)
+    content_hash = models.CharField(max_length=32, blank=True, null=True)  # hash of the last fetched body
+    hub_url = models.URLField(max_length=256, blank=True, null=True)  # WebSub hub the feed is subscribed to
+    websub_topic = models.URLField(max_length=256, blank=True, null=True)
+    websub_secret = models.CharField(max_length=64, blank=True, null=True)
+    websub_expires_at = models.DateTimeField(blank=True, null=True)  # end of the lease verified by the hub
+    retention_days = models.PositiveIntegerField(blank=True, null=True)  # overrides 'RETENTION_DAYS' if set
+    poll_interval = models.FloatField(blank=True, null=True)  # in seconds, 'UPDATE_INTERVAL' until scheduled
+    next_poll_at = models.DateTimeField(default=timezone.now)
+    empty_polls = models.PositiveIntegerField(default=0)  # consecutive updates without new entries
+    failed_updates = models.PositiveIntegerField(default=0)  # consecutive failed updates
     subscribers = models.ManyToManyField('users.User', through=FeedSubscription, related_name='subscriptions')
+    subscriber_count = models.PositiveIntegerField(default=0)  # kept up to date by 'signals.py'
 
     class Meta:
-        indexes = [models.Index(name="feed url index", fields=["feed_url", ],)]
+        indexes = [models.Index(name="feed url index", fields=["feed_url", ],),
+                   models.Index(name="feed url key index", fields=["url_key", ],),
+                   models.Index(name="feed next poll index", fields=["next_poll_at", "id", ],)]
 
     def __str__(self):
         return self.feed_url
 
+    @staticmethod
+    def get_metadata(parsed_feed):
+        """
+        Fields of a feed given by its channel
+        :param parsed_feed: 'd.feed' of 'feedparser.parse()'
+        :return: dict of title, link, description and language
+        """
+        return {field: parsed_feed.get(field) or '' for field in ('title', 'link', 'description', 'language')}
+
+    def save(self, *args, **kwargs):
+        self.url_key = get_url_key(self.feed_url)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def get_by_url(cls, feed_url):
+        """
+        Find a feed by any of its urls, see 'utils.get_url_key()'
+        :return: the feed, or None if it is not in the database
+        """
+        return cls.objects.filter(url_key=get_url_key(feed_url)).order_by('id').first()
+
     @classmethod
-    def get_or_create(cls, feed_url):
+    def get_or_create(cls, feed_url, validate=True):
         """
         This function will only create one feed entry in 'Feed' table.
         All the belonging feed items should be created asynchronously in a separate celery task.
+        The url is normalized, see 'utils.canonicalize_url()', and a feed which is permanently redirected is
+        created with the url it moved to: all variants of the url of a feed find the same feed.
+        :param feed_url: url of the feed
+        :param validate: whether a new feed is downloaded and parsed before it is created. If not, it is created
+        without its fields: its first update at background validates it and fills them in, see 'tasks.ingest_feed()'
+        :return: (feed, whether it is created)
         """
-        try:
-            feed = cls.objects.get(feed_url=feed_url)
-            create = False
+        feed_url = canonicalize_url(feed_url)
+        feed = cls.get_by_url(feed_url)
+        if feed is not None:
             logger.info(f'Find Feed: {feed.feed_url} in DB')
-        except cls.DoesNotExist:
-            d = feedparser.parse(feed_url)
-            if d.get('bozo'):
-                raise ValidationError(
-                    f'Failed to parse feed: {d.get("bozo_exception")}', code=status.HTTP_400_BAD_REQUEST
-                )
-            published_parsed = get_published_parsed(d.feed)
-
-            feed = cls.objects.create(feed_url=feed_url, title=d.feed.get('title', ''), link=d.feed.get('link', ''),
-                                      description=d.feed.get('description', ''), language=d.feed.get('language', ''),
-                                      status=Feed.Status.CREATING, published_time=published_parsed)
-            create = True
-
-        return feed, create
+            return feed, False
+
+        if not validate:
+            feed, create = cls.objects.get_or_create(feed_url=feed_url, defaults={'status': Feed.Status.CREATING})
+            return feed, create
+
+        result = fetcher.fetch_feed(feed_url)
+        if result.redirect_url and get_url_key(result.redirect_url) != get_url_key(feed_url):
+            feed = cls.get_by_url(result.redirect_url)
+            if feed is not None:
+                logger.info(f'Find Feed: {feed.feed_url} in DB, {feed_url} is redirected to it')
+                return feed, False
+        if result.redirect_url:
+            feed_url = canonicalize_url(result.redirect_url)
+
+        d = result.parse()
+        if d.get('bozo'):
+            raise ValidationError(
+                f'Failed to parse feed: {d.get("bozo_exception")}', code=status.HTTP_400_BAD_REQUEST
+            )
+        published_parsed = get_published_parsed(d.feed)
+
+        feed = cls.objects.create(feed_url=feed_url, **cls.get_metadata(d.feed),
+                                  status=Feed.Status.CREATING, published_time=published_parsed,
+                                  etag=d.get('etag'), last_modified=d.get('modified'))
+        # The first update of the feed follows right away: let it reuse this download
+        fetcher.cache_result(result, feed_url=feed.feed_url)
+
+        return feed, True
+
+    def move_to(self, feed_url):
+        """
+        Record that the feed permanently moved to another url. If another feed already has that url, it is the
+        same feed: this one is merged into it, see 'merge()'
+        :param feed_url: url the feed is redirected to
+        :return: the feed at the new url, this one or the one it is merged into
+        """
+        feed_url = canonicalize_url(feed_url)
+        feed = Feed.objects.filter(url_key=get_url_key(feed_url)).exclude(id=self.id).order_by('id').first()
+        if feed is not None:
+            logger.info(f'Feed {self.feed_url} moved to {feed.feed_url}, merge them')
+            feed.merge([self])
+            return feed
+        if feed_url != self.feed_url:
+            logger.info(f'Feed {self.feed_url} moved to {feed_url}')
+            self.feed_url = feed_url
+            self.save(update_fields=['feed_url', 'url_key'])
+        return self
+
+    def merge(self, aliases):
+        """
+        Merge duplicate feeds into this one, and delete them. Their subscribers are subscribed to this feed,
+        and their entries, with their read state, and their archived entries belong to this feed.
+        :param aliases: feeds which are the same feed as this one
+        """
+        with transaction.atomic():
+            for alias in aliases:
+                subscriber_ids = FeedSubscription.objects.filter(feed=self).values('user_id')
+                FeedSubscription.objects.filter(feed=alias).exclude(user_id__in=subscriber_ids).update(feed=self)
+                Entry.objects.filter(feed=alias).update(feed=self)
+                ArchivedEntry.objects.filter(feed=alias).update(feed=self)
+                import_job_ids = ImportJob.feeds.through.objects.filter(feed=self).values('importjob_id')
+                ImportJob.feeds.through.objects.filter(feed=alias).exclude(
+                    importjob_id__in=import_job_ids).update(feed=self)
+                alias.delete()
+            Feed.update_subscriber_count([self.id])
 
     def update_entries(self, parsed_entries_list, published_parsed):
         """
-        create/update entries of a feed. If error occurs on one entry, roll back the transaction
-        and continue for other entries.
+        create/update entries of a feed in batches of 'INGEST_BATCH_SIZE'. Entries of a batch which are not in
+        the database yet are created at once. If that fails, fall back to create them one by one: roll back the
+        transaction of a failed entry and continue for other entries.
+        An unchanged published time of the feed only skips the update if the hash of its previous body is unknown:
+        otherwise the body changed, see 'tasks.is_unchanged()', e.g. an entry was edited without the feed
+        publishing again.
         :param parsed_entries_list: parsed entries list from 'feedparser.parser()' (d.entreis)
         :param published_parsed: feed published time from 'feedparser.parse()' (d.published_parsed or d.updated_parsed)
         :return: a list of failed entries
         """
         failed_entries_list = []
-        if self.published_time == published_parsed and self.status == Feed.Status.UPDATED:
+        if (published_parsed and self.published_time == published_parsed and self.status == Feed.Status.UPDATED
+                and self.content_hash is None):
             logger.info(f"Nothing to update: {self.title}")
             return failed_entries_list
 
-        for entry in parsed_entries_list:  # make a new list for iteration
+        known_entries = self.get_known_entries()
+        seen_entries = {}
+        for parsed_entries in chunked(parsed_entries_list, INGEST_BATCH_SIZE):
+            digests = [Feed.get_entry_digests(entry) for entry in parsed_entries]
+            # Only entries which may be new or edited are looked up in the database
+            unknown_entries = [entry for entry, (guid_digest, content_digest) in zip(parsed_entries, digests)
+                               if guid_digest is None or known_entries.get(guid_digest) != content_digest]
+            failed_entries = self._bulk_create_entries(unknown_entries) if unknown_entries else []
+            failed_entries_list.extend(failed_entries)
+
+            failed_ids = {id(entry) for entry in failed_entries}
+            seen_entries.update((guid_digest, content_digest)
+                                for entry, (guid_digest, content_digest) in zip(parsed_entries, digests)
+                                if guid_digest is not None and id(entry) not in failed_ids)
+
+        self.remember_entries(known_entries, seen_entries)
+        return failed_entries_list
+
+    def get_known_entries_key(self):
+        return f'known_entries:{self.id}'
+
+    @staticmethod
+    def get_entry_digests(parsed_entry):
+        """
+        Compact digests of the guid and of the content of a parsed entry, see 'get_known_entries()'
+        :param parsed_entry: one parsed entry from 'feedparser.parse()' (d.entries)
+        :return: (guid digest, content digest), 8 bytes each. The guid digest is None for an entry without guid
+        """
+        guid = parsed_entry.get('id')
+        if guid is None:
+            return None, None
+        return (hashlib.blake2b(guid.encode(), digest_size=8).digest(),
+                bytes.fromhex(Entry.get_content_hash(parsed_entry))[:8])
+
+    def get_known_entries(self):
+        """
+        Entries of the feed which are stored already, kept in the cache shared by the workers: a compact map of
+        the digest of their guid to the digest of their content. Most entries of a fetched feed are known and
+        unchanged, they are skipped without querying the database. 'KNOWN_ENTRIES_CACHE_TIMEOUT' set to 0 disables it
+        :return: dict of guid digest to content digest, see 'get_entry_digests()'
+        """
+        if not KNOWN_ENTRIES_CACHE_TIMEOUT:
+            return {}
+        return cache.get(self.get_known_entries_key()) or {}
+
+    def remember_entries(self, known_entries, seen_entries):
+        """
+        Add the entries stored by an update to the known entries of the feed. Entries seen last are kept at the end,
+        so that the least recently seen ones are dropped beyond 'KNOWN_ENTRIES_MAX'. The cache is not written if all
+        of them were known already. It is written once the transaction of the update commits: entries rolled back
+        must not be known
+        :param known_entries: known entries before the update, see 'get_known_entries()'
+        :param seen_entries: dict of guid digest to content digest of the entries stored by the update
+        """
+        if not KNOWN_ENTRIES_CACHE_TIMEOUT or all(known_entries.get(guid_digest) == content_digest
+                                                  for guid_digest, content_digest in seen_entries.items()):
+            return
+        for guid_digest in seen_entries:
+            known_entries.pop(guid_digest, None)
+        known_entries.update(seen_entries)
+        for guid_digest in list(known_entries)[:max(len(known_entries) - KNOWN_ENTRIES_MAX, 0)]:
+            del known_entries[guid_digest]
+        key = self.get_known_entries_key()
+        transaction.on_commit(lambda: cache.set(key, known_entries, timeout=KNOWN_ENTRIES_CACHE_TIMEOUT))
+
+    def _bulk_create_entries(self, parsed_entries):
+        """
+        Create the entries whose guid is not in the database yet with one lookup and one insert transaction.
+        Existing entries of the feed whose content hash changed, i.e. which were edited, are rewritten with one
+        bulk update, unchanged ones are not written.
+        :param parsed_entries: a batch of parsed entries
+        :return: a list of failed entries, including edited entries which failed to be updated
+        """
+        existing_hashes = {guid: (entry_id, feed_id, content_hash) for guid, entry_id, feed_id, content_hash in
+                           Entry.objects.filter(guid__in=[entry.get('id') for entry in parsed_entries]).values_list(
+                               'guid', 'id', 'feed_id', 'content_hash')}
+
+        new_entries = []
+        changed_entries = {}
+        for entry in parsed_entries:
+            guid = entry.get('id')
+            if guid in existing_hashes:
+                entry_id, feed_id, content_hash = existing_hashes[guid]
+                # Entries of other feeds with the same guid are left alone
+                if feed_id == self.id and content_hash != Entry.get_content_hash(entry):
+                    changed_entries[guid] = (entry, Entry.from_parsed(parsed_entry=entry, feed_id=self.id))
+                    changed_entries[guid][1].id = entry_id
+                continue
+            if guid is not None:  # entries without guid are left to fail in the fallback
+                existing_hashes[guid] = (None, None, None)
+            new_entries.append(entry)
+
+        failed_updates = []
+        if changed_entries and not self._bulk_update_entries([entry for _, entry in changed_entries.values()]):
+            failed_updates = [parsed_entry for parsed_entry, _ in changed_entries.values()]
+
+        if not new_entries:
+            return failed_updates
+
+        try:
+            with transaction.atomic():
+                Entry.objects.bulk_create([Entry.from_parsed(parsed_entry=entry, feed_id=self.id)
+                                           for entry in new_entries])
+            logger.info(f'{len(new_entries)} new entries of {self.feed_url} are created')
+            return failed_updates
+        except Exception as e:
+            logger.warning(f'Failed to create entries of {self.feed_url} at once: {e}. Create them one by one')
+
+        failed_entries_list = failed_updates
+        for entry in new_entries:
             # continue update other entries if one or more entries update fails
             try:
                 with transaction.atomic():
@@ -152,15 +443,148 @@ class Feed(models.Model):
 
         return failed_entries_list
 
+    def _bulk_update_entries(self, entries):
+        """
+        Rewrite the content of edited entries in one transaction
+        :param entries: unsaved entries with the id of the existing rows, see 'Entry.from_parsed()'
+        :return: True if they are updated. If not, they are left as they are, with their previous hash
+        """
+        try:
+            with transaction.atomic():
+                Entry.objects.bulk_update(entries, Entry.CONTENT_FIELDS + ('content_hash', ))
+            logger.info(f'{len(entries)} edited entries of {self.feed_url} are updated')
+            return True
+        except Exception as e:
+            logger.warning(f'Failed to update edited entries of {self.feed_url}: {e}')
+            return False
+
     def get_queryset(self):
         return self.__class__.objects.filter(id=self.id)
 
-    def update_status(self, feed_status, published_parsed):
+    @classmethod
+    def update_subscriber_count(cls, feed_ids):
+        """
+        Recount the subscribers of feeds after subscriptions are added or removed
+        :param feed_ids: ids of the feeds whose subscriptions changed
+        """
+        subscriber_count = FeedSubscription.objects.filter(feed=models.OuterRef('pk')).order_by().values(
+            'feed').annotate(count=models.Count('id')).values('count')
+        cls.objects.filter(id__in=feed_ids).update(
+            subscriber_count=Coalesce(models.Subquery(subscriber_count), 0))
+
+    def get_publish_cadence(self):
+        """
+        Observed publish cadence of the feed: the median gap between the published time of its recent entries,
+        counting the time since the latest entry as a gap too, so a feed which stopped publishing slows down.
+        :return: cadence in seconds, or None if the feed has not published any entry
+        """
+        published_times = list(self.entries.exclude(published_time=None).order_by('-published_time').values_list(
+            'published_time', flat=True)[:CADENCE_SAMPLE_SIZE])
+        if not published_times:
+            return None
+        published_times.insert(0, max(timezone.now(), published_times[0]))
+        return statistics.median(
+            (later - earlier).total_seconds() for later, earlier in zip(published_times, published_times[1:]))
+
+    def get_poll_slot(self, poll_interval):
+        """
+        Next poll time in the slot of the feed. Each feed has a fixed phase within its interval, derived from its id,
+        so that the polls of all feeds are spread evenly over the interval instead of piling up at the same moment.
+        The slot is at least half an interval away, and is shifted by a random jitter of up to 'POLL_JITTER'.
+        :param poll_interval: interval in seconds
+        :return: next poll time
+        """
+        now = timezone.now().timestamp()
+        phase = (self.id * GOLDEN_RATIO) % 1 * poll_interval
+        earliest = now + poll_interval / 2
+        next_poll = earliest + (phase - earliest) % poll_interval
+        next_poll += random.uniform(-POLL_JITTER, POLL_JITTER) * poll_interval
+        return datetime.fromtimestamp(next_poll, tz=dt_timezone.utc)
+
+    def schedule_next_poll(self, has_new_entries):
+        """
+        Schedule the next periodic update of the feed according to its publish cadence. Every update in a row
+        which finds no new entries multiplies the interval by 'EMPTY_POLL_BACKOFF'. The interval is kept between
+        'MIN_UPDATE_INTERVAL' and 'MAX_UPDATE_INTERVAL'. A feed whose entries are pushed by its WebSub hub is
+        polled every 'WEBSUB_POLL_INTERVAL' at most, only as a safety net.
+        :param has_new_entries: whether the update which just finished created new entries
+        :return: next poll time
+        """
+        empty_polls = 0 if has_new_entries else self.empty_polls + 1
+        poll_interval = self.get_publish_cadence() or UPDATE_INTERVAL
+        poll_interval *= EMPTY_POLL_BACKOFF ** min(empty_polls, MAX_EMPTY_POLLS_BACKOFF)
+        poll_interval = min(max(poll_interval, MIN_UPDATE_INTERVAL), MAX_UPDATE_INTERVAL)
+        if self.is_push_enabled():
+            poll_interval = max(poll_interval, WEBSUB_POLL_INTERVAL)
+        next_poll_at = self.get_poll_slot(poll_interval)
+
+        self.get_queryset().update(poll_interval=poll_interval, next_poll_at=next_poll_at, empty_polls=empty_polls)
+        self.poll_interval, self.next_poll_at, self.empty_polls = poll_interval, next_poll_at, empty_polls
+        logger.info(f'Next update of {self.feed_url} in {poll_interval} seconds')
+        return next_poll_at
+
+    @classmethod
+    def postpone_polls(cls, feed_urls, countdown):
+        """
+        Mark feeds whose update is dispatched, or deferred, as in flight: their next poll is moved to when the
+        update should be done at the latest, 'FEED_UPDATE_LOCK_TIMEOUT' after it starts, so that the scheduler does
+        not dispatch them again meanwhile. The update schedules the real next poll once it is done, see
+        'schedule_next_poll()'
+        :param feed_urls: urls of the feeds
+        :param countdown: seconds until their update starts
+        """
+        next_poll_at = timezone.now() + timedelta(seconds=countdown + FEED_UPDATE_LOCK_TIMEOUT)
+        cls.objects.filter(feed_url__in=feed_urls).update(next_poll_at=next_poll_at)
+
+    def is_push_enabled(self):
+        """
+        Whether new entries of the feed are pushed by its WebSub hub: the hub verified a subscription which
+        has not expired yet
+        """
+        return self.websub_expires_at is not None and self.websub_expires_at > timezone.now()
+
+    def enable_push(self, lease_seconds):
+        """
+        Record the lease of the WebSub subscription verified by the hub. From now on the feed is polled every
+        'WEBSUB_POLL_INTERVAL' at most, see 'schedule_next_poll()'
+        :param lease_seconds: how long the hub pushes new entries of the feed
+        """
+        self.websub_expires_at = timezone.now() + timedelta(seconds=lease_seconds)
+        self.poll_interval = max(self.poll_interval or UPDATE_INTERVAL, WEBSUB_POLL_INTERVAL)
+        self.next_poll_at = self.get_poll_slot(self.poll_interval)
+        self.save(update_fields=['websub_expires_at', 'poll_interval', 'next_poll_at'])
+
+    def get_validators(self):
+        """
+        HTTP validators to send along with the next fetch of the feed. Only a feed which has been
+        successfully updated sends them, otherwise a '304 Not Modified' would skip creating its entries.
+        :return: keyword arguments 'etag' and 'modified' for 'feedparser.parse()'
+        """
+        if self.status != Feed.Status.UPDATED:
+            return {'etag': None, 'modified': None}
+        return {'etag': self.etag, 'modified': self.last_modified}
+
+    def record_failed_update(self):
+        """
+        Count one more failed update of the feed, and postpone its next periodic update until it is retried
+        :return: delay in seconds before retrying, with exponential backoff and jitter
+        """
+        failed_updates = self.failed_updates + 1
+        countdown = get_backoff(failed_updates)
+        next_poll_at = timezone.now() + timedelta(seconds=countdown)
+        self.get_queryset().update(failed_updates=failed_updates, next_poll_at=next_poll_at)
+        self.failed_updates, self.next_poll_at = failed_updates, next_poll_at
+        return countdown
+
+    def update_status(self, feed_status, published_parsed, validators=None, content_hash=None, metadata=None):
         """
         Updates the status of feed in the database. Use 'select_for_update' to lock the
         row until the transaction is committed, to avoid the problem of concurrency
         :param feed_status: status to be updated
         :param published_parsed: feed published time from 'feedparser.parse()' (d.published_parsed or d.updated_parsed)
+        :param validators: optional dict with 'etag' and 'modified' returned by the fetch, stored for the next one
+        :param content_hash: optional hash of the fetched body, stored to detect an unchanged body next time
+        :param metadata: optional fields of the feed to store, see 'get_metadata()'
         :return: current feed status
         """
         #  Operating on the self object will not work since it has already been fetched
@@ -171,6 +595,89 @@ class Feed(models.Model):
             new_feed.status = feed_status
             if published_parsed:
                 new_feed.published_time = published_parsed
+            if feed_status == Feed.Status.UPDATED:
+                new_feed.failed_updates = 0
+            if validators is not None:
+                new_feed.etag = validators.get('etag')
+                new_feed.last_modified = validators.get('modified')
+            if content_hash is not None:
+                new_feed.content_hash = content_hash
+            for field, value in (metadata or {}).items():
+                setattr(new_feed, field, value)
             new_feed.save()
 
         return old_status
+
+
+class ImportJobManager(models.Manager):
+    def with_progress(self):
+        """
+        Annotate jobs with the number of their feeds, of those still being validated, and of those which failed
+        """
+        return self.get_queryset().annotate(
+            num_feeds=models.Count('feeds'),
+            num_pending=models.Count('feeds', filter=models.Q(feeds__status=Feed.Status.CREATING)),
+            num_failed=models.Count('feeds', filter=models.Q(feeds__status=Feed.Status.ERROR)))
+
+
+class ImportJob(models.Model):
+    """
+    Import of the feeds of an OPML file by a user. All feeds are subscribed at once, the new ones are validated
+    by their first update at background: the import is done once none of them is 'creating' anymore.
+    """
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='import_jobs')
+    feeds = models.ManyToManyField('Feed', related_name='+')
+    num_new_feeds = models.PositiveIntegerField(default=0)  # feeds which were not in the database yet
+    num_skipped = models.PositiveIntegerField(default=0)  # outlines of the file without a valid feed url
+    created_time = models.DateTimeField(auto_now_add=True)
+    objects = ImportJobManager()
+
+    class Meta:
+        ordering = ('-id', )
+
+    def __str__(self):
+        return f'{self.user.username}:{self.created_time}'
+
+    @staticmethod
+    def get_feeds_by_url_key(url_keys):
+        """
+        Look up feeds by the keys of their urls, in batches of 'INGEST_BATCH_SIZE'
+        :return: dict of url key -> the first feed with that key
+        """
+        feeds = {}
+        for batch in chunked(url_keys, INGEST_BATCH_SIZE):
+            for feed in Feed.objects.filter(url_key__in=batch).order_by('-id'):
+                feeds[feed.url_key] = feed
+        return feeds
+
+    @classmethod
+    def create(cls, user, feed_urls, num_skipped=0):
+        """
+        Subscribe a user to feeds in bulk. Feeds already in the database are looked up in one query, the others
+        are created without being validated, like with 'Feed.get_or_create(validate=False)'. They are polled
+        periodically only after 'UPDATE_INTERVAL', their first update is expected to be scheduled by the caller.
+        :param user: user who imports the feeds
+        :param feed_urls: list of unique feed urls
+        :param num_skipped: number of outlines of the file which are not imported
+        :return: (ImportJob, list of urls of the new feeds)
+        """
+        # Variants of the url of a feed are imported once, see 'Feed.get_or_create()'
+        canonical_urls = {}
+        for feed_url in feed_urls:
+            canonical_urls.setdefault(get_url_key(feed_url), canonicalize_url(feed_url))
+        with transaction.atomic():
+            feeds = cls.get_feeds_by_url_key(list(canonical_urls))
+            new_feed_urls = [feed_url for url_key, feed_url in canonical_urls.items() if url_key not in feeds]
+            next_poll_at = timezone.now() + timedelta(seconds=UPDATE_INTERVAL)
+            Feed.objects.bulk_create(
+                [Feed(feed_url=feed_url, url_key=get_url_key(feed_url), status=Feed.Status.CREATING,
+                      next_poll_at=next_poll_at)
+                 for feed_url in new_feed_urls], batch_size=INGEST_BATCH_SIZE, ignore_conflicts=True)
+            feeds.update(cls.get_feeds_by_url_key([get_url_key(feed_url) for feed_url in new_feed_urls]))
+
+            # Existing subscriptions are kept, subscriber counts are updated by 'signals.py'
+            user.subscriptions.add(*feeds.values())
+            job = cls.objects.create(user=user, num_new_feeds=len(new_feed_urls), num_skipped=num_skipped)
+            job.feeds.add(*feeds.values())
+        logger.info(f'{user.username} imported {len(feeds)} feeds, {len(new_feed_urls)} new')
+        return job, new_feed_urls
@@ -0,0 +1,316 @@
+import logging
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin
+
+import feedparser
+from feedparser.datetimes import _parse_date
+from feedparser.sanitizer import _sanitize_html
+from requests.utils import parse_header_links
+from rest_framework.exceptions import ValidationError
+
+from rssfeed.settings import DAYS_RETRIEVABLE, MAX_FEED_ENTRIES, STREAM_PARSE_MIN_BYTES, FEED_PARSER
+from .utils import get_published_parsed
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024  # bytes fed to the incremental parser at a time
+ATOM = '{http://www.w3.org/2005/Atom}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+DCTERMS = '{http://purl.org/dc/terms/}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+ATOM_FEED_TAG = ATOM + 'feed'
+ENTRY_TAGS = {'item', ATOM + 'entry'}
+CONTAINER_TAGS = {'channel', ATOM_FEED_TAG}  # parents of the feed level elements, 'feed' is the root of Atom
+STREAM_ROOT_TAGS = {'rss', ATOM_FEED_TAG}  # roots of the feeds which are parsed incrementally
+
+# qualified element name -> key of 'feedparser.parse()' results. Core elements of RSS 2.0 have no namespace,
+# those of Atom the Atom one. Elements of other namespaces, e.g. 'itunes:title' or 'media:content', are ignored
+FEED_FIELDS = {
+    'title': 'title', 'link': 'link', 'description': 'description', 'language': 'language',
+    'pubDate': 'published_parsed', 'lastBuildDate': 'updated_parsed',
+    ATOM + 'title': 'title', ATOM + 'link': 'link', ATOM + 'subtitle': 'description',
+    ATOM + 'published': 'published_parsed', ATOM + 'updated': 'updated_parsed',
+    DC + 'language': 'language', DC + 'date': 'updated_parsed',
+}
+ENTRY_FIELDS = {
+    'guid': 'id', 'title': 'title', 'link': 'link', 'author': 'author', 'description': 'description',
+    'pubDate': 'published_parsed',
+    ATOM + 'id': 'id', ATOM + 'title': 'title', ATOM + 'link': 'link', ATOM + 'author': 'author',
+    ATOM + 'summary': 'description', ATOM + 'content': 'content', ATOM + 'published': 'published_parsed',
+    ATOM + 'updated': 'updated_parsed',
+    DC + 'creator': 'author', DC + 'date': 'updated_parsed', DCTERMS + 'issued': 'published_parsed',
+    DCTERMS + 'modified': 'updated_parsed', CONTENT + 'encoded': 'content',
+}
+
+
+def _get_value(elem, key):
+    """
+    Get the value of an element as 'feedparser.parse()' would store it under 'key'
+    :return: the value, or None if the element has none
+    """
+    if key.endswith('_parsed'):
+        return _parse_date((elem.text or '').strip())
+    if key == 'link':
+        # RSS has the link as text, Atom as 'href' of the alternate link
+        if elem.text and elem.text.strip():
+            return elem.text.strip()
+        if elem.get('rel', 'alternate') == 'alternate':
+            return elem.get('href')
+        return None
+    if elem.tag == ATOM + 'author':
+        # Atom author is a person construct
+        name_elem = elem.find(ATOM + 'name')
+        return (name_elem.text or '').strip() if name_elem is not None else None
+    text = ''.join(elem.itertext()).strip()
+    if key in ('description', 'content'):
+        return _sanitize_html(text, 'utf-8', 'text/html')
+    return text
+
+
+def _set_fields(target, elem, fields):
+    key = fields.get(elem.tag)
+    if key is None or target.get(key) is not None:
+        return
+    value = _get_value(elem, key)
+    if value is not None:
+        target[key] = value
+
+
+def _set_feed_fields(feed, elem):
+    if elem.tag == ATOM + 'link' and elem.get('href'):
+        # All links of the feed, e.g. its WebSub hub and its own url, as 'links' of 'feedparser.parse()'
+        feed.setdefault('links', []).append(
+            feedparser.FeedParserDict(rel=elem.get('rel', 'alternate'), href=elem.get('href')))
+    _set_fields(feed, elem, FEED_FIELDS)
+
+
+def _resolve_link(item, base_url):
+    """
+    Resolve a relative link against the feed url, as feedparser does
+    """
+    if base_url and item.get('link'):
+        item['link'] = urljoin(base_url, item['link'])
+
+
+def _parse_entry(elem):
+    entry = feedparser.FeedParserDict()
+    for child in elem:
+        _set_fields(entry, child, ENTRY_FIELDS)
+    # Only the description is stored: fall back to the full content, as feedparser does
+    content = entry.pop('content', None)
+    if entry.get('description') is None and content is not None:
+        entry['description'] = content
+    return entry
+
+
+def _iter_events(body):
+    """
+    Parse a document incrementally, feeding it to the parser chunk by chunk.
+    Yields ('container', element) when the parent of the feed level elements starts, ('feed', element) for each
+    element of the feed level and ('entry', parsed entry) for each entry.
+    Each entry is removed from the tree once it is parsed, so that memory stays bounded by one entry.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    view = memoryview(body)
+    stack = []
+    for offset in range(0, len(view), CHUNK_SIZE):
+        parser.feed(view[offset:offset + CHUNK_SIZE])
+        for event, elem in parser.read_events():
+            if event == 'start':
+                stack.append(elem)
+                if elem.tag in CONTAINER_TAGS:
+                    yield 'container', elem
+                continue
+            stack.pop()
+            if elem.tag in ENTRY_TAGS:
+                yield 'entry', _parse_entry(elem)
+                if stack:
+                    stack[-1].remove(elem)
+            elif stack and stack[-1].tag in CONTAINER_TAGS:
+                yield 'feed', elem
+    parser.close()
+
+
+def _iter_entries(first_entry, events, max_entries, since, base_url=None):
+    """
+    Yield parsed entries until 'max_entries' entries, or until an entry published before 'since':
+    entries are expected newest first, older ones could not be retrieved by users anyway.
+    """
+    num_entries = 0
+    entry = first_entry
+    try:
+        while entry is not None:
+            published_parsed = get_published_parsed(entry)
+            if since and published_parsed and published_parsed < since:
+                logger.info(f'Stop parsing at entry {entry.get("id")} published at {published_parsed}')
+                return
+            if num_entries >= max_entries:
+                logger.info(f'Stop parsing after {max_entries} entries')
+                return
+            _resolve_link(entry, base_url)
+            yield entry
+            num_entries += 1
+            entry = next((value for event, value in events if event == 'entry'), None)
+    except ET.ParseError as e:
+        raise ValidationError(f'rss parser failed after {num_entries} entries: {e}')
+
+
+class UnsupportedFeedError(ValueError):
+    """
+    The document is well-formed, but not a feed the fast parser handles
+    """
+
+
+def _get_root_tag(body):
+    """
+    Get the qualified name of the root element of a document, parsing only up to its start
+    :return: the name, or None if the document is not XML
+    """
+    parser = ET.XMLPullParser(events=('start',))
+    view = memoryview(body)
+    try:
+        for offset in range(0, len(view), CHUNK_SIZE):
+            parser.feed(view[offset:offset + CHUNK_SIZE])
+            for event, elem in parser.read_events():
+                return elem.tag
+    except ET.ParseError:
+        return None
+    return None
+
+
+def parse_stream(body, base_url=None, max_entries=MAX_FEED_ENTRIES, days_retrievable=DAYS_RETRIEVABLE):
+    """
+    Parse a feed incrementally, for feeds too large to hold all their parsed entries in memory.
+    The feed level elements are parsed up to the first entry; elements which follow entries are ignored.
+    Entries are parsed lazily, one at a time, while they are consumed.
+    :param body: raw body of the feed
+    :param base_url: url of the feed, relative links are resolved against it
+    :param max_entries: maximum number of entries to parse
+    :param days_retrievable: stop at the first entry older than this number of days
+    :return: FeedParserDict with the same keys as the result of 'feedparser.parse()', but 'entries' is a generator.
+    Parse errors of the feed level, and documents without a channel or Atom feed, set 'bozo'. Parse errors of
+    entries raise ValidationError while consuming them.
+    """
+    feed = feedparser.FeedParserDict()
+    events = _iter_events(body)
+    first_entry = None
+    has_container = False
+    try:
+        for event, value in events:
+            if event == 'container':
+                has_container = True
+            elif event == 'entry':
+                first_entry = value
+                break
+            else:
+                _set_feed_fields(feed, value)
+    except ET.ParseError as e:
+        return feedparser.FeedParserDict(feed=feed, entries=[], bozo=True, bozo_exception=e)
+    if not has_container:
+        return feedparser.FeedParserDict(
+            feed=feed, entries=[], bozo=True, bozo_exception=UnsupportedFeedError('no channel or feed'))
+
+    _resolve_link(feed, base_url)
+    since = datetime.now(timezone.utc) - timedelta(days=days_retrievable)
+    return feedparser.FeedParserDict(
+        feed=feed, entries=_iter_entries(first_entry, events, max_entries, since, base_url), bozo=False)
+
+
+def _parse_tree(body, base_url=None):
+    root = ET.fromstring(body)
+    if root.tag == 'rss':
+        container = root.find('channel')
+    elif root.tag == ATOM_FEED_TAG:
+        container = root
+    else:
+        raise UnsupportedFeedError(f'unsupported root element {root.tag}')
+    if container is None:
+        raise UnsupportedFeedError('no channel')
+    if any(elem.get('type') == 'xhtml' for elem in container.iter()):
+        # Inline xhtml content needs its markup kept, which feedparser does
+        raise UnsupportedFeedError('inline xhtml content')
+
+    feed, entries = feedparser.FeedParserDict(), []
+    for elem in container:
+        if elem.tag in ENTRY_TAGS:
+            entries.append(_parse_entry(elem))
+        else:
+            _set_feed_fields(feed, elem)
+    for item in [feed, *entries]:
+        _resolve_link(item, base_url)
+    return feedparser.FeedParserDict(feed=feed, entries=entries, bozo=False)
+
+
+def parse_feedparser(body, base_url=None, response_headers=None):
+    """
+    Parse any feed with 'feedparser', which also copes with malformed documents and every feed format
+    """
+    if response_headers:
+        # 'content-location' lets feedparser resolve relative links against the feed url
+        response_headers = {'content-location': base_url, **response_headers}
+    return feedparser.parse(body, response_headers=response_headers or None)
+
+
+def parse_fast(body, base_url=None, response_headers=None):
+    """
+    Parse well-formed RSS 2.0 and Atom documents with the C-accelerated ElementTree parser, which is several times
+    faster than 'feedparser'. Malformed and other documents fall back to 'feedparser'.
+    """
+    try:
+        return _parse_tree(body, base_url)
+    except (ET.ParseError, UnsupportedFeedError) as e:
+        logger.info(f'Parse {base_url} with feedparser: {e}')
+        return parse_feedparser(body, base_url, response_headers)
+
+
+def get_websub_hub(d, headers=None):
+    """
+    Find the WebSub hub a feed advertises, in the 'Link' header of its response or in its links
+    :param d: result of 'feedparser.parse()'
+    :param headers: lower case headers of the response
+    :return: (hub url, topic url) where the topic is the url the feed gives for itself, or (None, None)
+    """
+    links = [(link.get('rel'), link.get('href')) for link in d.get('feed', {}).get('links') or []]
+    links += [(link.get('rel'), link.get('url')) for link in parse_header_links((headers or {}).get('link', ''))]
+    hub_url = next((href for rel, href in links if rel == 'hub' and href), None)
+    topic_url = next((href for rel, href in links if rel == 'self' and href), None)
+    return (hub_url, topic_url) if hub_url and topic_url else (None, None)
+
+
+PARSERS = {
+    'fast': parse_fast,
+    'feedparser': parse_feedparser,
+}
+
+
+def parse(body, base_url=None, response_headers=None):
+    """
+    Parse a downloaded feed with the parser configured by 'FEED_PARSER'. RSS 2.0 and Atom feeds of at least
+    'STREAM_PARSE_MIN_BYTES' bytes are parsed incrementally, see 'parse_stream()'; other large documents, e.g. RSS 1.0
+    feeds or web pages, are parsed by the configured parser too.
+    :param body: raw body of the feed
+    :param base_url: url of the feed, relative links are resolved against it
+    :param response_headers: lower case headers of the response, used to detect the encoding
+    :return: FeedParserDict with the keys of 'feedparser.parse()' results which are stored: 'feed', 'entries', 'bozo'
+    """
+    if len(body) >= STREAM_PARSE_MIN_BYTES and _get_root_tag(body) in STREAM_ROOT_TAGS:
+        return parse_stream(body, base_url)
+    return PARSERS[FEED_PARSER](body, base_url, response_headers)
+
+
+def parse_opml(body):
+    """
+    Get the feed urls of an OPML document, as exported by feed readers. Outlines may be nested in folders.
+    :param body: raw body of the document
+    :return: list of unique feed urls, in the order of the document
+    :raise ValidationError: the document is not OPML
+    """
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError as e:
+        raise ValidationError(f'OPML parser failed: {e}')
+    if root.tag != 'opml':
+        raise ValidationError(f'Not an OPML document: root element {root.tag}')
+    feed_urls = (outline.get('xmlUrl', '').strip() for outline in root.iter('outline'))
+    return list(dict.fromkeys(feed_url for feed_url in feed_urls if feed_url))
@@ -0,0 +1,142 @@
+import contextlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import feedparser
+
+from rssfeed.settings import PARSE_PROCESSES, PIPELINE_QUEUE_SIZE
+from . import fetcher
+from .utils import normalize_entry
+
+logger = logging.getLogger(__name__)
+
+FEED_KEYS = ('title', 'link', 'description', 'language', 'published_parsed', 'updated_parsed', 'links')
+RESULT_KEYS = ('status', 'href', 'etag', 'modified', 'content_hash', 'hub', 'topic', 'bozo')
+WAIT_TIMEOUT = 0.1  # seconds to wait for a parsed feed before taking more downloaded ones
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def can_start_processes():
+    """
+    Whether this process may start child processes: daemonic processes, e.g. the children of the prefork pool of
+    celery workers, may not. 'PIPELINE' makes workers use the threads pool instead, see 'CELERY_WORKER_POOL'
+    """
+    return not multiprocessing.current_process().daemon
+
+
+def get_parse_pool():
+    """
+    Process pool of a worker process which parses downloaded feeds, 'PARSE_PROCESSES' processes large.
+    Created once per worker process and reused by all batches. Its processes are started by a fork server,
+    so they do not inherit the threads and connections of the worker. In a daemonic process, which cannot start
+    processes, feeds are parsed by threads instead: the pipeline still works, without parsing in parallel.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if can_start_processes():
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                _pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                            mp_context=multiprocessing.get_context(start_method))
+            else:
+                logger.warning('A daemonic process cannot start the parse processes, feeds are parsed by threads. '
+                               'Run workers with the threads pool to parse feeds in parallel')
+                _pool = ThreadPoolExecutor(max_workers=PARSE_PROCESSES, thread_name_prefix='parse')
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def parse_result(result):
+    """
+    Parse a downloaded feed in a process of the pool.
+    :return: FeedParserDict with only the keys which are stored, so that it is cheap to send back. Entries are
+    normalized, see 'normalize_entry()'. An error while parsing is returned as 'bozo_exception'
+    """
+    d = feedparser.FeedParserDict(entries=[])
+    try:
+        parsed = result.parse()
+        d['feed'] = feedparser.FeedParserDict({key: parsed.feed.get(key) for key in FEED_KEYS})
+        d['entries'] = [normalize_entry(entry) for entry in parsed.entries]
+        d.update({key: parsed.get(key) for key in RESULT_KEYS})
+        if parsed.get('bozo'):
+            d['bozo_exception'] = str(parsed.get('bozo_exception'))
+    except Exception as e:
+        d.update(feed=feedparser.FeedParserDict(), bozo=True, bozo_exception=str(e))
+    return d
+
+
+def fetch_and_parse(feeds, needs_parse=None, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Download a batch of feeds and parse them in a pipeline: downloads run concurrently in threads, see
+    'fetcher.fetch_feeds()', while downloaded feeds are parsed by the process pool, see 'get_parse_pool()'.
+    At most 'queue_size' downloaded feeds wait to be parsed, and at most 'queue_size' parsed feeds wait to be
+    consumed: downloads pause while the parsers are behind, parsers pause while the consumer is behind.
+    :param feeds: list of (feed_url, validators) tuples, see 'fetcher.fetch_feeds()'
+    :param needs_parse: optional callable telling whether a downloaded FetchResult must be parsed
+    :param queue_size: maximum number of feeds waiting between two stages
+    :return: generator of (FetchResult, parsed feed) tuples as soon as they are ready, in any order. The parsed feed
+    is None if the download failed, the feed is not modified, or 'needs_parse' returns False for it
+    """
+    pool = get_parse_pool()
+    downloaded = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(result):
+        while not stopped.is_set():
+            try:
+                downloaded.put(result, timeout=WAIT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+        # Abort the remaining downloads once nobody consumes them anymore
+        raise _Stopped()
+
+    def download():
+        try:
+            fetcher.fetch_feeds(feeds, on_result=put)
+        except _Stopped:
+            return
+        except Exception as e:
+            logger.error(f'Download of a batch failed with exception: {e}')
+        with contextlib.suppress(_Stopped):
+            put(_END)
+
+    threading.Thread(target=download, name='fetch_and_parse', daemon=True).start()
+
+    parsing = {}  # future -> FetchResult
+    downloading = True
+    try:
+        while downloading or parsing:
+            # Hand downloaded feeds over to the parsers, as long as they are not behind
+            while downloading and len(parsing) < queue_size:
+                try:
+                    result = downloaded.get(timeout=WAIT_TIMEOUT if parsing else None)
+                except queue.Empty:
+                    break
+                if result is _END:
+                    downloading = False
+                elif result.error or result.not_modified or (needs_parse and not needs_parse(result)):
+                    yield result, None
+                else:
+                    parsing[pool.submit(parse_result, result)] = result
+
+            if parsing:
+                done, _ = wait(parsing, timeout=WAIT_TIMEOUT, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield parsing.pop(future), future.result()
+    finally:
+        stopped.set()
+        for future in parsing:
+            future.cancel()
@@ -1,6 +1,10 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import URLValidator
 from rest_framework import serializers
 
-from .models import Entry, Feed, FeedSubscription
+from rssfeed.settings import IMPORT_MAX_FEEDS, MAX_FEED_BYTES
+from .models import Entry, Feed, FeedSubscription, ImportJob
+from .parsers import parse_opml
 
 
 class EntryListSerializer(serializers.ModelSerializer):
@@ -39,12 +43,15 @@ class EntryFilterSerializer(serializers.Serializer):
 
 class FeedListSerializer(serializers.HyperlinkedModelSerializer):
     subscription_id = serializers.IntegerField(source='id', read_only=True)
-    feed_url = serializers.CharField(source='feed.feed_url')
+    # Validated before anything is stored, also when the feed itself is validated at background
+    feed_url = serializers.URLField(source='feed.feed_url', max_length=Feed._meta.get_field('feed_url').max_length,
+                                    validators=[URLValidator(schemes=['http', 'https'])])
+    status = serializers.CharField(source='feed.status', read_only=True)
 
     class Meta:
         model = FeedSubscription
-        fields = ('feed', 'feed_url', 'subscribed_time', 'subscription_id', )
-        read_only_fields = ('feed', 'subscribed_time', 'subscription_id',)
+        fields = ('feed', 'feed_url', 'status', 'subscribed_time', 'subscription_id', )
+        read_only_fields = ('feed', 'status', 'subscribed_time', 'subscription_id',)
 
         extra_kwargs = {
             'feed': {'view_name': 'rssfeedapi:feed_detail'},
@@ -62,3 +69,48 @@ class FeedDetailSerializer(serializers.HyperlinkedModelSerializer):
         extra_kwargs = {
             'entries': {'view_name': 'rssfeedapi:entry_detail'}
         }
+
+
+class FeedImportSerializer(serializers.Serializer):
+    file = serializers.FileField(write_only=True, help_text='OPML file exported by a feed reader')
+
+    def validate_file(self, value):
+        """
+        :return: (list of unique valid feed urls of the file, number of skipped outlines with an invalid url)
+        """
+        if value.size > MAX_FEED_BYTES:
+            raise serializers.ValidationError(f'OPML file is larger than {MAX_FEED_BYTES} bytes')
+        feed_urls, num_skipped = [], 0
+        max_length = Feed._meta.get_field('feed_url').max_length
+        for feed_url in parse_opml(value.read()):
+            try:
+                URLValidator()(feed_url)
+            except DjangoValidationError:
+                num_skipped += 1
+                continue
+            if len(feed_url) > max_length:
+                num_skipped += 1
+                continue
+            feed_urls.append(feed_url)
+        if not feed_urls:
+            raise serializers.ValidationError('No feed found in the OPML file')
+        if len(feed_urls) > IMPORT_MAX_FEEDS:
+            raise serializers.ValidationError(f'More than {IMPORT_MAX_FEEDS} feeds in the OPML file')
+        return feed_urls, num_skipped
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    num_feeds = serializers.IntegerField(read_only=True)
+    num_pending = serializers.IntegerField(read_only=True)
+    num_failed = serializers.IntegerField(read_only=True)
+    status = serializers.SerializerMethodField('_get_status', read_only=True)
+
+    def _get_status(self, job_obj) -> str:
+        return 'validating' if job_obj.num_pending else 'done'
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'created_time', 'status', 'num_feeds', 'num_new_feeds', 'num_pending', 'num_failed',
+                  'num_skipped',)
+        read_only_fields = ('id', 'created_time', 'status', 'num_feeds', 'num_new_feeds', 'num_pending',
+                            'num_failed', 'num_skipped',)
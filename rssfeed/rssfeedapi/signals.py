@@ -0,0 +1,30 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import Feed, FeedSubscription
+
+
+@receiver(post_save, sender=FeedSubscription)
+def subscription_created(sender, instance, created, **kwargs):
+    if created:
+        Feed.update_subscriber_count([instance.feed_id])
+
+
+@receiver(post_delete, sender=FeedSubscription)
+def subscription_deleted(sender, instance, **kwargs):
+    Feed.update_subscriber_count([instance.feed_id])
+
+
+@receiver(m2m_changed, sender=Feed.subscribers.through)
+def subscribers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    'user.subscriptions.add()' and 'feed.subscribers.add()' create subscriptions in bulk without 'post_save'.
+    'reverse' is True if the subscriptions of a user changed, then 'pk_set' holds feed ids.
+    """
+    if action == 'pre_clear' and reverse:
+        # Remember the feeds of the user before they are cleared
+        instance._cleared_feed_ids = list(instance.subscriptions.values_list('id', flat=True))
+    elif action == 'post_clear':
+        Feed.update_subscriber_count(getattr(instance, '_cleared_feed_ids', []) if reverse else [instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        Feed.update_subscriber_count(pk_set if reverse else [instance.pk])
@@ -1,6 +1,6 @@
 from drf_yasg import openapi
 
-from .serializers import FeedListSerializer, EntryDetailSerializer
+from .serializers import FeedListSerializer, EntryDetailSerializer, ImportJobSerializer
 
 feed_param = openapi.Parameter('feed_id', openapi.IN_QUERY,
                                description="filter entries by feed id", type=openapi.TYPE_INTEGER)
@@ -8,6 +8,10 @@ read_param = openapi.Parameter('read', openapi.IN_QUERY,
                                description="filter read/unread entries", type=openapi.TYPE_BOOLEAN)
 feed_subscribed_200 = openapi.Response('Feed was already subscribed', FeedListSerializer)
 feed_subscribed_201 = openapi.Response('Feed is subscribed successfully', FeedListSerializer)
+feed_subscribed_202 = openapi.Response('Feed is subscribed, and will be validated at background', FeedListSerializer)
 
 entry_read_201 = openapi.Response('Entry is marked as read', EntryDetailSerializer)
 entry_read_200 = openapi.Response('Entry was already marked as read', EntryDetailSerializer)
+
+feed_import_202 = openapi.Response('Feeds are subscribed, new feeds will be validated at background',
+                                   ImportJobSerializer)
@@ -1,19 +1,29 @@
-import itertools
+import base64
+import hashlib
 import logging
-from time import sleep
+from collections import defaultdict
 
-import feedparser
+import requests
 from celery import group
-from django.db.models import Count
-from rest_framework.exceptions import APIException, ValidationError
-from rssfeed.settings import MAXIMUM_RETRY, UPDATE_INTERVAL
-from .models import Feed
+from django.core.cache import cache
+from django.db import transaction, OperationalError
+from django.utils import timezone
+from rest_framework.exceptions import APIException, ValidationError, Throttled
+from rest_framework.status import HTTP_304_NOT_MODIFIED
+from rssfeed.settings import MAXIMUM_RETRY, SCHEDULER_INTERVAL, SCHEDULER_CHUNK_SIZE, FETCH_BATCH_SIZE, \
+    HOST_DELAY, FEED_UPDATE_LOCK_TIMEOUT, PIPELINE, SINGLE_WRITER_INGEST, \
+    IMPORT_BATCH_INTERVAL, RETENTION_INTERVAL, RETENTION_CHUNK_SIZE, RETENTION_ARCHIVE
+from .models import Feed, Entry, ArchivedEntry
 from celery.exceptions import MaxRetriesExceededError
 from rssfeed.celery import app
-from .utils import get_published_parsed
+from . import fetcher, parsers, pipeline, websub
+from .utils import get_published_parsed, chunked, get_host, normalize_entry, get_backoff
 
 logger = logging.getLogger(__name__)
 
+INGEST_QUEUE = 'ingest'  # consumed by a single worker process, see 'ingest_feeds'
+PRUNE_LOCK_KEY = 'prune_expired_entries'
+
 
 def send_email(email, msg):
     """
@@ -26,6 +36,176 @@ def send_admin_email(msg):
     send_email(email='admin@api.com', msg=msg)
 
 
+def get_ingest_payload(feed_url, d):
+    """
+    Normalize a parsed feed into what is stored by 'ingest_feed()'. Does not touch the database.
+    :param feed_url: url of the feed
+    :param d: result of 'feedparser.parse()'
+    :return: dict which can be sent as json to a task once its entries are listed, see 'publish_ingest()'
+    :raise ValidationError: the feed cannot be parsed
+    """
+    if d.get('status') == HTTP_304_NOT_MODIFIED:
+        # Conditional GET: the feed has not changed since the last fetch, nothing to parse
+        return {'feed_url': feed_url, 'modified': False, 'validators': None}
+    if d.get('bozo'):
+        raise ValidationError(f'rss feedparser failed: {d.get("bozo_exception")}')
+    published_parsed = d.feed.get('published_parsed', None) or d.feed.get('updated_parsed', None)
+    return {
+        'feed_url': feed_url, 'modified': True, 'metadata': Feed.get_metadata(d.feed),
+        'published_parsed': tuple(published_parsed) if published_parsed else None,
+        # Entries are normalized while they are consumed, so that a feed parsed incrementally stays incremental
+        'entries': (normalize_entry(entry) for entry in d.entries),
+        'validators': {'etag': d.get('etag'), 'modified': d.get('modified')}, 'content_hash': d.get('content_hash'),
+        'hub_url': d.get('hub'), 'topic_url': d.get('topic'),
+    }
+
+
+def follow_redirect(feed, result):
+    """
+    Get the feed a download is stored in. If the feed permanently moved, its new url is recorded, and it is
+    merged into the feed which already has that url, if any, see 'Feed.move_to()'
+    :param feed: Feed which is downloaded
+    :param result: FetchResult of downloading the feed
+    """
+    if result.redirect_url:
+        return feed.move_to(result.redirect_url)
+    return feed
+
+
+def is_unchanged(feed, result):
+    """
+    Whether a downloaded feed has the same body as the one of the previous successful update
+    """
+    return not result.not_modified and feed.status == Feed.Status.UPDATED and result.content_hash == feed.content_hash
+
+
+def get_result_payload(feed, result):
+    """
+    Parse a downloaded feed into what is stored by 'ingest_feed()'. If the body is the same as the one of the
+    previous successful update, the feed is not modified: parsing and updating entries are skipped.
+    :param feed: Feed which is downloaded
+    :param result: FetchResult of downloading the feed
+    """
+    if is_unchanged(feed, result):
+        logger.info(f"Feed {feed.feed_url} is unchanged")
+        return {'feed_url': feed.feed_url, 'modified': False,
+                'validators': {'etag': result.headers.get('etag'), 'modified': result.headers.get('last-modified')}}
+    return get_ingest_payload(feed.feed_url, result.parse())
+
+
+def ingest_feed(feed, payload):
+    """
+    Update a feed and its entries in the database
+    :param feed: Feed to update
+    :param payload: parsed feed, see 'get_ingest_payload()'
+    """
+    if not payload['modified']:
+        feed.update_status(feed_status=Feed.Status.UPDATED, published_parsed=None, validators=payload['validators'])
+        feed.schedule_next_poll(has_new_entries=False)
+        logger.info(f"Feed {feed.feed_url} is not modified")
+        return
+
+    started = timezone.now()
+    published_parsed = get_published_parsed(payload)
+    failed_entries_list = feed.update_entries(parsed_entries_list=payload['entries'], published_parsed=published_parsed)
+    if len(failed_entries_list):
+        # retry failed entries later in a separate task, instead of holding the worker
+        update_failed_entries.apply_async(
+            args=(feed.feed_url, [normalize_entry(entry) for entry in failed_entries_list], 1),
+            countdown=get_backoff(1), queue=INGEST_QUEUE if SINGLE_WRITER_INGEST else None)
+
+    # Continue update the feed in the future, regardless of the results of updating entries
+    feed.update_status(
+        feed_status=Feed.Status.UPDATED, published_parsed=published_parsed,
+        validators=payload['validators'], content_hash=payload['content_hash'],
+        # A feed subscribed without being validated gets its fields from its first update
+        metadata=payload['metadata'] if feed.status == Feed.Status.CREATING else None)
+    feed.schedule_next_poll(has_new_entries=feed.entries.filter(created_time__gte=started).exists())
+    logger.info(f"Feed {feed.feed_url} is updated")
+    if websub.needs_subscription(feed, payload.get('hub_url')):
+        schedule_websub_subscription(feed, payload['hub_url'], payload['topic_url'])
+
+
+def serialize_payload(payload):
+    """
+    Make a parsed feed fit to be sent as json to a task: list its entries, which parses them if not done yet
+    :raise ValidationError: an entry cannot be parsed
+    """
+    if 'entries' not in payload:
+        return payload
+    return {**payload, 'entries': list(payload['entries'])}
+
+
+def store_payload(feed, payload):
+    """
+    Store a parsed feed by this worker. With 'SINGLE_WRITER_INGEST', send it to the single writer instead,
+    see 'ingest_feeds'.
+    :param feed: Feed to update
+    :param payload: parsed feed, see 'get_ingest_payload()'
+    """
+    if SINGLE_WRITER_INGEST:
+        ingest_feeds.apply_async(args=([serialize_payload(payload)],), queue=INGEST_QUEUE)
+    else:
+        ingest_feed(feed, payload)
+
+
+def get_update_lock_key(feed_url):
+    return f'update_feed:{hashlib.md5(feed_url.encode()).hexdigest()}'
+
+
+def acquire_update_lock(feed_url):
+    """
+    Lock a feed while its update is queued or running, so that concurrent requests to update the same feed
+    are merged into one. The lock expires after 'FEED_UPDATE_LOCK_TIMEOUT' in case a worker dies.
+    :return: True if the lock is acquired, False if the feed is already being updated
+    """
+    return cache.add(get_update_lock_key(feed_url), True, timeout=FEED_UPDATE_LOCK_TIMEOUT)
+
+
+def release_update_lock(feed_url):
+    cache.delete(get_update_lock_key(feed_url))
+
+
+def schedule_feed_update(feed_url, queue='force_feed_update'):
+    """
+    Update a feed at background, unless an update of the same feed is already queued or running
+    :return: True if a new update is scheduled, False if it is merged into the running one
+    """
+    if not acquire_update_lock(feed_url):
+        logger.info(f'Feed {feed_url} is already being updated')
+        return False
+    update_feed.apply_async(args=(feed_url,), queue=queue)
+    return True
+
+
+@app.task
+def update_failed_entries(feed_url, parsed_entries_list, attempt):
+    """
+    Background task to retry creating the entries which failed during an update of a feed. Retry again with
+    exponential backoff until 'MAXIMUM_RETRY' attempts, then notify admin.
+    :param parsed_entries_list: failed entries, normalized by 'normalize_entry()'
+    :param attempt: number of this attempt
+    """
+    feed = Feed.objects.get(feed_url=feed_url)
+    failed_entries_list = feed.update_entries(parsed_entries_list=parsed_entries_list, published_parsed=None)
+    if len(failed_entries_list) == 0:
+        return
+
+    if attempt < MAXIMUM_RETRY:
+        update_failed_entries.apply_async(
+            args=(feed_url, [normalize_entry(entry) for entry in failed_entries_list], attempt + 1),
+            countdown=get_backoff(attempt + 1), queue=INGEST_QUEUE if SINGLE_WRITER_INGEST else None)
+        return
+
+    failed_entries_guid = ''
+    for entry_guid in failed_entries_list:
+        failed_entries_guid += f'{entry_guid.get("id", "")},'
+    err_msg = f"Failed to update entries {failed_entries_guid}"
+    logger.error(err_msg)
+    # Notify admin.
+    send_admin_email(msg=err_msg)
+
+
 @app.task(retry_jitter=False, max_retries=MAXIMUM_RETRY,)
 def update_feed(feed_url):
     """
@@ -33,41 +213,35 @@ def update_feed(feed_url):
     After reaching maximum retries, mark the feed status as 'Error' and send emails to all its subscribers.
     Do not send email again if the feed was already in Error state. This is to prevent Emails sent to other
      feed subscribers if one user manually updates an error feed which fails again.
+    The update lock of the feed is kept while the update is deferred or retried, and released once it is done.
     """
+    deferred = False
+    feed = None
     try:
-        d = feedparser.parse(feed_url)
-        if d.get('bozo'):
-            raise ValidationError(f'rss feedparser failed: {d.get("bozo_exception")}')
-        published_parsed = get_published_parsed(d.feed)
-
         feed = Feed.objects.get(feed_url=feed_url)
-
-        for i in itertools.count():
-            # retry failed entries if any
-            failed_entries_list = feed.update_entries(
-                parsed_entries_list=d.entries, published_parsed=published_parsed)
-            if len(failed_entries_list) == 0 or i == MAXIMUM_RETRY:
-                break
-            sleep(2)
-
-        if len(failed_entries_list):
-            failed_entries_guid = ''
-            for entry_guid in failed_entries_list:
-                failed_entries_guid += f'{entry_guid.get("id", "")},'
-            err_msg = f"Failed to update entries {failed_entries_guid}"
-            logger.error(err_msg)
-            # Notify admin.
-            send_admin_email(msg=err_msg)
-
-        # Continue update the feed in the future, regardless of the results of updating entries
-        feed.update_status(
-            feed_status=Feed.Status.UPDATED, published_parsed=published_parsed)
-        logger.info(f"Feed {feed_url} is updated")
+        # A feed which was just subscribed to is downloaded already
+        result = fetcher.pop_cached_result(feed_url) or fetcher.fetch_feed(feed_url, **feed.get_validators())
+        feed = follow_redirect(feed, result)
+        store_payload(feed, get_result_payload(feed, result))
+    except Throttled as e:
+        # The host asks to slow down. Not a failure of the feed: defer the update without using up retries
+        logger.info(f'Update {feed_url} is deferred for {e.wait} seconds: {e.detail}')
+        deferred = True
+        Feed.postpone_polls([feed_url], e.wait)
+        delivery_info = update_feed.request.delivery_info or {}
+        update_feed.apply_async(args=(feed_url,), countdown=e.wait, queue=delivery_info.get('routing_key'))
     except (ValidationError, APIException) as e:
+        if feed is not None:
+            # The feed may have moved to another url, see 'follow_redirect()'. The lock of the old url is left
+            # to expire: no feed has that url anymore
+            feed_url = feed.feed_url
         try:
             logger.warning(f'Parse {feed_url} failed with exception: {e}')
-            raise update_feed.retry(countdown=2)
+            feed = Feed.objects.get(feed_url=feed_url)
+            deferred = True
+            raise update_feed.retry(args=(feed_url,), countdown=feed.record_failed_update())
         except MaxRetriesExceededError:
+            deferred = False
             logger.error(f"Maximum retries reached. Stop updating {feed_url}")
             feed = Feed.objects.get(feed_url=feed_url)
             old_status = feed.update_status(
@@ -75,28 +249,307 @@ def update_feed(feed_url):
 
             if old_status != Feed.Status.ERROR:
                 # Notify admin
-                err_msg = f"failed to update {feed.title}"
+                err_msg = f"failed to update {feed.title or feed.feed_url}"
                 send_admin_email(msg=err_msg)
 
                 # Also notify subscribers??
                 email_list = feed.subscribers.values_list('email', flat=True)
                 for email_addr in email_list:
                     send_email(email=email_addr, msg=err_msg)
+    finally:
+        if not deferred:
+            release_update_lock(feed_url)
+
+
+@app.task
+def update_feeds_batch(feed_urls):
+    """
+    Background task to update a batch of feeds. All feeds are downloaded concurrently, then parsed and stored
+    one by one. With 'PIPELINE', feeds are parsed by a process pool while others are still being downloaded,
+    and stored as soon as they are parsed, see 'pipeline.fetch_and_parse()'. With 'SINGLE_WRITER_INGEST', all
+    parsed feeds of the batch are sent together to the single writer, see 'ingest_feeds'.
+    A feed which fails is handed over to 'update_feed', which retries it on its own. An unexpected error, e.g. the
+    database is locked, only fails its own feed, which is updated again when its next poll is due. Feeds of a host
+    which asks to slow down are deferred together as a new batch, and the scheduler postpones them until that batch
+    runs. Feeds which are already being updated, e.g. forced by a user, are skipped. The update lock of each feed is
+    released once it is done, whatever the outcome.
+    """
+    feed_urls = [feed_url for feed_url in feed_urls if acquire_update_lock(feed_url)]
+    feeds = Feed.objects.in_bulk(feed_urls, field_name='feed_url')
+    for feed_url in set(feed_urls) - set(feeds):
+        # Deleted, or merged into another feed, since the batch was dispatched
+        release_update_lock(feed_url)
+    feeds_to_fetch = [(feed_url, feeds[feed_url].get_validators()) for feed_url in feed_urls if feed_url in feeds]
+    deferred_feed_urls, wait, payloads = [], 0, []
+    pending_feed_urls = set(feeds)
+    try:
+        if PIPELINE:
+            results = pipeline.fetch_and_parse(
+                feeds_to_fetch, needs_parse=lambda result: not is_unchanged(feeds[result.url], result))
+        else:
+            results = ((result, None) for result in fetcher.fetch_feeds(feeds_to_fetch))
+        for result, d in results:
+            pending_feed_urls.discard(result.url)
+            feed = feeds[result.url]
+            handed_over = False
+            try:
+                if result.error:
+                    raise result.error
+                feed = follow_redirect(feed, result)
+                payload = get_result_payload(feed, result) if d is None else get_ingest_payload(feed.feed_url, d)
+                if SINGLE_WRITER_INGEST:
+                    payloads.append(serialize_payload(payload))
+                else:
+                    ingest_feed(feed, payload)
+            except Throttled as e:
+                deferred_feed_urls.append(feed.feed_url)
+                wait = max(wait, e.wait)
+            except (ValidationError, APIException) as e:
+                logger.warning(f'Update {feed.feed_url} in batch failed with exception: {e}')
+                # The lock is handed over to 'update_feed'
+                handed_over = True
+                update_feed.delay(feed.feed_url)
+            except Exception as e:
+                # e.g. the database is locked: the other feeds of the batch are still stored, and the scheduler
+                # updates this one again once its poll is due
+                logger.error(f'Update {feed.feed_url} in batch failed with unexpected exception: {e}')
+            finally:
+                if not handed_over:
+                    release_update_lock(result.url)
+    finally:
+        # The batch was aborted, e.g. the downloads failed as a whole: do not keep the other feeds locked
+        for feed_url in pending_feed_urls:
+            release_update_lock(feed_url)
+
+    if payloads:
+        ingest_feeds.apply_async(args=(payloads,), queue=INGEST_QUEUE)
+    if deferred_feed_urls:
+        logger.info(f'{len(deferred_feed_urls)} feeds are deferred for {wait} seconds')
+        # The scheduler must not update them before the host is ready either
+        Feed.postpone_polls(deferred_feed_urls, wait)
+        update_feeds_batch.apply_async(args=(deferred_feed_urls,), countdown=wait)
+
+
+@app.task(max_retries=MAXIMUM_RETRY)
+def ingest_feeds(payloads):
+    """
+    Background task to store parsed feeds and their entries. With 'SINGLE_WRITER_INGEST', workers which download
+    and parse feeds send them to the 'ingest' queue instead of writing the database themselves. A single worker
+    process consumes this queue, so that writes do not wait for the database lock held by other processes, and
+    all feeds of a task are stored in one transaction. If the transaction fails, e.g. the database is locked,
+    the whole task is retried with backoff.
+    :param payloads: list of parsed feeds, see 'get_ingest_payload()' and 'serialize_payload()'
+    """
+    feeds = Feed.objects.in_bulk([payload['feed_url'] for payload in payloads], field_name='feed_url')
+    try:
+        with transaction.atomic():
+            for payload in payloads:
+                feed = feeds.get(payload['feed_url'])
+                if feed is None:  # deleted meanwhile
+                    continue
+                try:
+                    with transaction.atomic():
+                        ingest_feed(feed, payload)
+                except (ValidationError, APIException) as e:
+                    logger.error(f'Ingest {feed.feed_url} failed with exception: {e}')
+    except OperationalError as e:
+        logger.warning(f'Ingest {len(payloads)} feeds failed with exception: {e}')
+        raise ingest_feeds.retry(countdown=get_backoff(ingest_feeds.request.retries + 1))
+
+
+def batch_feeds_by_host(feed_urls, batch_size):
+    """
+    Split feeds into batches, keeping feeds of the same host together so that the per-host limits of
+    'fetcher.fetch_feeds()' apply to all of them. A host with more than 'batch_size' feeds is split into several
+    batches, each one delayed by the time the previous ones need: requests to a host start 'HOST_DELAY' apart,
+    whatever 'HOST_CONCURRENCY' is. Delayed batches come last, so that they are never dispatched before the
+    first batch of their host.
+    :param feed_urls: iterable of feed urls
+    :param batch_size: maximum number of feeds per batch
+    :return: generator of (list of feed urls, countdown in seconds)
+    """
+    feeds_by_host = defaultdict(list)
+    for feed_url in feed_urls:
+        feeds_by_host[get_host(feed_url)].append(feed_url)
+
+    batch = []
+    delayed_batches = []
+    for host_feed_urls in feeds_by_host.values():
+        for i, host_batch in enumerate(chunked(host_feed_urls, batch_size)):
+            if i > 0:
+                delayed_batches.append((host_batch, i * batch_size * HOST_DELAY))
+                continue
+            if len(batch) + len(host_batch) > batch_size:
+                yield batch, 0
+                batch = []
+            batch.extend(host_batch)
+    if batch:
+        yield batch, 0
+    yield from delayed_batches
+
+
+def get_due_feeds():
+    """
+    Active feeds which has at least one subscriber and are due to update, read from the '(next_poll_at, id)' index:
+    the most overdue feeds first
+    """
+    return Feed.objects.filter(
+        subscriber_count__gt=0, next_poll_at__lte=timezone.now()).exclude(
+        status=Feed.Status.ERROR).order_by('next_poll_at', 'id')
+
+
+def iter_due_feed_urls(due_feeds, chunk_size):
+    """
+    Read due feeds in chunks of at most 'chunk_size' feeds, so that neither the query nor the result grows with
+    the total number of feeds. Each chunk continues after the '(next_poll_at, id)' of the last one, so that it is
+    a range of the index
+    :param due_feeds: queryset of 'get_due_feeds()'
+    :return: generator of lists of feed urls
+    """
+    chunk = list(due_feeds.values_list('next_poll_at', 'id', 'feed_url')[:chunk_size])
+    while chunk:
+        yield [feed_url for _, _, feed_url in chunk]
+        last_poll_at, last_id = chunk[-1][:2]
+        chunk = list(due_feeds.filter(next_poll_at__gte=last_poll_at).exclude(
+            next_poll_at=last_poll_at, id__lte=last_id).values_list('next_poll_at', 'id', 'feed_url')[:chunk_size])
 
 
 @app.task
 def update_active_feeds():
     """
-    Collect all active feeds which has at least one subscriber and update them periodically at background
+    Collect all active feeds which has at least one subscriber and are due to update, and update them
+    periodically at background, in batches of at most 'FETCH_BATCH_SIZE' feeds grouped by host.
+    Due feeds are dispatched chunk by chunk, 'SCHEDULER_CHUNK_SIZE' feeds at a time. The batches are staggered
+    evenly until the next run of this task, so that workers get a steady load instead of a burst. Dispatched
+    feeds are postponed until their update is done, so that later runs do not dispatch them again.
+    """
+    due_feeds = get_due_feeds()
+    num_due_feeds = due_feeds.count()
+    num_dispatched = 0
+    for feed_urls in iter_due_feed_urls(due_feeds, SCHEDULER_CHUNK_SIZE):
+        signatures = []
+        for batch_feed_urls, countdown in batch_feeds_by_host(feed_urls, FETCH_BATCH_SIZE):
+            countdown += SCHEDULER_INTERVAL * num_dispatched / num_due_feeds
+            Feed.postpone_polls(batch_feed_urls, countdown)
+            signatures.append(update_feeds_batch.s(batch_feed_urls,).set(countdown=countdown))
+            num_dispatched += len(batch_feed_urls)
+        group(signatures)()
+
+
+def schedule_new_feeds(feed_urls):
+    """
+    Validate feeds which were created without being downloaded, e.g. imported from OPML, by updating them at
+    background in batches of at most 'FETCH_BATCH_SIZE' feeds grouped by host. Batches are throttled: one starts
+    every 'IMPORT_BATCH_INTERVAL' seconds, so that a large import leaves room to other updates.
+    :param feed_urls: urls of the new feeds
     """
-    active_feeds = Feed.objects.annotate(
-        num_subscribers=Count('subscribers')).filter(
-        num_subscribers__gt=0).exclude(status=Feed.Status.ERROR)
-    g = group(update_feed.s(feed.feed_url,) for feed in active_feeds)
-    res = g()
+    signatures = [
+        update_feeds_batch.s(batch_feed_urls,).set(countdown=countdown + i * IMPORT_BATCH_INTERVAL)
+        for i, (batch_feed_urls, countdown) in enumerate(batch_feeds_by_host(feed_urls, FETCH_BATCH_SIZE))]
+    if signatures:
+        group(signatures)()
+
+
+def get_websub_lock_key(feed_url):
+    return f'websub_subscribe:{hashlib.md5(feed_url.encode()).hexdigest()}'
+
+
+def schedule_websub_subscription(feed, hub_url, topic_url):
+    """
+    Subscribe a feed to its WebSub hub at background, once per 'FEED_UPDATE_LOCK_TIMEOUT' at most while the hub
+    has not verified it yet
+    """
+    if cache.add(get_websub_lock_key(feed.feed_url), 1, timeout=FEED_UPDATE_LOCK_TIMEOUT):
+        subscribe_websub.delay(feed.feed_url, hub_url, topic_url)
+
+
+@app.task(max_retries=MAXIMUM_RETRY)
+def subscribe_websub(feed_url, hub_url, topic_url):
+    """
+    Background task to subscribe a feed to the WebSub hub it advertises, or to renew its subscription. The secret
+    of the subscription is kept as long as the hub is the same. Once the hub verifies the subscription, new entries
+    are pushed to 'views.WebSubCallbackView' and the feed is only polled as a safety net.
+    """
+    feed = Feed.objects.filter(feed_url=feed_url).first()
+    if feed is None:  # deleted meanwhile
+        return
+    if feed.hub_url != hub_url or not feed.websub_secret:
+        feed.hub_url, feed.websub_secret = hub_url, websub.new_secret()
+    feed.websub_topic = topic_url
+    feed.save(update_fields=['hub_url', 'websub_topic', 'websub_secret'])
+    try:
+        websub.request_subscription(feed)
+    except requests.RequestException as e:
+        logger.warning(f'Subscribe {feed_url} to hub {hub_url} failed with exception: {e}')
+        raise subscribe_websub.retry(countdown=get_backoff(subscribe_websub.request.retries + 1))
+
+
+@app.task(max_retries=MAXIMUM_RETRY)
+def ingest_pushed_content(feed_id, body, content_type):
+    """
+    Background task to store the content the WebSub hub of a feed pushed to 'views.WebSubCallbackView', as if the
+    feed was polled. The update lock of the feed is taken, so that a push and an update of the same feed are not
+    stored at the same time: while the feed is being updated, the push is retried with backoff.
+    :param body: pushed body, base64 encoded to be sent as json
+    :param content_type: content type of the pushed body
+    """
+    feed = Feed.objects.filter(id=feed_id).first()
+    if feed is None:  # deleted meanwhile
+        return
+    if not acquire_update_lock(feed.feed_url):
+        try:
+            raise ingest_pushed_content.retry(countdown=get_backoff(ingest_pushed_content.request.retries + 1))
+        except MaxRetriesExceededError:
+            logger.warning(f'Ignore content pushed for {feed.feed_url}: the feed is still being updated')
+            return
+    try:
+        d = parsers.parse(base64.b64decode(body), base_url=feed.feed_url,
+                          response_headers={'content-type': content_type})
+        payload = get_ingest_payload(feed.feed_url, d)
+        # Pushed content says nothing about the validators of the next poll
+        payload['validators'] = None
+        store_payload(feed, payload)
+    except (ValidationError, APIException) as e:
+        logger.warning(f'Ignore content pushed for {feed.feed_url} with exception: {e}')
+    finally:
+        release_update_lock(feed.feed_url)
+
+
+@app.task
+def prune_expired_entries():
+    """
+    Delete entries older than the retention of their feed, see 'Entry.get_expired()', with their read state,
+    periodically at background. Entries are deleted in transactions of at most 'RETENTION_CHUNK_SIZE' entries,
+    so that writers are never blocked for long. With 'RETENTION_ARCHIVE', a compact copy of them is kept first,
+    see 'ArchivedEntry'. Runs do not overlap: a run holds a lock until it is done, 'RETENTION_INTERVAL' at most.
+    :return: number of deleted entries
+    """
+    if not cache.add(PRUNE_LOCK_KEY, True, timeout=RETENTION_INTERVAL):
+        logger.info('Expired entries are already being pruned')
+        return 0
+
+    num_deleted = 0
+    try:
+        expired = Entry.get_expired().order_by('id')
+        last_id = 0
+        while True:
+            entry_ids = list(expired.filter(id__gt=last_id).values_list('id', flat=True)[:RETENTION_CHUNK_SIZE])
+            if not entry_ids:
+                break
+            last_id = entry_ids[-1]
+            with transaction.atomic():
+                if RETENTION_ARCHIVE:
+                    ArchivedEntry.archive(entry_ids)
+                _, num_deleted_by_model = Entry.objects.filter(id__in=entry_ids).delete()
+            num_deleted += num_deleted_by_model.get(Entry._meta.label, 0)
+    finally:
+        cache.delete(PRUNE_LOCK_KEY)
+    logger.info(f'{num_deleted} expired entries are deleted')
+    return num_deleted
 
 
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(UPDATE_INTERVAL, update_active_feeds.s(), name='update active feeds')
+    sender.add_periodic_task(SCHEDULER_INTERVAL, update_active_feeds.s(), name='update active feeds')
+    sender.add_periodic_task(RETENTION_INTERVAL, prune_expired_entries.s(), name='prune expired entries')
 
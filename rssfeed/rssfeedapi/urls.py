@@ -1,6 +1,8 @@
 from django.urls import include, path
 
-from .views import FeedListVew, FeedDetailView, EntryListView, EntryDetailView, EntryReadView
+from .views import FeedListVew, FeedDetailView, EntryListView, EntryDetailView, EntryReadView, FeedImportView, \
+    FeedImportDetailView, FeedExportView, EntryExportView, \
+    WebSubCallbackView
 
 # router = routers.DefaultRouter()
 app_name = 'rssfeedapi'
@@ -9,8 +11,13 @@ urlpatterns = [
     # path('', include(router.urls)),
     path('feed/', FeedListVew.as_view(), name='feed_list'),
     path('feed/<int:pk>/', FeedDetailView.as_view(), name='feed_detail'),
+    path('feed/import/', FeedImportView.as_view(), name='feed_import'),
+    path('feed/import/<int:pk>/', FeedImportDetailView.as_view(), name='feed_import_detail'),
+    path('feed/export/', FeedExportView.as_view(), name='feed_export'),
     # path('feed/update/', FeedUpdateView.as_view(), name='feed_update'),
     path('entry/', EntryListView.as_view(), name='entry_list'),
     path('entry/<int:pk>/', EntryDetailView.as_view(), name='entry_detail'),
     path('entry/<int:pk>/read/', EntryReadView.as_view(), name='entry_read'),
+    path('entry/export/<str:export_format>/', EntryExportView.as_view(), name='entry_export'),
+    path('websub/<int:pk>/', WebSubCallbackView.as_view(), name='websub_callback'),
 ]
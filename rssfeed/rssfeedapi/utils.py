@@ -1,5 +1,11 @@
 import datetime
+import hashlib
+import itertools
+import random
 import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from rssfeed.settings import RETRY_BACKOFF, RETRY_BACKOFF_MAX
 
 
 def get_published_parsed(d):
@@ -13,5 +19,105 @@ def get_published_parsed(d):
     published_parsed = None
     first = next((item for item in published_parsed_list if item is not None), None)
     if first:
-        published_parsed = datetime.datetime.fromtimestamp(time.mktime(first), tz=datetime.timezone.utc)
+        # A parsed time is a list instead of a tuple after being sent as json to a task
+        published_parsed = datetime.datetime.fromtimestamp(time.mktime(tuple(first)), tz=datetime.timezone.utc)
     return published_parsed
+
+
+def chunked(iterable, size):
+    """
+    Helper function to split an iterable into lists of at most 'size' items, without materializing it at once
+    :param iterable: any iterable, e.g. a list of parsed entries or a queryset iterator
+    :param size: maximum number of items per chunk
+    :return: generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_host(url):
+    """
+    Helper function to get the host of a url, used to group feeds hosted together
+    :param url: feed url
+    :return: lower case host name, or an empty string if the url has none
+    """
+    return (urlsplit(url).hostname or '').lower()
+
+
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_ga', 'ref_src'}
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+def canonicalize_url(url):
+    """
+    Helper function to normalize a feed url without changing the document it points to: the scheme and the host
+    are lower cased, the default port, the fragment and tracking query parameters ('utm_*' and 'TRACKING_PARAMS')
+    are removed
+    :param url: feed url
+    :return: normalized url
+    """
+    parts = urlsplit(url.strip())
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    default_port = DEFAULT_PORTS.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    query = parts.query
+    params = parse_qsl(query, keep_blank_values=True)
+    kept_params = [(key, value) for key, value in params
+                   if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS]
+    if len(kept_params) < len(params):
+        query = urlencode(kept_params)
+    return urlunsplit((scheme, netloc, parts.path, query, ''))
+
+
+def get_url_key(url):
+    """
+    Helper function to get the key which urls of the same feed have in common: the url normalized by
+    'canonicalize_url()', without its scheme and without a trailing slash. 'http://' and 'https://' variants of a
+    feed are the same feed
+    :param url: feed url
+    :return: key of the url
+    """
+    parts = urlsplit(canonicalize_url(url))
+    return parts.netloc + parts.path.rstrip('/') + (f'?{parts.query}' if parts.query else '')
+
+
+def normalize_entry(parsed_entry):
+    """
+    Helper function to keep only the fields of a parsed entry which are stored, in a form which can be sent as json
+    to a task
+    :param parsed_entry: one parsed entry from 'feedparser.parse()' (d.entries)
+    :return: dict with the same keys as a parsed entry
+    """
+    published_parsed = parsed_entry.get('published_parsed', None) or parsed_entry.get('updated_parsed', None)
+    return {
+        'id': parsed_entry.get('id'), 'title': parsed_entry.get('title', ''), 'link': parsed_entry.get('link', ''),
+        'author': parsed_entry.get('author', ''), 'description': parsed_entry.get('description', ''),
+        'published_parsed': tuple(published_parsed) if published_parsed else None,
+    }
+
+
+def get_content_hash(values):
+    """
+    Fast hash of text values, e.g. the content fields of an entry. A missing value hashes as an empty one
+    :param values: iterable of values
+    :return: hex digest of 32 characters
+    """
+    content = '\0'.join(str(value or '') for value in values)
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def get_backoff(attempt):
+    """
+    Helper function to get the delay before retrying: exponential backoff from 'RETRY_BACKOFF' up to
+    'RETRY_BACKOFF_MAX' seconds, of which a random half is jitter, so that failures at the same time do not retry
+    at the same time
+    :param attempt: number of the retry, starting from 1
+    :return: delay in seconds
+    """
+    backoff = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+    return backoff / 2 + random.uniform(0, backoff / 2)
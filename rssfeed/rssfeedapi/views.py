@@ -1,24 +1,31 @@
+import base64
 import logging
 
 from django.db.models import Prefetch
-from django.http import Http404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.urls import reverse
 from django.utils.decorators import method_decorator
 from drf_yasg.utils import swagger_auto_schema, no_body
 
 from rest_framework import status
 from rest_framework.generics import ListCreateAPIView, \
     ListAPIView, RetrieveAPIView, CreateAPIView, RetrieveUpdateDestroyAPIView
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from rssfeed.settings import DAYS_RETRIEVABLE
-from .swagger_utils import feed_subscribed_200, feed_subscribed_201, feed_param, read_param, entry_read_200, \
-    entry_read_201
-from .tasks import update_feed
+from rssfeed.settings import DAYS_RETRIEVABLE, ASYNC_SUBSCRIBE
+from .swagger_utils import feed_subscribed_200, feed_subscribed_201, feed_subscribed_202, feed_param, read_param, \
+    entry_read_200, entry_read_201, feed_import_202
+from .tasks import schedule_feed_update, schedule_new_feeds, ingest_pushed_content
+from . import websub
 
 from .serializers import FeedListSerializer, FeedDetailSerializer, EntryFilterSerializer, \
-    EntryListSerializer, EntryDetailSerializer
-from .models import Entry, Feed, FeedSubscription
+    EntryListSerializer, EntryDetailSerializer, FeedImportSerializer, ImportJobSerializer
+from .models import Entry, Feed, FeedSubscription, ImportJob
+from .exporters import iter_opml, ENTRY_EXPORTERS
 logger = logging.getLogger(__name__)
 
 
@@ -28,8 +35,11 @@ logger = logging.getLogger(__name__)
 @method_decorator(name='post', decorator=swagger_auto_schema(
     operation_summary="Subscribe to a new feed",
     operation_description="Add a feed to user's subscription list. "
-                          "Create a new feed in the database if not exists",
-    responses={200: feed_subscribed_200, 201: feed_subscribed_201, 400: 'rss feedparser error'},
+                          "Create a new feed in the database if not exists. "
+                          "With 'ASYNC_SUBSCRIBE', a new feed is validated at background: its status stays "
+                          "'creating' until then, and becomes 'updated' or 'error'",
+    responses={200: feed_subscribed_200, 201: feed_subscribed_201, 202: feed_subscribed_202,
+               400: 'rss feedparser error'},
 ))
 class FeedListVew(ListCreateAPIView):
     serializer_class = FeedListSerializer
@@ -44,16 +54,18 @@ class FeedListVew(ListCreateAPIView):
         serializer.is_valid(raise_exception=True)
 
         feed_url = serializer.validated_data['feed']['feed_url']
-        feed, create = Feed.get_or_create(feed_url)
+        feed, create = Feed.get_or_create(feed_url, validate=not ASYNC_SUBSCRIBE)
+        # Not validated yet: the subscription is accepted, the feed may still turn out to be invalid
+        pending = ASYNC_SUBSCRIBE and feed.status == Feed.Status.CREATING
         if create:  # update entreis at background
-            update_feed.apply_async(args=(feed.feed_url,), queue='force_feed_update',)
+            schedule_feed_update(feed.feed_url)
 
         feed_subs = FeedSubscription.objects.filter(feed=feed, user=self.request.user).first()
         if feed_subs:
             return_status = status.HTTP_200_OK
         else:
             feed_subs = FeedSubscription.objects.create(feed=feed, user=self.request.user)
-            return_status = status.HTTP_201_CREATED
+            return_status = status.HTTP_202_ACCEPTED if pending else status.HTTP_201_CREATED
 
         fs_serializer = self.serializer_class(instance=feed_subs, context={'request': request})
         headers = self.get_success_headers(fs_serializer.data)
@@ -67,7 +79,7 @@ class FeedListVew(ListCreateAPIView):
 @method_decorator(name='put', decorator=swagger_auto_schema(
     operation_summary="Update a feed manually",
     request_body=no_body,
-    responses={200: "Feed will be updated at background"}
+    responses={200: "Feed will be updated at background, or is already being updated"}
 ))
 @method_decorator(name='delete', decorator=swagger_auto_schema(
     operation_summary="Unsubscribe a feed",
@@ -94,9 +106,47 @@ class FeedDetailView(RetrieveUpdateDestroyAPIView):
 
     def update(self, request, *args, **kwargs):
         feed = self.get_object()
-        update_feed.apply_async(args=(feed.feed_url,), queue='force_feed_update',)
+        if not schedule_feed_update(feed.feed_url):
+            return Response(f"Feed {feed.id} is already being updated at background")
         return Response(f"Feed {feed.id} will be updated at background")
 
+
+@method_decorator(name='post', decorator=swagger_auto_schema(
+    operation_summary="Import feeds from an OPML file",
+    operation_description="Subscribe to all feeds of an OPML file exported by another feed reader. "
+                          "Feeds which are not in the database yet are validated at background: "
+                          "follow the progress of the import at the url of the 'Location' header",
+    responses={202: feed_import_202, 400: 'OPML parser error'},
+))
+class FeedImportView(CreateAPIView):
+    serializer_class = FeedImportSerializer
+    parser_classes = (MultiPartParser, )
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        feed_urls, num_skipped = serializer.validated_data['file']
+        job, new_feed_urls = ImportJob.create(request.user, feed_urls, num_skipped)
+        schedule_new_feeds(new_feed_urls)
+
+        job_serializer = ImportJobSerializer(instance=ImportJob.objects.with_progress().get(id=job.id))
+        headers = {'Location': reverse('rssfeedapi:feed_import_detail', args=[job.id])}
+        return Response(job_serializer.data, status=status.HTTP_202_ACCEPTED, headers=headers)
+
+
+@method_decorator(name='get', decorator=swagger_auto_schema(
+    operation_summary="Show the progress of an OPML import",
+))
+class FeedImportDetailView(RetrieveAPIView):
+    serializer_class = ImportJobSerializer
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return ImportJob.objects.none()
+        return ImportJob.objects.with_progress().filter(user=self.request.user)
+
+
 # debug purpose
 # class FeedUpdateView(APIView):
 #     @swagger_auto_schema(operation_summary="Update all feeds subscribed by the user",
@@ -192,3 +242,90 @@ class EntryListView(ListAPIView):
             entries = entries.filter(feed_id=feed_id)
 
         return entries
+
+
+class FeedExportView(APIView):
+    @swagger_auto_schema(operation_summary="Export all feeds followed by a user as an OPML file",
+                         responses={200: "OPML file, streamed"})
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(iter_opml(request.user), content_type='text/x-opml; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="subscriptions.opml"'
+        return response
+
+
+@method_decorator(
+    name='get',
+    decorator=swagger_auto_schema(
+        operation_summary=f"Export followed entries published in recent {DAYS_RETRIEVABLE} days with their read "
+                          f"state, as newline delimited json ('ndjson') or as an Atom feed ('atom')",
+        operation_description="Filter entries like the list of entries. The export is streamed at once instead "
+                              "of paginated",
+        manual_parameters=[feed_param, read_param],
+        responses={200: "Export file, streamed", 404: "Unknown export format"}),
+)
+class EntryExportView(EntryListView):
+    pagination_class = None
+
+    def get(self, request, export_format, *args, **kwargs):
+        if export_format not in ENTRY_EXPORTERS:
+            raise Http404
+        exporter, content_type = ENTRY_EXPORTERS[export_format]
+        response = StreamingHttpResponse(exporter(request.user, self.get_queryset()),
+                                         content_type=f'{content_type}; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="entries.{export_format}"'
+        return response
+
+
+class WebSubCallbackView(APIView):
+    """
+    Callback of the WebSub subscription of a feed, see 'tasks.subscribe_websub'. Called by hubs, not by users.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    swagger_schema = None
+
+    def get_feed(self, pk):
+        feed = Feed.objects.filter(id=pk, hub_url__isnull=False).first()
+        if feed is None:
+            raise Http404
+        return feed
+
+    def get(self, request, pk, *args, **kwargs):
+        """
+        The hub verifies the intent to subscribe: confirm it by echoing the challenge, only if this subscription
+        was requested and is not verified yet
+        """
+        feed = self.get_feed(pk)
+        mode, topic = request.query_params.get('hub.mode'), request.query_params.get('hub.topic')
+        if mode == 'denied':
+            if topic != feed.websub_topic:
+                raise Http404
+            websub.clear_pending(feed)
+            logger.warning(f'Hub {feed.hub_url} denied to subscribe to {feed.feed_url}: '
+                           f'{request.query_params.get("hub.reason")}')
+            # Poll the feed again as usual
+            Feed.objects.filter(id=feed.id).update(websub_expires_at=None, next_poll_at=timezone.now())
+            return HttpResponse()
+        if mode != 'subscribe' or not websub.is_pending(feed, topic):
+            raise Http404
+
+        lease_seconds = websub.get_lease_seconds(request.query_params.get('hub.lease_seconds'))
+        feed.enable_push(lease_seconds)
+        websub.clear_pending(feed)
+        logger.info(f'Hub {feed.hub_url} pushes {feed.feed_url} for {lease_seconds} seconds')
+        return HttpResponse(request.query_params.get('hub.challenge', ''), content_type='text/plain')
+
+    def post(self, request, pk, *args, **kwargs):
+        """
+        The hub pushes new content of the feed: store it at background as if the feed was polled, see
+        'tasks.ingest_pushed_content'
+        """
+        feed = self.get_feed(pk)
+        body = request.body
+        if not websub.is_valid_signature(feed.websub_secret, body, request.headers.get('X-Hub-Signature')):
+            # The content is not from the hub: acknowledge it, but ignore it
+            logger.warning(f'Ignore content pushed for {feed.feed_url} with an invalid signature')
+            return HttpResponse(status=status.HTTP_202_ACCEPTED)
+
+        ingest_pushed_content.delay(feed.id, base64.b64encode(body).decode(), request.content_type)
+        return HttpResponse(status=status.HTTP_202_ACCEPTED)
@@ -0,0 +1,99 @@
+import hashlib
+import hmac
+import logging
+import secrets
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils import timezone
+
+from rssfeed.settings import WEBSUB_CALLBACK_BASE_URL, WEBSUB_LEASE_SECONDS, WEBSUB_POLL_INTERVAL, FETCH_TIMEOUT
+from .fetcher import get_session
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_METHODS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256, 'sha384': hashlib.sha384,
+                     'sha512': hashlib.sha512}
+VERIFICATION_TIMEOUT = 3600  # seconds a hub has to verify a subscription request
+
+
+def is_enabled():
+    """
+    WebSub needs a callback url which hubs can reach, see 'WEBSUB_CALLBACK_BASE_URL'
+    """
+    return bool(WEBSUB_CALLBACK_BASE_URL)
+
+
+def get_callback_url(feed):
+    return WEBSUB_CALLBACK_BASE_URL.rstrip('/') + reverse('rssfeedapi:websub_callback', args=[feed.id])
+
+
+def needs_subscription(feed, hub_url):
+    """
+    Whether the feed must be subscribed to its hub: it is not yet, its hub changed, or its lease ends before
+    the next safety net poll after this one
+    """
+    if not hub_url or not is_enabled():
+        return False
+    renew_at = timezone.now() + timedelta(seconds=2 * WEBSUB_POLL_INTERVAL)
+    return feed.hub_url != hub_url or feed.websub_expires_at is None or feed.websub_expires_at < renew_at
+
+
+def request_subscription(feed):
+    """
+    Ask the hub of a feed to subscribe to it, or to renew the subscription. The hub verifies the intent at the
+    callback url asynchronously, see 'views.WebSubCallbackView'
+    :raise requests.RequestException: the hub does not accept the request
+    """
+    data = {'hub.mode': 'subscribe', 'hub.topic': feed.websub_topic, 'hub.callback': get_callback_url(feed),
+            'hub.secret': feed.websub_secret, 'hub.lease_seconds': WEBSUB_LEASE_SECONDS}
+    # The hub may verify the intent before it answers
+    cache.set(get_pending_key(feed), feed.websub_topic, timeout=VERIFICATION_TIMEOUT)
+    try:
+        response = get_session().post(feed.hub_url, data=data, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+    except Exception:
+        cache.delete(get_pending_key(feed))
+        raise
+    logger.info(f'Hub {feed.hub_url} accepted to subscribe to {feed.feed_url}')
+
+
+def get_pending_key(feed):
+    return f'websub_pending:{feed.id}'
+
+
+def is_pending(feed, topic):
+    """
+    Whether a subscription of the feed to the topic was requested and is not verified yet, see
+    'request_subscription()'. Only such a request may be verified: a verification without it is not from the hub
+    """
+    return topic is not None and topic == feed.websub_topic and cache.get(get_pending_key(feed)) == topic
+
+
+def clear_pending(feed):
+    cache.delete(get_pending_key(feed))
+
+
+def get_lease_seconds(value):
+    """
+    Lease granted by the hub, at most the one asked for: 'WEBSUB_LEASE_SECONDS'
+    :param value: 'hub.lease_seconds' of the verification, the lease asked for if missing or invalid
+    """
+    return min(int(value), WEBSUB_LEASE_SECONDS) if value and value.isdigit() else WEBSUB_LEASE_SECONDS
+
+
+def new_secret():
+    return secrets.token_hex(20)
+
+
+def is_valid_signature(secret, body, signature):
+    """
+    Check the 'X-Hub-Signature' header of pushed content, the HMAC of the body with the secret of the subscription
+    :param signature: header value, '<method>=<hex digest>'
+    """
+    method, _, digest = (signature or '').partition('=')
+    if not secret or method not in SIGNATURE_METHODS:
+        return False
+    expected = hmac.new(secret.encode(), body, SIGNATURE_METHODS[method]).hexdigest()
+    return hmac.compare_digest(expected, digest)
@@ -1,4 +1,5 @@
 import pytest
+from django.core.cache import cache
 from faker import Faker
 
 from .factories import FeedFactory, EntryFactory, UserFactory
@@ -38,3 +39,10 @@ def celery_app(request):
     app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
     return app
 
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Locks and other cached state must not leak between tests
+    cache.clear()
+    yield
+    cache.clear()
@@ -0,0 +1,68 @@
+import json
+import xml.etree.ElementTree as ET
+
+import feedparser
+import pytest
+from django.http import StreamingHttpResponse
+from rest_framework.reverse import reverse
+
+from rssfeedapi.models import Entry
+from rssfeedapi.parsers import parse_opml
+from tests.utils import _create_feeds_in_db
+
+
+def _content(response):
+    assert isinstance(response, StreamingHttpResponse)
+    return b''.join(response.streaming_content)
+
+
+@pytest.mark.django_db
+class TestExport:
+    def test_export_feeds(self, user, api_client):
+        feeds = _create_feeds_in_db(3)
+        user.subscriptions.add(feeds[0], feeds[1])
+
+        response = api_client.get(reverse("rssfeedapi:feed_export"))
+        assert response.status_code == 200
+        assert response['Content-Disposition'] == 'attachment; filename="subscriptions.opml"'
+        # Test the export can be imported again
+        assert parse_opml(_content(response)) == [feeds[0].feed_url, feeds[1].feed_url]
+
+    def test_export_entries_ndjson(self, user, api_client):
+        feeds = _create_feeds_in_db(2)
+        user.subscriptions.add(feeds[0])
+        read_entry = feeds[0].entries.first()
+        read_entry.read_by.add(user)
+
+        response = api_client.get(reverse("rssfeedapi:entry_export", args=['ndjson']))
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in _content(response).decode().splitlines()]
+        # Test all entries of the subscribed feeds are exported at once, with their read state
+        assert {line['id'] for line in lines} == set(Entry.recent_objects.filter(feed=feeds[0]).values_list(
+            'id', flat=True))
+        assert all(line['read'] == (line['id'] == read_entry.id) for line in lines)
+        assert all(line['feed_url'] == feeds[0].feed_url for line in lines)
+
+        # Test entries are filtered like the list of entries
+        response = api_client.get(reverse("rssfeedapi:entry_export", args=['ndjson']), data={'read': True})
+        assert [json.loads(line)['id'] for line in _content(response).decode().splitlines()] == [read_entry.id]
+
+    def test_export_entries_atom(self, user, api_client):
+        feeds = _create_feeds_in_db(1)
+        user.subscriptions.add(feeds[0])
+        read_entry = feeds[0].entries.first()
+        read_entry.read_by.add(user)
+
+        response = api_client.get(reverse("rssfeedapi:entry_export", args=['atom']))
+        assert response.status_code == 200
+        content = _content(response)
+        ET.fromstring(content)  # well-formed
+        d = feedparser.parse(content)
+        assert not d.bozo
+        assert {entry.id for entry in d.entries} == set(Entry.recent_objects.filter(feed=feeds[0]).values_list(
+            'guid', flat=True))
+        assert [entry.id for entry in d.entries if entry.get('tags')] == [read_entry.guid]
+
+    def test_export_unknown_format(self, user, api_client):
+        response = api_client.get(reverse("rssfeedapi:entry_export", args=['csv']))
+        assert response.status_code == 404
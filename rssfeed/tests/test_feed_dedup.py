@@ -0,0 +1,144 @@
+import os
+from unittest.mock import patch, MagicMock
+
+import pytest
+from django.core.management import call_command
+from django.urls import reverse
+
+from rssfeedapi.fetcher import FetchResult, fetch_feed
+from rssfeedapi.models import Feed, Entry, FeedSubscription
+from rssfeedapi.tasks import update_feed
+from rssfeedapi.utils import canonicalize_url, get_url_key
+from .utils import _create_authorized_users, _create_feeds_in_db, _mock_fetch_feed
+
+FEED_FILE = os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml'
+
+
+def _mock_redirected_fetch_feed(redirect_url):
+    def fetch_feed(feed_url, **kwargs):
+        with open(FEED_FILE, 'rb') as f:
+            return FetchResult(url=feed_url, status=200, body=f.read(), headers={}, redirect_url=redirect_url)
+    return MagicMock(side_effect=fetch_feed)
+
+
+class TestUrls:
+    @pytest.mark.parametrize('url, canonical_url', [
+        ('HTTPS://Feed.NL:443/rss#top', 'https://feed.nl/rss'),
+        ('http://feed.nl:80/rss?utm_source=x&utm_medium=y&fbclid=z', 'http://feed.nl/rss'),
+        ('https://feed.nl/rss?page=1&utm_source=x', 'https://feed.nl/rss?page=1'),
+        ('https://feed.nl:8443/Rss/', 'https://feed.nl:8443/Rss/'),
+    ])
+    def test_canonicalize_url(self, url, canonical_url):
+        assert canonicalize_url(url) == canonical_url
+
+    def test_url_key(self):
+        # Test variants of the url of a feed have the same key, other feeds not
+        assert get_url_key('http://feed.nl/rss/') == get_url_key('https://FEED.nl/rss?utm_campaign=x')
+        assert get_url_key('https://feed.nl/rss') != get_url_key('https://feed.nl/Rss')
+        assert get_url_key('https://feed.nl/rss?id=1') != get_url_key('https://feed.nl/rss?id=2')
+
+    def test_permanent_redirect(self):
+        response = MagicMock(status_code=200, url='https://new.feed.nl/rss', headers={},
+                             history=[MagicMock(status_code=301), MagicMock(status_code=308)])
+        response.iter_content.return_value = iter([b'<rss/>'])
+        response.__enter__.return_value = response
+        with patch('rssfeedapi.fetcher.get_session') as mock_session:
+            mock_session.return_value.get.return_value = response
+            assert fetch_feed('http://feed.nl/rss').redirect_url == 'https://new.feed.nl/rss'
+
+            # Test a temporary redirect is not recorded
+            response.history = [MagicMock(status_code=301), MagicMock(status_code=302)]
+            response.iter_content.return_value = iter([b'<rss/>'])
+            assert fetch_feed('http://feed.nl/rss').redirect_url is None
+
+
+@pytest.mark.django_db
+class TestFeedDedup:
+    def test_subscribe_url_variants(self, celery_app):
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        mock_fetch_feed = _mock_fetch_feed(FEED_FILE)
+        url = reverse("rssfeedapi:feed_list")
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            response = api_client.post(url, data={"feed_url": 'https://Feed.nl/rss?utm_source=newsletter'})
+            assert response.status_code == 201
+            assert response.json()['feed_url'] == 'https://feed.nl/rss'
+
+            # Test variants of the url find the same feed, which is downloaded once
+            response = api_client.post(url, data={"feed_url": 'http://feed.nl/rss/'})
+            assert response.status_code == 200
+            assert response.json()['feed_url'] == 'https://feed.nl/rss'
+        assert Feed.objects.count() == 1
+        assert mock_fetch_feed.call_count == 1
+
+    def test_subscribe_redirected(self):
+        feed, = _create_feeds_in_db(1)
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_redirected_fetch_feed(feed.feed_url)), \
+                patch('rssfeedapi.views.schedule_feed_update') as mock_schedule:
+            response = api_client.post(reverse("rssfeedapi:feed_list"), data={"feed_url": 'https://old.feed.nl/rss'})
+        # Test the feed the url is redirected to is subscribed
+        assert response.status_code == 201
+        assert response.json()['feed_url'] == feed.feed_url
+        assert not Feed.get_by_url('https://old.feed.nl/rss') and user.subscriptions.filter(id=feed.id).exists()
+        assert mock_schedule.call_count == 0
+
+    def test_subscribe_redirected_new_feed(self, celery_app):
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        mock_fetch_feed = _mock_redirected_fetch_feed('https://new.feed.nl/rss')
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            response = api_client.post(reverse("rssfeedapi:feed_list"), data={"feed_url": 'https://old.feed.nl/rss'})
+        # Test the feed is created with the url it moved to, and its first update reuses the download
+        assert response.status_code == 201
+        feed = Feed.objects.get()
+        assert feed.feed_url == 'https://new.feed.nl/rss' and feed.status == Feed.Status.UPDATED
+        assert mock_fetch_feed.call_count == 1
+
+    def test_update_moves_and_merges(self, celery_app):
+        alias, canonical_feed = _create_feeds_in_db(2)
+        (user0, user1), _ = _create_authorized_users(2)
+        user0.subscriptions.add(alias)
+        user1.subscriptions.add(alias, canonical_feed)
+        alias_entry_ids = set(alias.entries.values_list('id', flat=True))
+        alias.entries.first().read_by.add(user0)
+
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_redirected_fetch_feed(canonical_feed.feed_url)):
+            update_feed(alias.feed_url)
+
+        # Test the alias is merged into the feed it moved to: subscribers, entries and read state are kept
+        assert not Feed.objects.filter(id=alias.id).exists()
+        canonical_feed = Feed.objects.get(id=canonical_feed.id)
+        assert set(canonical_feed.subscribers.all()) == {user0, user1}
+        assert canonical_feed.subscriber_count == 2
+        assert alias_entry_ids <= set(canonical_feed.entries.values_list('id', flat=True))
+        assert user0.read_entries.filter(feed=canonical_feed).count() == 1
+        assert canonical_feed.status == Feed.Status.UPDATED
+
+    def test_update_records_new_url(self, celery_app):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(feed_url='http://feed.nl/rss')
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_redirected_fetch_feed('https://feed.nl/rss')):
+            update_feed('http://feed.nl/rss')
+        # Test the feed keeps its id with the url it moved to
+        feed = Feed.objects.get(id=feed.id)
+        assert feed.feed_url == 'https://feed.nl/rss' and feed.url_key == 'feed.nl/rss'
+
+    def test_merge_duplicate_feeds(self):
+        feeds = _create_feeds_in_db(3)
+        for feed, feed_url in zip(feeds, ['http://feed.nl/rss', 'https://feed.nl/rss/', 'https://other.nl/rss']):
+            feed.feed_url = feed_url
+            feed.save()
+        (user, ), _ = _create_authorized_users(1)
+        user.subscriptions.add(feeds[0], feeds[1])
+        num_entries = Entry.objects.filter(feed__in=feeds[:2]).count()
+
+        num_feeds = Feed.objects.count()
+        call_command('merge_duplicate_feeds', '--dry-run')
+        assert Feed.objects.count() == num_feeds
+
+        call_command('merge_duplicate_feeds')
+        # Test the https variant is kept, with the entries of both and one subscription of the user
+        assert Feed.objects.count() == num_feeds - 1
+        assert not Feed.objects.filter(id=feeds[0].id).exists()
+        assert Feed.objects.get(id=feeds[1].id).entries.count() == num_entries
+        assert FeedSubscription.objects.filter(user=user).count() == 1
+        assert Feed.objects.get(id=feeds[1].id).subscriber_count == 1
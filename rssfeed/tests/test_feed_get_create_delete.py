@@ -6,8 +6,9 @@ from django.urls import reverse
 from rest_framework import serializers
 
 from rssfeedapi.models import Feed, Entry, FeedSubscription
+from rssfeedapi.tasks import update_feed
 from rssfeedapi.utils import get_published_parsed
-from tests.utils import _create_feeds_in_db
+from tests.utils import _create_feeds_in_db, _mock_fetch_feed
 
 
 @pytest.mark.django_db
@@ -42,7 +43,9 @@ class TestFeedView:
         # Test user subscribes to a new feed (Not exist)
         d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
         published_parsed = get_published_parsed(d.feed)
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             url = reverse("rssfeedapi:feed_list")
             fake_url = 'https://abc.nl'
             response = api_client.post(url, data={"feed_url": fake_url})
@@ -92,6 +95,75 @@ class TestFeedView:
         response = api_client.post(url, data={"feed_url": 'http://invalid_rss20.xml'})
         assert response.status_code == 400
 
+    def test_follow_a_feed_downloaded_once(self, user, api_client, celery_app):
+        mock_fetch_feed = _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            url = reverse("rssfeedapi:feed_list")
+            response = api_client.post(url, data={"feed_url": 'https://abc.nl'})
+            assert response.status_code == 201
+
+            # Test the first update reuses the download of the subscription
+            assert mock_fetch_feed.call_count == 1
+            new_feed = Feed.objects.get(feed_url='https://abc.nl')
+            assert new_feed.status == Feed.Status.UPDATED
+            assert new_feed.entries.count() == len(d.entries)
+
+            # Test the next update downloads the feed again
+            api_client.put(reverse("rssfeedapi:feed_detail", args=[new_feed.id]))
+            assert mock_fetch_feed.call_count == 2
+
+    def test_follow_a_feed_async(self, user, api_client):
+        file_dir = os.path.dirname(os.path.realpath(__file__))
+        url = reverse("rssfeedapi:feed_list")
+        with patch('rssfeedapi.views.ASYNC_SUBSCRIBE', True), \
+                patch('rssfeedapi.views.schedule_feed_update') as mock_schedule, \
+                patch('rssfeedapi.fetcher.fetch_feed') as mock_fetch_feed:
+            response = api_client.post(url, data={"feed_url": 'https://abc.nl'})
+            # Test the subscription is accepted without downloading the feed
+            assert response.status_code == 202
+            assert response.json().get('status') == Feed.Status.CREATING
+            assert mock_fetch_feed.call_count == 0
+            mock_schedule.assert_called_once_with('https://abc.nl')
+            new_feed = Feed.objects.get(feed_url='https://abc.nl')
+            assert new_feed.status == Feed.Status.CREATING and not new_feed.title
+            assert user.subscriptions.filter(id=new_feed.id).exists()
+
+            # Test subscribing again before the feed is validated
+            response = api_client.post(url, data={"feed_url": 'https://abc.nl'})
+            assert response.status_code == 200
+
+            # Test an invalid url is rejected right away, before any feed or subscription is created
+            for invalid_url in ('not a url', 'ftp://abc.nl/rss', 'https://abc.nl/' + 'x' * 256):
+                response = api_client.post(url, data={"feed_url": invalid_url})
+                assert response.status_code == 400
+            assert Feed.objects.count() == 1 and mock_schedule.call_count == 1
+
+        # Test the update at background fills in the feed and its entries
+        d = feedparser.parse(file_dir + '/nu.nl.rss.xml')
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(file_dir + '/nu.nl.rss.xml')):
+            update_feed('https://abc.nl')
+        new_feed = Feed.objects.get(feed_url='https://abc.nl')
+        assert new_feed.status == Feed.Status.UPDATED
+        for key in ['title', 'link', 'description', 'language']:
+            assert getattr(new_feed, key) == d.feed.get(key)
+        assert new_feed.entries.count() == len(d.entries)
+        response = api_client.get(url)
+        assert response.json()['results'][0]['status'] == Feed.Status.UPDATED
+
+    def test_follow_an_invalid_feed_async(self, user, api_client, celery_app):
+        file_dir = os.path.dirname(os.path.realpath(__file__))
+        with patch('rssfeedapi.views.ASYNC_SUBSCRIBE', True), \
+                patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(file_dir + '/NotValid.xml')), \
+                patch('rssfeedapi.tasks.send_admin_email') as mock_send_admin_email:
+            response = api_client.post(reverse("rssfeedapi:feed_list"), data={"feed_url": 'https://abc.nl'})
+            assert response.status_code == 202
+
+        # Test the feed ends in error once the update at background gives up
+        new_feed = Feed.objects.get(feed_url='https://abc.nl')
+        assert new_feed.status == Feed.Status.ERROR
+        mock_send_admin_email.assert_called_once_with(msg="failed to update https://abc.nl")
+
     def test_get_feed_detail(self, user, api_client, feed):
         # Setup DB: user subscribes to feed
         user.subscriptions.add(feed)
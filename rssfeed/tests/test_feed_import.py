@@ -0,0 +1,89 @@
+import os
+from unittest.mock import patch
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+
+from rssfeedapi.models import Feed, ImportJob
+from .utils import _create_authorized_users, _create_feeds_in_db, _mock_fetch_feed
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def _opml(feed_urls):
+    outlines = ''.join(f'<outline type="rss" text="{feed_url}" xmlUrl="{feed_url}"/>' for feed_url in feed_urls)
+    return (f'<?xml version="1.0" encoding="UTF-8"?><opml version="2.0"><head><title>Export</title></head>'
+            f'<body><outline text="Folder">{outlines}</outline><outline text="No feed"/></body></opml>').encode()
+
+
+@pytest.mark.django_db
+class TestFeedImport:
+    def test_import_feeds(self, celery_app):
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        existing_feed, subscribed_feed = _create_feeds_in_db(2)
+        user.subscriptions.add(subscribed_feed)
+        url_to_file = {'https://feed1.nl/rss': FILE_DIR + '/nu.nl.rss.xml',
+                       'https://feed2.nl/rss': FILE_DIR + '/tweakers.mixed.xml',
+                       'https://feed3.nl/rss': FILE_DIR + '/NotValid.xml'}
+        feed_urls = [existing_feed.feed_url, subscribed_feed.feed_url, *url_to_file,
+                     'https://feed1.nl/rss', 'not a url']
+        upload = SimpleUploadedFile('export.opml', _opml(feed_urls), content_type='text/x-opml')
+
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(url_to_file)), \
+                patch('rssfeedapi.tasks.send_admin_email'):
+            response = api_client.post(reverse('rssfeedapi:feed_import'), data={'file': upload}, format='multipart')
+        assert response.status_code == 202
+        job = ImportJob.objects.get(user=user)
+        assert response['Location'] == reverse('rssfeedapi:feed_import_detail', args=[job.id])
+
+        # Test all feeds are subscribed once, and the new ones are created
+        assert set(user.subscriptions.values_list('feed_url', flat=True)) == \
+               {existing_feed.feed_url, subscribed_feed.feed_url, *url_to_file}
+        assert job.num_new_feeds == 3 and job.num_skipped == 1
+        assert Feed.objects.get(id=existing_feed.id).subscriber_count == 1
+        assert Feed.objects.get(feed_url='https://feed1.nl/rss').subscriber_count == 1
+
+        # Test new feeds are validated at background, and the progress of the import
+        assert Feed.objects.get(feed_url='https://feed1.nl/rss').status == Feed.Status.UPDATED
+        assert Feed.objects.get(feed_url='https://feed1.nl/rss').title
+        assert Feed.objects.get(feed_url='https://feed3.nl/rss').status == Feed.Status.ERROR
+        response = api_client.get(response['Location'])
+        assert response.status_code == 200
+        assert response.json()['status'] == 'done'
+        assert response.json()['num_feeds'] == 5
+        assert response.json()['num_pending'] == 0 and response.json()['num_failed'] == 1
+
+    def test_import_throttled(self):
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        feed_urls = [f'https://feed{i}.nl/rss' for i in range(5)]
+        upload = SimpleUploadedFile('export.opml', _opml(feed_urls), content_type='text/x-opml')
+        with patch('rssfeedapi.tasks.FETCH_BATCH_SIZE', 2), \
+                patch('rssfeedapi.tasks.update_feeds_batch.s') as mock_batch, \
+                patch('rssfeedapi.tasks.group'):
+            response = api_client.post(reverse('rssfeedapi:feed_import'), data={'file': upload}, format='multipart')
+        assert response.status_code == 202
+        assert response.json()['status'] == 'validating' and response.json()['num_pending'] == 5
+
+        # Test new feeds are validated in batches, one batch after the other
+        assert sorted(feed_url for args in mock_batch.call_args_list for feed_url in args[0][0]) == feed_urls
+        countdowns = [call.kwargs['countdown'] for call in mock_batch.return_value.set.call_args_list]
+        assert len(countdowns) == 3 and countdowns == sorted(set(countdowns))
+        # Test they are not polled periodically before they are validated
+        assert not Feed.objects.filter(feed_url__in=feed_urls, next_poll_at__lte=response.json()['created_time'])
+
+    @pytest.mark.parametrize('body', [b'<html><body>Not OPML</body></html>', b'<opml><body></opml>',
+                                      b'<opml><body><outline text="No feed"/></body></opml>'])
+    def test_import_invalid_file(self, body):
+        (user, ), (api_client, ) = _create_authorized_users(1)
+        upload = SimpleUploadedFile('export.opml', body, content_type='text/x-opml')
+        response = api_client.post(reverse('rssfeedapi:feed_import'), data={'file': upload}, format='multipart')
+        assert response.status_code == 400
+        assert not ImportJob.objects.exists()
+
+    def test_import_of_another_user(self):
+        (user, other_user), (api_client, other_api_client) = _create_authorized_users(2)
+        upload = SimpleUploadedFile('export.opml', _opml(['https://feed.nl/rss']), content_type='text/x-opml')
+        with patch('rssfeedapi.views.schedule_new_feeds'):
+            response = api_client.post(reverse('rssfeedapi:feed_import'), data={'file': upload}, format='multipart')
+        assert other_api_client.get(response['Location']).status_code == 404
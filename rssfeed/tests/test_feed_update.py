@@ -1,14 +1,21 @@
+import json
+from importlib import import_module
 from unittest.mock import patch, MagicMock
 
 import feedparser
 import pytest
 import os
 
+from django.apps import apps
+from django.core.cache import cache
 from rest_framework.reverse import reverse
 
-from rssfeed.settings import MAXIMUM_RETRY
-from rssfeedapi.models import Feed
+from rssfeed.settings import MAXIMUM_RETRY, RETRY_BACKOFF
+from rssfeedapi.models import Feed, Entry
+from rssfeedapi.fetcher import FetchResult
+from rssfeedapi.tasks import acquire_update_lock, update_feeds_batch
 from rssfeedapi.utils import get_published_parsed
+from .utils import _mock_fetch_feed
 
 
 @pytest.mark.django_db
@@ -20,7 +27,9 @@ class TestFeedUpdate:
 
         url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
         d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             response = api_client.put(url)
             assert response.status_code == 200
             updated_feed = Feed.objects.get(id=feed.id)
@@ -43,7 +52,9 @@ class TestFeedUpdate:
         d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/NotValid.xml')
         mock_feedparser = MagicMock(return_value=d)
         mock_send_admin_email = MagicMock()
-        with patch('feedparser.parse', mock_feedparser):
+        with patch('feedparser.parse', mock_feedparser), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/NotValid.xml')):
             with patch('rssfeedapi.tasks.send_admin_email', mock_send_admin_email):
                 response = api_client.put(url)
                 assert response.status_code == 200
@@ -79,7 +90,9 @@ class TestFeedUpdate:
         mock_entries_update = MagicMock(return_value=[d.entries[0]])
         mock_send_admin_email = MagicMock()
 
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             with patch('rssfeedapi.models.Feed.update_entries', mock_entries_update):
                 with patch('rssfeedapi.tasks.send_admin_email', mock_send_admin_email):
                     response = api_client.put(url)
@@ -106,7 +119,9 @@ class TestFeedUpdate:
         mock_feed_update = MagicMock(side_effect=[[d.entries[0]], []])
         mock_send_admin_email = MagicMock()
 
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             with patch('rssfeedapi.models.Feed.update_entries', mock_feed_update):
                 with patch('rssfeedapi.tasks.send_admin_email', mock_send_admin_email):
                     response = api_client.put(url)
@@ -146,7 +161,9 @@ class TestFeedUpdate:
         feed.save()
 
         mock_create_entry = MagicMock()
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             with patch('rssfeedapi.models.Entry.get_or_create', mock_create_entry):
                 response = api_client.put(url)
                 assert response.status_code == 200
@@ -165,7 +182,9 @@ class TestFeedUpdate:
         feed.published_time = publish_parsed
         feed.save()
 
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             response = api_client.put(url)
             assert response.status_code == 200
             updated_feed = Feed.objects.get(id=feed.id)
@@ -177,3 +196,241 @@ class TestFeedUpdate:
             # Test all entries are created
             for entry in d.entries:
                 assert updated_feed.entries.filter(guid=entry.id).exists()
+
+    def test_conditional_fetch_not_modified(self, user, api_client, feed, celery_app):
+        # Set up in DB: user subscribes to feed, which was fetched before and returned validators
+        user.subscriptions.add(feed)
+        feed.etag = '"abc"'
+        feed.last_modified = 'Sat, 05 Nov 2022 19:25:36 GMT'
+        feed.save()
+
+        url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
+        mock_fetch_feed = MagicMock(return_value=FetchResult(url=feed.feed_url, status=304))
+        mock_feedparser = MagicMock()
+        mock_entries_update = MagicMock()
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed), patch('feedparser.parse', mock_feedparser):
+            with patch('rssfeedapi.models.Feed.update_entries', mock_entries_update):
+                response = api_client.put(url)
+                assert response.status_code == 200
+                # Test validators are sent along with the request
+                mock_fetch_feed.assert_called_once_with(feed.feed_url, etag=feed.etag, modified=feed.last_modified)
+                # Test '304 Not Modified' skips parsing and updating entries
+                assert mock_feedparser.call_count == 0
+                assert mock_entries_update.call_count == 0
+                updated_feed = Feed.objects.get(id=feed.id)
+                assert updated_feed.status == Feed.Status.UPDATED
+                assert updated_feed.published_time == feed.published_time
+                assert updated_feed.etag == feed.etag
+                assert updated_feed.last_updated > feed.last_updated
+
+    def test_store_validators(self, user, api_client, feed, celery_app):
+        user.subscriptions.add(feed)
+        url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
+        with open(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml', 'rb') as f:
+            fetch_result = FetchResult(url=feed.feed_url, status=200, body=f.read(),
+                                       headers={'content-type': 'application/rss+xml', 'etag': '"xyz"',
+                                                'last-modified': 'Sat, 05 Nov 2022 19:25:36 GMT'})
+        with patch('rssfeedapi.fetcher.fetch_feed', return_value=fetch_result):
+            response = api_client.put(url)
+            assert response.status_code == 200
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.etag == '"xyz"'
+            assert updated_feed.last_modified == 'Sat, 05 Nov 2022 19:25:36 GMT'
+
+    def test_skip_unchanged_body(self, user, api_client, feed, celery_app):
+        # Set up in DB: user subscribes to feed, whose server ignores conditional requests
+        user.subscriptions.add(feed)
+        url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
+        mock_fetch_feed = _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            api_client.put(url)
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.content_hash == mock_fetch_feed(feed.feed_url).content_hash
+
+            # Test the same body again skips parsing and updating entries
+            mock_feedparser = MagicMock()
+            mock_entries_update = MagicMock()
+            with patch('feedparser.parse', mock_feedparser), \
+                    patch('rssfeedapi.models.Feed.update_entries', mock_entries_update):
+                response = api_client.put(url)
+                assert response.status_code == 200
+                assert mock_feedparser.call_count == 0
+                assert mock_entries_update.call_count == 0
+                assert Feed.objects.get(id=feed.id).last_updated > updated_feed.last_updated
+
+            # Test a feed in Error state is parsed again even if its body is unchanged
+            Feed.objects.filter(id=feed.id).update(status=Feed.Status.ERROR)
+            with patch('rssfeedapi.models.Feed.update_entries', return_value=[]) as mock_entries_update:
+                api_client.put(url)
+                assert mock_entries_update.call_count == 1
+                assert Feed.objects.get(id=feed.id).status == Feed.Status.UPDATED
+
+    def test_update_entries_in_bulk(self, feed, django_assert_max_num_queries):
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        published_parsed = get_published_parsed(d.feed)
+        # Simulate the first entry is already in DB
+        Entry.get_or_create(parsed_entry=d.entries[0], feed_id=feed.id)
+        num_old_entries = feed.entries.count()
+
+        # One lookup of existing guids and one insert, instead of a lookup and an insert per entry
+        with django_assert_max_num_queries(4):
+            failed_entries_list = feed.update_entries(
+                parsed_entries_list=d.entries, published_parsed=published_parsed)
+        assert failed_entries_list == []
+        assert feed.entries.count() == num_old_entries + len(d.entries) - 1
+        for entry in d.entries:
+            assert feed.entries.filter(guid=entry.id).exists()
+
+    def test_update_edited_entries(self, feed, django_assert_num_queries):
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        feed.update_entries(parsed_entries_list=d.entries, published_parsed=None)
+
+        # Test unchanged entries are not written: one lookup only
+        cache.clear()
+        with django_assert_num_queries(1):
+            assert feed.update_entries(parsed_entries_list=d.entries, published_parsed=None) == []
+
+        # Test only edited entries are rewritten, in one bulk update
+        d.entries[0]['title'] = 'Edited title'
+        d.entries[1]['description'] = 'Edited description'
+        with patch('rssfeedapi.models.Entry.objects.bulk_update',
+                   wraps=Entry.objects.bulk_update) as mock_bulk_update:
+            assert feed.update_entries(parsed_entries_list=d.entries, published_parsed=None) == []
+        assert mock_bulk_update.call_count == 1
+        assert len(mock_bulk_update.call_args.args[0]) == 2
+        assert Entry.objects.get(guid=d.entries[0].id).title == 'Edited title'
+        assert Entry.objects.get(guid=d.entries[1].id).description == 'Edited description'
+        assert Entry.objects.get(guid=d.entries[2].id).title == d.entries[2].title
+
+    def test_hash_entries_stored_before_hashing(self, feed):
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        feed.update_entries(parsed_entries_list=d.entries, published_parsed=None)
+        Entry.objects.update(content_hash=None)
+
+        # Test the migration which adds the hash hashes stored entries as they were parsed: they are not rewritten
+        import_module('rssfeedapi.migrations.0010_entry_content_hash').set_content_hashes(apps, None)
+        cache.clear()
+        with patch('rssfeedapi.models.Entry.objects.bulk_update') as mock_bulk_update:
+            assert feed.update_entries(parsed_entries_list=d.entries, published_parsed=None) == []
+        assert mock_bulk_update.call_count == 0
+
+    def test_update_edited_entry_of_same_feed_version(self, user, api_client, feed, celery_app):
+        user.subscriptions.add(feed)
+        feed_file = os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml'
+        with open(feed_file, 'rb') as f:
+            body = f.read()
+        d = feedparser.parse(body)
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(feed_file)):
+            api_client.put(reverse("rssfeedapi:feed_detail", args=[feed.id]))
+        assert Feed.objects.get(id=feed.id).published_time == get_published_parsed(d.feed)
+
+        # Test an entry edited without the feed publishing again is updated: its body changed
+        edited_body = body.replace(d.entries[0].title.encode(), b'Edited title', 1)
+        result = FetchResult(url=feed.feed_url, status=200, body=edited_body, headers={})
+        with patch('rssfeedapi.fetcher.fetch_feed', return_value=result):
+            api_client.put(reverse("rssfeedapi:feed_detail", args=[feed.id]))
+        assert Entry.objects.get(guid=d.entries[0].id).title == 'Edited title'
+
+    def test_known_entries_skip_database(self, feed, django_assert_num_queries,
+                                         django_capture_on_commit_callbacks):
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        with django_capture_on_commit_callbacks(execute=True):
+            feed.update_entries(parsed_entries_list=d.entries, published_parsed=None)
+
+        # Test known and unchanged entries are skipped without any query
+        with django_assert_num_queries(0):
+            assert feed.update_entries(parsed_entries_list=d.entries, published_parsed=None) == []
+
+        # Test only a new entry and an edited one are looked up
+        new_entry = feedparser.FeedParserDict({**d.entries[0], 'id': 'https://feed.nl/new', 'link': ''})
+        d.entries[1]['title'] = 'Edited title'
+        with patch('rssfeedapi.models.Feed._bulk_create_entries', wraps=feed._bulk_create_entries) as mock_create, \
+                django_capture_on_commit_callbacks(execute=True):
+            feed.update_entries(parsed_entries_list=d.entries + [new_entry], published_parsed=None)
+        assert [entry['id'] for entry in mock_create.call_args.args[0]] == [d.entries[1].id, 'https://feed.nl/new']
+        assert Entry.objects.get(guid=d.entries[1].id).title == 'Edited title'
+        assert Entry.objects.filter(guid='https://feed.nl/new', feed=feed).exists()
+
+        # Test failed entries are not remembered, so that they are looked up again
+        failed_entry = feedparser.FeedParserDict({**d.entries[0], 'id': 'https://feed.nl/failed'})
+        with patch('rssfeedapi.models.Feed._bulk_create_entries', return_value=[failed_entry]):
+            feed.update_entries(parsed_entries_list=[failed_entry], published_parsed=None)
+        assert Feed.get_entry_digests(failed_entry)[0] not in feed.get_known_entries()
+
+        # Test entries of a transaction which is rolled back are not remembered
+        rolled_back_entry = feedparser.FeedParserDict({**d.entries[0], 'id': 'https://feed.nl/rolled-back'})
+        with django_capture_on_commit_callbacks(execute=False) as callbacks:
+            feed.update_entries(parsed_entries_list=[rolled_back_entry], published_parsed=None)
+        assert len(callbacks) == 1
+        assert Feed.get_entry_digests(rolled_back_entry)[0] not in feed.get_known_entries()
+
+    def test_failed_entries_retried_later(self, user, api_client, feed, celery_app):
+        user.subscriptions.add(feed)
+        url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
+        d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        mock_retry_entries = MagicMock()
+
+        with patch('rssfeedapi.fetcher.fetch_feed',
+                   _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')), \
+                patch('rssfeedapi.models.Feed.update_entries', return_value=[d.entries[0]]), \
+                patch('rssfeedapi.tasks.update_failed_entries.apply_async', mock_retry_entries):
+            response = api_client.put(url)
+            assert response.status_code == 200
+            # Test the feed is updated without waiting for the failed entry
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.status == Feed.Status.UPDATED
+            # Test the failed entry is retried later in a separate task, with a payload which can be sent as json
+            mock_retry_entries.assert_called_once()
+            feed_url, entries, attempt = mock_retry_entries.call_args.kwargs['args']
+            assert feed_url == feed.feed_url and attempt == 1
+            assert json.loads(json.dumps(entries))[0]['id'] == d.entries[0]['id']
+            assert mock_retry_entries.call_args.kwargs['countdown'] > 0
+
+    def test_retry_backoff(self, feed):
+        # Test the delay doubles with every failed update, with jitter of half of the delay
+        for failed_updates in range(1, 5):
+            countdown = feed.record_failed_update()
+            backoff = RETRY_BACKOFF * 2 ** (failed_updates - 1)
+            assert backoff / 2 <= countdown <= backoff
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.failed_updates == failed_updates
+            assert updated_feed.next_poll_at == feed.next_poll_at
+
+        # Test a successful update resets the backoff
+        feed.update_status(feed_status=Feed.Status.UPDATED, published_parsed=None)
+        assert Feed.objects.get(id=feed.id).failed_updates == 0
+
+    def test_single_flight_update(self, user, api_client, feed, celery_app):
+        # Set up in DB: user subscribe to feed, an update of the feed is already queued
+        user.subscriptions.add(feed)
+        assert acquire_update_lock(feed.feed_url)
+
+        url = reverse("rssfeedapi:feed_detail",  args=[feed.id])
+        mock_fetch_feed = MagicMock(side_effect=_mock_fetch_feed(
+            os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml'))
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed), \
+                patch('rssfeedapi.fetcher.fetch_feeds') as mock_fetch_feeds:
+            # Test a duplicate request returns immediately without fetching the feed again
+            response = api_client.put(url)
+            assert response.status_code == 200
+            assert 'already' in response.data
+            assert mock_fetch_feed.call_count == 0
+
+            # Test the periodic update skips the feed too
+            mock_fetch_feeds.return_value = []
+            update_feeds_batch(feed_urls=[feed.feed_url])
+            assert mock_fetch_feeds.call_args.args[0] == []
+
+        # Test the lock is released once the update is done, so the next request updates the feed
+        cache.clear()
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            for _ in range(2):
+                response = api_client.put(url)
+                assert 'already' not in response.data
+            assert mock_fetch_feed.call_count == 2
+
+    def test_lock_of_deleted_feed_released(self, celery_app):
+        # Test a feed deleted after its batch was dispatched does not keep its lock until it expires
+        with patch('rssfeedapi.fetcher.fetch_feeds', return_value=[]):
+            update_feeds_batch(feed_urls=['https://deleted.nl/rss'])
+        assert acquire_update_lock('https://deleted.nl/rss')
@@ -1,10 +1,19 @@
+import datetime
+import json
 import os
 from unittest.mock import patch, MagicMock
 
 import feedparser
 import pytest
-from rssfeedapi.tasks import update_active_feeds
-from .utils import _create_authorized_users, _create_feeds_in_db
+from celery.exceptions import Retry
+from django.db import OperationalError
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+from rssfeed.settings import HOST_DELAY, EMPTY_POLL_BACKOFF, MAX_UPDATE_INTERVAL, POLL_JITTER, \
+    SCHEDULER_INTERVAL, FEED_UPDATE_LOCK_TIMEOUT
+from rssfeedapi.tasks import update_active_feeds, batch_feeds_by_host, update_feeds_batch, ingest_feeds, \
+    get_due_feeds, iter_due_feed_urls, acquire_update_lock
+from .utils import _create_authorized_users, _create_feeds_in_db, _mock_fetch_feed
 from rssfeedapi.models import Feed
 from rssfeedapi.utils import get_published_parsed
 
@@ -23,7 +32,11 @@ class TestFeedUpdatePeriodic:
         published_parsed1 = get_published_parsed(d1.feed)
         published_parsed2 = get_published_parsed(d2.feed)
         mock_feedparser = MagicMock(side_effect=[d1, d2])
-        with patch('feedparser.parse', mock_feedparser):
+        mock_fetch_feed = _mock_fetch_feed({
+            feeds[0].feed_url: os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml',
+            feeds[1].feed_url: os.path.dirname(os.path.realpath(__file__)) + '/tweakers.mixed.xml',
+        })
+        with patch('feedparser.parse', mock_feedparser), patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
             # Both feed0 and feed1 will be updated
             update_active_feeds.apply()
 
@@ -57,8 +70,9 @@ class TestFeedUpdatePeriodic:
 
         d = feedparser.parse(valid_url)
         published_parsed = get_published_parsed(d.feed)
-        # Both feed0 and feed1 will be updated
-        update_active_feeds.apply()
+        # Both feed0 and feed1 will be updated, but feed1 cannot be downloaded
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed({valid_url: valid_url})):
+            update_active_feeds.apply()
 
         # Test feed0 has been updated successfully
         updated_feed = Feed.objects.get(id=feeds[0].id)
@@ -81,7 +95,9 @@ class TestFeedUpdatePeriodic:
         users[0].subscriptions.add(feeds[0])
 
         d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             update_active_feeds.apply()
             published_parsed = get_published_parsed(d.feed)
             # No one subscribes to feed1. Skip periodic updating it
@@ -101,7 +117,9 @@ class TestFeedUpdatePeriodic:
         feed.save()
 
         d = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
-        with patch('feedparser.parse', return_value=d):
+        with patch('feedparser.parse', return_value=d), \
+                patch('rssfeedapi.fetcher.fetch_feed',
+                      _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')):
             update_active_feeds.apply()
             published_parsed = get_published_parsed(d.feed)
             updated_feed = Feed.objects.get(id=feed.id)
@@ -110,4 +128,210 @@ class TestFeedUpdatePeriodic:
             assert updated_feed.last_updated == feed.last_updated
             assert updated_feed.status == feed.status
 
+    def test_batch_feeds_by_host(self):
+        feed_urls = ['https://a.nl/1', 'https://b.nl/1', 'https://a.nl/2', 'https://c.nl/1', 'https://b.nl/2',
+                     'https://c.nl/2', 'https://c.nl/3', 'https://c.nl/4', 'https://c.nl/5']
+        batches = list(batch_feeds_by_host(feed_urls, batch_size=4))
+        # Test feeds of the same host are in the same batch, and no batch is larger than the batch size
+        assert batches[0] == (['https://a.nl/1', 'https://a.nl/2', 'https://b.nl/1', 'https://b.nl/2'], 0)
+        # Test a host with more feeds than the batch size is split into delayed batches, which come after its
+        # first batch and wait until its requests spaced by the host delay are done
+        assert batches[1] == (['https://c.nl/1', 'https://c.nl/2', 'https://c.nl/3', 'https://c.nl/4'], 0)
+        assert batches[2] == (['https://c.nl/5'], pytest.approx(4 * HOST_DELAY))
+
+    def test_only_update_due_feed(self, celery_app):
+        # Setup in DB. Both feeds are subscribed, feed1 is not due to update yet
+        users, clients = _create_authorized_users(1)
+        feeds = _create_feeds_in_db(2)
+        users[0].subscriptions.add(feeds[0], feeds[1])
+        feeds[1].next_poll_at = timezone.now() + datetime.timedelta(minutes=10)
+        feeds[1].save()
+
+        mock_fetch_feed = _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            update_active_feeds.apply()
+            mock_fetch_feed.assert_called_once()
+            assert mock_fetch_feed.call_args.args[0] == feeds[0].feed_url
+            # Test feed0 is rescheduled after the update
+            updated_feed = Feed.objects.get(id=feeds[0].id)
+            assert updated_feed.next_poll_at > timezone.now()
+            assert updated_feed.empty_polls == 0
+
+    def test_adaptive_poll_interval(self, feed):
+        # Setup in DB: feed published an entry every hour until now
+        now = timezone.now()
+        for i, entry in enumerate(feed.entries.all()):
+            entry.published_time = now - datetime.timedelta(hours=i)
+            entry.save()
+
+        # Test the interval follows the publish cadence of the feed
+        feed.schedule_next_poll(has_new_entries=True)
+        assert feed.poll_interval == pytest.approx(3600, rel=0.01)
+        assert feed.empty_polls == 0
+
+        # Test the interval grows with every update which finds nothing new
+        feed.schedule_next_poll(has_new_entries=False)
+        feed.schedule_next_poll(has_new_entries=False)
+        assert feed.empty_polls == 2
+        assert feed.poll_interval == pytest.approx(3600 * EMPTY_POLL_BACKOFF ** 2, rel=0.01)
+        updated_feed = Feed.objects.get(id=feed.id)
+        assert updated_feed.poll_interval == feed.poll_interval
+        assert updated_feed.next_poll_at == feed.next_poll_at
+
+        # Test the interval stays within the bounds
+        for _ in range(20):
+            feed.schedule_next_poll(has_new_entries=False)
+        assert feed.poll_interval == MAX_UPDATE_INTERVAL
+
+    def test_spread_poll_slots(self):
+        interval = 3600
+        now = timezone.now()
+        slots = [Feed(id=i).get_poll_slot(interval) for i in range(1, 101)]
+
+        # Test the next update is at least half an interval away and at most one and a half
+        for slot in slots:
+            assert interval * (0.5 - POLL_JITTER) <= (slot - now).total_seconds() <= interval * (1.5 + POLL_JITTER) + 1
+        # Test updates of feeds are spread evenly over the interval: every tenth of the interval gets some of them
+        phases = {int((slot.timestamp() % interval) / interval * 10) for slot in slots}
+        assert len(phases) == 10
+
+    def test_due_feeds_read_in_chunks(self):
+        users, clients = _create_authorized_users(1)
+        feeds = _create_feeds_in_db(5)
+        users[0].subscriptions.add(*feeds)
+        now = timezone.now()
+        # Feeds 1 and 2 are due at the same time, which a chunk ends in the middle of
+        minutes_overdue = [1, 3, 3, 2, 4]
+        for feed, minutes in zip(feeds, minutes_overdue):
+            Feed.objects.filter(id=feed.id).update(
+                feed_url=f'https://feed{feed.id}.nl/rss', next_poll_at=now - datetime.timedelta(minutes=minutes))
+
+        # Test due feeds are read chunk by chunk, the most overdue first, each of them once
+        chunks = list(iter_due_feed_urls(get_due_feeds(), 2))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        expected_order = [feeds[i] for i in (4, 1, 2, 3, 0)]
+        assert sum(chunks, []) == [f'https://feed{feed.id}.nl/rss' for feed in expected_order]
+
+    def test_stagger_dispatch(self, celery_app):
+        users, clients = _create_authorized_users(1)
+        feeds = _create_feeds_in_db(4)
+        for i, feed in enumerate(feeds):
+            feed.feed_url = f'https://feed{i}.nl/rss'
+            feed.save()
+        users[0].subscriptions.add(*feeds)
+
+        mock_update_feeds_batch = MagicMock()
+        with patch('rssfeedapi.tasks.FETCH_BATCH_SIZE', 1), \
+                patch('rssfeedapi.tasks.update_feeds_batch.s', mock_update_feeds_batch), \
+                patch('rssfeedapi.tasks.group'):
+            update_active_feeds.apply()
+        # Test the batches are dispatched evenly over the scheduler interval
+        countdowns = sorted(
+            call.kwargs['countdown'] for call in mock_update_feeds_batch.return_value.set.call_args_list)
+        assert countdowns == [pytest.approx(SCHEDULER_INTERVAL * i / 4) for i in range(4)]
+
+    def test_dispatched_feeds_not_dispatched_again(self, celery_app):
+        users, clients = _create_authorized_users(1)
+        feeds = _create_feeds_in_db(2)
+        users[0].subscriptions.add(*feeds)
+
+        mock_update_feeds_batch = MagicMock()
+        with patch('rssfeedapi.tasks.update_feeds_batch.s', mock_update_feeds_batch), \
+                patch('rssfeedapi.tasks.group'):
+            update_active_feeds.apply()
+            # Test feeds whose update is not done yet are not due at the next run
+            assert not get_due_feeds().exists()
+            update_active_feeds.apply()
+        assert mock_update_feeds_batch.call_count == 1
+        for feed in Feed.objects.filter(id__in=[feed.id for feed in feeds]):
+            assert feed.next_poll_at > timezone.now() + datetime.timedelta(seconds=FEED_UPDATE_LOCK_TIMEOUT - 60)
+
+        # Test the update schedules the real next poll once it is done
+        postponed_poll_at = Feed.objects.get(id=feeds[0].id).next_poll_at
+        mock_fetch_feed = _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            update_feeds_batch([feeds[0].feed_url])
+        updated_feed = Feed.objects.get(id=feeds[0].id)
+        assert updated_feed.next_poll_at != postponed_poll_at
+        assert updated_feed.next_poll_at <= timezone.now() + datetime.timedelta(seconds=2 * updated_feed.poll_interval)
+
+    def test_throttled_feeds_postponed(self, celery_app):
+        users, clients = _create_authorized_users(1)
+        feed, = _create_feeds_in_db(1)
+        users[0].subscriptions.add(feed)
+        Feed.objects.filter(id=feed.id).update(next_poll_at=timezone.now())
+
+        mock_deferred_batch = MagicMock()
+        with patch('rssfeedapi.fetcher.fetch_feed', side_effect=Throttled(wait=300)), \
+                patch('rssfeedapi.tasks.update_feeds_batch.apply_async', mock_deferred_batch):
+            update_feeds_batch([feed.feed_url])
+        # Test the feed is deferred as a new batch, and the scheduler does not update it before then
+        assert mock_deferred_batch.call_args.kwargs == {'args': ([feed.feed_url],), 'countdown': 300}
+        assert not get_due_feeds().exists()
+        assert Feed.objects.get(id=feed.id).next_poll_at > timezone.now() + datetime.timedelta(seconds=300)
+
+    def test_unexpected_error_fails_one_feed_only(self, celery_app):
+        feeds = _create_feeds_in_db(2)
+        feed_urls = [f'https://feed{i}.nl/rss' for i in range(2)]
+        for feed, feed_url in zip(feeds, feed_urls):
+            Feed.objects.filter(id=feed.id).update(feed_url=feed_url)
+
+        mock_fetch_feed = _mock_fetch_feed(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        ingest_feed = MagicMock(side_effect=[OperationalError('database is locked'), None])
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed), patch('rssfeedapi.tasks.ingest_feed', ingest_feed):
+            update_feeds_batch(feed_urls)
+        # Test the other feeds of the batch are still stored, and no feed keeps its lock
+        assert ingest_feed.call_count == 2
+        assert all(acquire_update_lock(feed_url) for feed_url in feed_urls)
+
+    def test_aborted_batch_releases_locks(self, celery_app):
+        feed, = _create_feeds_in_db(1)
+        with patch('rssfeedapi.fetcher.fetch_feeds', side_effect=RuntimeError('event loop failed')), \
+                pytest.raises(RuntimeError):
+            update_feeds_batch([feed.feed_url])
+        assert acquire_update_lock(feed.feed_url)
+
+    def test_single_writer_ingest(self, celery_app):
+        # Setup in DB. user0 subscribes feed0, user1 subscribes feed1
+        users, clients = _create_authorized_users(2)
+        feeds = _create_feeds_in_db(2)
+        users[0].subscriptions.add(feeds[0])
+        users[1].subscriptions.add(feeds[1])
+
+        d1 = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml')
+        d2 = feedparser.parse(os.path.dirname(os.path.realpath(__file__)) + '/tweakers.mixed.xml')
+        mock_fetch_feed = _mock_fetch_feed({
+            feeds[0].feed_url: os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml',
+            feeds[1].feed_url: os.path.dirname(os.path.realpath(__file__)) + '/tweakers.mixed.xml',
+        })
+        mock_ingest = MagicMock()
+        with patch('rssfeedapi.tasks.SINGLE_WRITER_INGEST', True), \
+                patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed), \
+                patch('rssfeedapi.tasks.ingest_feeds.apply_async', mock_ingest):
+            update_feeds_batch([feed.feed_url for feed in feeds])
+
+        # Test parsed feeds of the batch are sent together to the ingest queue as json, without being stored
+        assert mock_ingest.call_count == 1
+        assert mock_ingest.call_args.kwargs['queue'] == 'ingest'
+        payloads = json.loads(json.dumps(mock_ingest.call_args.kwargs['args'][0]))
+        assert [payload['feed_url'] for payload in payloads] == [feed.feed_url for feed in feeds]
+        assert Feed.objects.get(id=feeds[0].id).published_time == feeds[0].published_time
+        assert not Feed.objects.get(id=feeds[0].id).entries.filter(guid=d1.entries[0].id).exists()
+
+        # Test the writer stores all of them
+        ingest_feeds(payloads)
+        for feed, d in zip(feeds, [d1, d2]):
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.status == Feed.Status.UPDATED
+            assert updated_feed.published_time == get_published_parsed(d.feed)
+            for entry in d.entries:
+                assert updated_feed.entries.filter(guid=entry.id).exists()
 
+    def test_ingest_retried_when_database_is_locked(self, celery_app):
+        feed, = _create_feeds_in_db(1)
+        payload = {'feed_url': feed.feed_url}
+        with patch('rssfeedapi.tasks.ingest_feed', side_effect=OperationalError('database is locked')), \
+                patch('rssfeedapi.tasks.ingest_feeds.retry', side_effect=Retry()) as mock_retry:
+            with pytest.raises(Retry):
+                ingest_feeds([payload])
+        assert mock_retry.call_args.kwargs['countdown'] > 0
@@ -1,6 +1,7 @@
 import pytest
 from rest_framework.reverse import reverse
 
+from rssfeedapi.models import Feed
 from .utils import _create_authorized_users, _create_feeds_in_db
 
 
@@ -78,6 +79,29 @@ class TestFeedView:
         assert response.status_code == 200
 
 
+    def test_subscriber_count(self):
+        users, clients = _create_authorized_users(3)
+        feeds = _create_feeds_in_db(2)
+
+        # Test subscribing through the API and directly in DB both count the subscribers
+        url = reverse("rssfeedapi:feed_list")
+        response = clients[0].post(url, data={"feed_url": feeds[0].feed_url})
+        assert response.status_code == 201
+        users[1].subscriptions.add(feeds[0], feeds[1])
+        feeds[1].subscribers.add(users[2])
+        assert Feed.objects.get(id=feeds[0].id).subscriber_count == 2
+        assert Feed.objects.get(id=feeds[1].id).subscriber_count == 2
+
+        # Test unsubscribing through the API and directly in DB
+        response = clients[0].delete(reverse("rssfeedapi:feed_detail", args=[feeds[0].id]))
+        assert response.status_code == 204
+        users[1].subscriptions.clear()
+        assert Feed.objects.get(id=feeds[0].id).subscriber_count == 0
+        assert Feed.objects.get(id=feeds[1].id).subscriber_count == 1
+        users[2].delete()
+        assert Feed.objects.get(id=feeds[1].id).subscriber_count == 0
+
+
 @pytest.mark.django_db
 class TestEntryView:
     def test_get_entries(self):
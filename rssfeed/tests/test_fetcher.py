@@ -0,0 +1,178 @@
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+import requests
+from django.core.cache import cache
+
+from rest_framework.exceptions import ValidationError, Throttled
+
+from rssfeed.settings import FETCH_POOL_CONNECTIONS, CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_OPEN_SECONDS, \
+    HOST_CONCURRENCY
+from rssfeedapi.fetcher import fetch_feeds, FetchResult, get_session, fetch_feed, get_host_key
+
+
+class TestFetchFeeds:
+    def test_fetch_feeds_concurrently(self):
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def fetch_feed(feed_url, **kwargs):
+            with lock:
+                in_flight.append(feed_url)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(feed_url)
+            if feed_url.endswith('/error'):
+                raise ValidationError('Failed to fetch feed')
+            return FetchResult(url=feed_url, status=200, body=feed_url.encode())
+
+        feeds = [(f'https://feed{i}.nl/rss', {'etag': None, 'modified': None}) for i in range(10)]
+        feeds.append(('https://feed.nl/error', {'etag': None, 'modified': None}))
+        with patch('rssfeedapi.fetcher.fetch_feed', side_effect=fetch_feed):
+            results = fetch_feeds(feeds, concurrency=4)
+
+        # Test downloads run concurrently, but never more than the given concurrency
+        assert 1 < max(max_in_flight) <= 4
+        # Test results keep the order of the feeds, and a failed download does not fail the batch
+        assert [result.url for result in results] == [feed_url for feed_url, _ in feeds]
+        assert all(result.body == result.url.encode() for result in results[:-1])
+        assert isinstance(results[-1].error, ValidationError)
+
+    def test_shared_session(self):
+        # Test all downloads of a worker share one session, which keeps connections per host alive
+        session = get_session()
+        assert get_session() is session
+        adapter = session.get_adapter('https://feeds.example.com/rss')
+        assert adapter is session.get_adapter('https://other.example.com/atom')
+        assert adapter._pool_maxsize == FETCH_POOL_CONNECTIONS
+        assert 'gzip' in session.headers['Accept-Encoding']
+
+    def test_host_politeness(self):
+        starts = {}
+
+        def fetch_feed(feed_url, **kwargs):
+            starts[feed_url] = time.monotonic()
+            if feed_url == 'https://limited.nl/0':
+                raise Throttled(wait=120)
+            return FetchResult(url=feed_url, status=200)
+
+        feeds = [(f'https://polite.nl/{i}', {}) for i in range(3)] + [(f'https://limited.nl/{i}', {}) for i in range(3)]
+        started = time.monotonic()
+        with patch('rssfeedapi.fetcher.fetch_feed', side_effect=fetch_feed):
+            results = fetch_feeds(feeds, concurrency=4, host_concurrency=1, host_delay=0.1)
+
+        # Test requests to the same host are spaced by the minimum delay. Threads may start requests late, never early
+        polite_starts = sorted(start for url, start in starts.items() if 'polite' in url)
+        assert all(start - started >= i * 0.1 - 0.01 for i, start in enumerate(polite_starts))
+        assert all(result.status == 200 for result in results[:3])
+        # Test once a host asks to retry later, its other feeds are deferred without being requested
+        assert list(starts).count('https://limited.nl/0') == 1
+        assert 'https://limited.nl/1' not in starts and 'https://limited.nl/2' not in starts
+        assert all(isinstance(result.error, Throttled) and result.error.wait > 100 for result in results[3:])
+
+
+@patch('rssfeedapi.fetcher.HOST_DELAY', 0)
+class TestCircuitBreaker:
+    def _response(self, status_code=200):
+        response = MagicMock(status_code=status_code, url='https://down.nl/rss', headers={}, history=[])
+        response.iter_content.return_value = iter([b'<rss/>'])
+        response.raise_for_status.side_effect = requests.HTTPError() if status_code >= 400 else None
+        response.__enter__.return_value = response
+        return response
+
+    def test_circuit_opens_and_recovers(self):
+        with patch('rssfeedapi.fetcher.get_session') as mock_session, patch('rssfeedapi.fetcher.time') as mock_time:
+            mock_get = mock_session.return_value.get
+            mock_time.time.return_value = 1000
+            mock_get.side_effect = requests.ConnectionError()
+            for _ in range(CIRCUIT_BREAKER_FAILURES):
+                with pytest.raises(ValidationError):
+                    fetch_feed('https://down.nl/rss')
+
+            # Test the feeds of the host fail fast and are deferred, without any request
+            with pytest.raises(Throttled) as e:
+                fetch_feed('https://down.nl/other')
+            assert e.value.wait == CIRCUIT_BREAKER_OPEN_SECONDS
+            assert mock_get.call_count == CIRCUIT_BREAKER_FAILURES
+            # Test other hosts are not affected
+            mock_get.side_effect = None
+            mock_get.return_value = self._response()
+            assert fetch_feed('https://up.nl/rss').status == 200
+
+            # Test a failed probe opens the circuit again
+            mock_time.time.return_value += CIRCUIT_BREAKER_OPEN_SECONDS
+            mock_get.return_value = self._response(502)
+            with pytest.raises(ValidationError):
+                fetch_feed('https://down.nl/rss')
+            with pytest.raises(Throttled):
+                fetch_feed('https://down.nl/rss')
+
+            # Test a successful probe closes the circuit
+            mock_time.time.return_value += CIRCUIT_BREAKER_OPEN_SECONDS
+            mock_get.return_value = self._response()
+            assert fetch_feed('https://down.nl/rss').status == 200
+            mock_get.return_value = self._response()
+            assert fetch_feed('https://down.nl/other').status == 200
+
+    def test_client_errors_do_not_open_circuit(self):
+        with patch('rssfeedapi.fetcher.get_session') as mock_session:
+            for _ in range(CIRCUIT_BREAKER_FAILURES + 1):
+                mock_session.return_value.get.return_value = self._response(404)
+                with pytest.raises(ValidationError):
+                    fetch_feed('https://feed.nl/missing')
+            assert mock_session.return_value.get.call_count == CIRCUIT_BREAKER_FAILURES + 1
+
+
+class TestSharedHostLimits:
+    def _response(self, status_code=200, headers=None):
+        response = MagicMock(status_code=status_code, url='https://feed.nl/rss', headers=headers or {}, history=[])
+        response.iter_content.return_value = iter([b'<rss/>'])
+        response.__enter__.return_value = response
+        return response
+
+    def test_retry_after_shared(self):
+        with patch('rssfeedapi.fetcher.get_session') as mock_session:
+            mock_get = mock_session.return_value.get
+            mock_get.return_value = self._response(429, {'Retry-After': '120'})
+            with pytest.raises(Throttled):
+                fetch_feed('https://feed.nl/0')
+            # Test another download of the host, e.g. of another worker, is deferred without any request
+            mock_get.return_value = self._response()
+            with pytest.raises(Throttled) as e:
+                fetch_feed('https://feed.nl/1')
+            assert 100 < e.value.wait <= 120
+            assert mock_get.call_count == 1
+            assert fetch_feed('https://other.nl/rss').status == 200
+
+    def test_concurrency_shared(self):
+        # Setup: other workers download all feeds of the host they may download at once
+        slot_keys = [get_host_key('feed.nl', f'slot{i}') for i in range(HOST_CONCURRENCY)]
+        cache.set_many({key: 1 for key in slot_keys})
+        with patch('rssfeedapi.fetcher.get_session') as mock_session, \
+                patch('rssfeedapi.fetcher.FETCH_TIMEOUT', 0.2), patch('rssfeedapi.fetcher.HOST_DELAY', 0):
+            mock_session.return_value.get.return_value = self._response()
+            # Test the download waits for a slot, and is deferred once it waited too long
+            with pytest.raises(Throttled):
+                fetch_feed('https://feed.nl/rss')
+            assert mock_session.return_value.get.call_count == 0
+            # Test a slot freed by another worker is taken, and freed again once the download is done
+            cache.delete(slot_keys[0])
+            assert fetch_feed('https://feed.nl/rss').status == 200
+            assert not cache.get(slot_keys[0])
+
+    def test_delay_shared(self):
+        starts = []
+        with patch('rssfeedapi.fetcher.get_session') as mock_session, patch('rssfeedapi.fetcher.HOST_DELAY', 0.2):
+            def get(*args, **kwargs):
+                starts.append(time.monotonic())
+                return self._response()
+
+            mock_session.return_value.get.side_effect = get
+            # Test downloads of the host, e.g. by different workers, start one per delay at most
+            for i in range(3):
+                fetch_feed(f'https://feed.nl/{i}')
+        assert starts[-1] - starts[0] >= 0.19
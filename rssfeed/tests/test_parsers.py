@@ -0,0 +1,163 @@
+import inspect
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest.mock import patch, MagicMock
+
+import feedparser
+import pytest
+from rest_framework.exceptions import ValidationError
+
+from rssfeedapi.fetcher import FetchResult, read_body
+from rssfeedapi.parsers import parse_stream, parse_fast
+from rssfeedapi.utils import get_published_parsed, normalize_entry
+
+
+def _rss(num_items, days_apart=0.0):
+    now = datetime.now(timezone.utc)
+    items = ''.join(
+        f'<item><title>Item {i}</title><link>https://feed.nl/{i}</link><guid>https://feed.nl/{i}</guid>'
+        f'<description>&lt;p onclick="x"&gt;Text {i}&lt;/p&gt;</description>'
+        f'<pubDate>{format_datetime(now - timedelta(days=i * days_apart))}</pubDate></item>'
+        for i in range(num_items))
+    return (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Feed</title>'
+            f'<link>https://feed.nl</link><language>nl</language><pubDate>{format_datetime(now)}</pubDate>'
+            f'{items}</channel></rss>').encode()
+
+
+class TestParseStream:
+    def test_parse_stream(self):
+        d = parse_stream(_rss(3))
+        assert not d.bozo
+        assert d.feed.title == 'Feed' and d.feed.link == 'https://feed.nl' and d.feed.language == 'nl'
+        assert get_published_parsed(d.feed) is not None
+        # Test entries are parsed lazily, with the same keys feedparser returns
+        assert inspect.isgenerator(d.entries)
+        entries = list(d.entries)
+        assert [entry.id for entry in entries] == [f'https://feed.nl/{i}' for i in range(3)]
+        assert entries[0].title == 'Item 0' and entries[0].link == 'https://feed.nl/0'
+        assert entries[0].description == '<p>Text 0</p>'
+        assert get_published_parsed(entries[0]) is not None
+
+    def test_parse_atom(self):
+        body = b'''<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">
+            <title>Feed</title><link rel="self" href="https://feed.nl/atom"/><link href="https://feed.nl"/>
+            <updated>2022-11-05T19:25:36Z</updated>
+            <entry><id>urn:1</id><title>Entry</title><link href="https://feed.nl/1"/>
+            <author><name>Author</name><email>a@feed.nl</email></author>
+            <content type="html">&lt;b&gt;Content&lt;/b&gt;</content><updated>2022-11-05T19:25:36Z</updated></entry>
+            </feed>'''
+        d = parse_stream(body, days_retrievable=100000)
+        assert d.feed.title == 'Feed' and d.feed.link == 'https://feed.nl'
+        entry, = list(d.entries)
+        assert entry.id == 'urn:1' and entry.link == 'https://feed.nl/1' and entry.author == 'Author'
+        assert entry.description == '<b>Content</b>'
+
+    def test_stop_conditions(self):
+        # Test parsing stops at the item cap
+        assert len(list(parse_stream(_rss(50), max_entries=10).entries)) == 10
+        # Test parsing stops at the first entry older than the retrievable days
+        assert len(list(parse_stream(_rss(50, days_apart=1), days_retrievable=6.5).entries)) == 7
+
+    def test_parse_errors(self):
+        assert parse_stream(b'<html><body>Not a feed').bozo
+        # Test a well-formed document without a channel or Atom feed is not a valid feed
+        assert parse_stream(b'<html><body><p>Not a feed</p></body></html>').bozo
+        # Test entries before a parse error are still returned
+        entries = parse_stream(_rss(3)[:-40]).entries
+        assert next(entries).id == 'https://feed.nl/0'
+        with pytest.raises(ValidationError):
+            list(entries)
+
+    def test_large_feeds_parsed_incrementally(self):
+        result = FetchResult(url='https://feed.nl/rss', status=200, body=_rss(3), headers={})
+        with patch('rssfeedapi.parsers.STREAM_PARSE_MIN_BYTES', 0):
+            assert inspect.isgenerator(result.parse().entries)
+        assert isinstance(result.parse().entries, list)
+
+    def test_large_documents_of_other_formats(self):
+        rdf = b'''<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/">
+            <channel><title>Feed</title><link>https://feed.nl</link></channel>
+            <item><title>Item</title><link>https://feed.nl/1</link></item></rdf:RDF>'''
+        # Test large feeds which are not RSS 2.0 or Atom, and other documents, are not parsed incrementally
+        with patch('rssfeedapi.parsers.STREAM_PARSE_MIN_BYTES', 0):
+            d = FetchResult(url='https://feed.nl/rss', status=200, body=rdf, headers={}).parse()
+            assert d.feed.title == 'Feed' and [entry.link for entry in d.entries] == ['https://feed.nl/1']
+            with patch('feedparser.parse') as mock_feedparser:
+                body = b'<html><body><p>Not a feed</p></body></html>'
+                FetchResult(url='https://feed.nl/rss', status=200, body=body, headers={}).parse()
+                assert mock_feedparser.call_count == 1
+
+    def test_relative_links(self):
+        body = _rss(1).replace(b'https://feed.nl/0</link>', b'/0</link>')
+        body = body.replace(b'https://feed.nl</link>', b'/</link>')
+        d = parse_stream(body, base_url='https://feed.nl/rss')
+        # Test relative links are resolved against the feed url, as feedparser does
+        assert d.feed.link == 'https://feed.nl/'
+        assert [entry.link for entry in d.entries] == ['https://feed.nl/0']
+
+
+class TestParseFast:
+    @pytest.mark.parametrize('file_name', ['nu.nl.rss.xml', 'tweakers.mixed.xml'])
+    def test_same_as_feedparser(self, file_name):
+        with open(os.path.dirname(os.path.realpath(__file__)) + '/' + file_name, 'rb') as f:
+            body = f.read()
+        with patch('feedparser.parse') as mock_feedparser:
+            d = parse_fast(body, base_url='https://feed.nl/rss')
+            assert mock_feedparser.call_count == 0
+
+        # Test all stored fields are the same as parsed by feedparser
+        expected = feedparser.parse(body)
+        for key in ('title', 'link', 'description', 'language'):
+            assert d.feed.get(key) == expected.feed.get(key)
+        assert get_published_parsed(d.feed) == get_published_parsed(expected.feed)
+        assert [normalize_entry(entry) for entry in d.entries] == \
+               [normalize_entry(entry) for entry in expected.entries]
+
+    def test_extension_elements_same_as_feedparser(self):
+        body = b'''<?xml version="1.0" encoding="utf-8"?>
+            <rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"
+                 xmlns:media="http://search.yahoo.com/mrss/" xmlns:dc="http://purl.org/dc/elements/1.1/"
+                 xmlns:content="http://purl.org/rss/1.0/modules/content/"><channel>
+            <itunes:title>Podcast (itunes)</itunes:title><title>Podcast</title><link>https://feed.nl</link>
+            <item><itunes:title>Episode One (itunes)</itunes:title><title>Episode 1</title>
+            <media:title>Episode One (media)</media:title><media:content url="https://feed.nl/1.mp3"/>
+            <guid>https://feed.nl/1</guid><link>https://feed.nl/1</link><dc:creator>Host</dc:creator>
+            <content:encoded>&lt;p&gt;Show notes&lt;/p&gt;</content:encoded>
+            <pubDate>Sat, 05 Nov 2022 18:53:16 +0100</pubDate></item></channel></rss>'''
+        d = parse_fast(body, base_url='https://feed.nl/rss')
+        # Test elements of extension namespaces do not override the core elements of RSS
+        expected = feedparser.parse(body)
+        assert d.feed.title == expected.feed.title == 'Podcast'
+        entry, = d.entries
+        assert entry.title == 'Episode 1' and entry.author == 'Host' and entry.description == '<p>Show notes</p>'
+        assert [normalize_entry(entry) for entry in d.entries] == \
+               [normalize_entry(entry) for entry in expected.entries]
+
+    @pytest.mark.parametrize('body', [
+        b'<rss version="2.0"><channel><title>Unclosed &nbsp; entity</title></rss>',
+        b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><channel/></rdf:RDF>',
+    ])
+    def test_fall_back_to_feedparser(self, body):
+        # Test malformed and other feeds are parsed by feedparser
+        with patch('feedparser.parse') as mock_feedparser:
+            assert parse_fast(body, base_url='https://feed.nl/rss') is mock_feedparser.return_value
+            assert mock_feedparser.call_count == 1
+
+
+class TestReadBody:
+    def test_byte_limit(self):
+        response = MagicMock(headers={}, url='https://feed.nl/rss')
+        response.iter_content.return_value = iter([b'x' * 100] * 3)
+        assert read_body(response, max_bytes=300) == b'x' * 300
+
+        # Test the download is aborted once the body is too large
+        response.iter_content.return_value = iter([b'x' * 100] * 3)
+        with pytest.raises(ValidationError):
+            read_body(response, max_bytes=250)
+
+        # Test a too large body is not downloaded at all if its size is known
+        response = MagicMock(headers={'Content-Length': '1000'}, url='https://feed.nl/rss')
+        with pytest.raises(ValidationError):
+            read_body(response, max_bytes=250)
+        assert response.iter_content.call_count == 0
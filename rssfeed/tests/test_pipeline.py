@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from unittest.mock import patch
+
+import billiard
+import feedparser
+import pytest
+
+from rssfeedapi.models import Feed, Entry
+from rssfeedapi.pipeline import fetch_and_parse
+from rssfeedapi.tasks import update_feeds_batch
+from rssfeedapi.utils import get_published_parsed, normalize_entry
+from .utils import _mock_fetch_feed, _create_feeds_in_db
+
+FEED_FILE = os.path.dirname(os.path.realpath(__file__)) + '/nu.nl.rss.xml'
+
+
+def _fetch_and_parse_in_worker(feed_urls):
+    with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(FEED_FILE)):
+        return {result.url: len(d.entries) for result, d in fetch_and_parse([(url, {}) for url in feed_urls])}
+
+
+class TestFetchAndParse:
+    def test_fetch_and_parse(self):
+        feeds = [(f'https://feed{i}.nl/rss', {}) for i in range(5)] + [('https://feed.nl/error', {})]
+        url_to_file = {feed_url: FEED_FILE for feed_url, _ in feeds[:-1]}
+        with patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(url_to_file)):
+            results = {result.url: (result, d) for result, d in fetch_and_parse(feeds)}
+
+        # Test feeds are parsed by other processes, with the same stored fields as parsed here
+        assert set(results) == {feed_url for feed_url, _ in feeds}
+        expected = feedparser.parse(FEED_FILE)
+        for feed_url, _ in feeds[:-1]:
+            result, d = results[feed_url]
+            assert not d.bozo
+            assert get_published_parsed(d.feed) == get_published_parsed(expected.feed)
+            assert d.entries == [normalize_entry(entry) for entry in expected.entries]
+            assert d.content_hash == result.content_hash
+        # Test a failed download is returned without being parsed
+        result, d = results['https://feed.nl/error']
+        assert result.error is not None and d is None
+
+    def test_fetch_and_parse_in_prefork_worker(self):
+        feed_urls = [f'https://feed{i}.nl/rss' for i in range(3)]
+        # Test feeds are parsed in a child of the prefork pool of workers, which is daemonic and cannot start processes
+        with billiard.Pool(1) as pool:
+            results = pool.apply(_fetch_and_parse_in_worker, (feed_urls,))
+        assert results == {feed_url: len(feedparser.parse(FEED_FILE).entries) for feed_url in feed_urls}
+
+    def test_backpressure(self):
+        feeds = [(f'https://feed{i}.nl/rss', {}) for i in range(100)]
+        mock_fetch_feed = _mock_fetch_feed(FEED_FILE)
+        with patch('rssfeedapi.fetcher.fetch_feed', mock_fetch_feed):
+            results = fetch_and_parse(feeds, queue_size=2)
+            next(results)
+            time.sleep(0.5)
+            # Test downloads pause while the parsed feeds are not consumed
+            assert mock_fetch_feed.call_count < 50
+
+            # Test the remaining downloads are given up once the consumer stops
+            results.close()
+            for thread in threading.enumerate():
+                if thread.name == 'fetch_and_parse':
+                    thread.join(timeout=5)
+                    assert not thread.is_alive()
+            assert mock_fetch_feed.call_count < 50
+
+
+@pytest.mark.django_db
+class TestPipelineUpdate:
+    def test_update_feeds_batch_in_pipeline(self, celery_app):
+        feeds = _create_feeds_in_db(3)
+        feed_urls = [f'https://feed{i}.nl/rss' for i in range(3)]
+        for feed, feed_url in zip(feeds, feed_urls):
+            Feed.objects.filter(id=feed.id).update(feed_url=feed_url)
+
+        d = feedparser.parse(FEED_FILE)
+        with patch('rssfeedapi.tasks.PIPELINE', True), \
+                patch('rssfeedapi.fetcher.fetch_feed', _mock_fetch_feed(FEED_FILE)):
+            update_feeds_batch(feed_urls)
+
+        for feed in feeds:
+            updated_feed = Feed.objects.get(id=feed.id)
+            assert updated_feed.status == Feed.Status.UPDATED
+            assert updated_feed.published_time == get_published_parsed(d.feed)
+        # Test all entries are created. Guids are unique, so they belong to the feed which is stored first
+        for entry in d.entries:
+            assert Entry.objects.filter(guid=entry.id, feed__in=feeds).exists()
@@ -0,0 +1,78 @@
+import datetime
+from unittest.mock import patch
+
+import pytest
+from django.utils import timezone
+
+from rssfeed.settings import RETENTION_DAYS
+from rssfeedapi.models import Entry, ArchivedEntry, ReadEntry
+from rssfeedapi.tasks import prune_expired_entries
+from .factories import FeedFactory, EntryFactory
+from .utils import _create_feeds_in_db
+
+
+def _age_entries(entries, days, created_days=None):
+    Entry.objects.filter(id__in=[entry.id for entry in entries]).update(
+        published_time=timezone.now() - datetime.timedelta(days=days),
+        created_time=timezone.now() - datetime.timedelta(days=days if created_days is None else created_days))
+
+
+@pytest.mark.django_db
+class TestRetention:
+    def test_prune_expired_entries(self, user):
+        feed, = _create_feeds_in_db(1)
+        expired_entries = [EntryFactory(guid=f'https://feed.nl/{i}', feed=feed) for i in range(5)]
+        _age_entries(expired_entries, RETENTION_DAYS + 1)
+        expired_entries[0].read_by.add(user)
+        num_recent_entries = Entry.objects.count() - len(expired_entries)
+
+        # Test expired entries are deleted chunk by chunk, with their read state
+        with patch('rssfeedapi.tasks.RETENTION_CHUNK_SIZE', 2), \
+                patch('rssfeedapi.models.Entry.objects.filter', wraps=Entry.objects.filter) as mock_filter:
+            assert prune_expired_entries() == len(expired_entries)
+        assert len([call for call in mock_filter.call_args_list if 'id__in' in call.kwargs]) == 3
+        assert Entry.objects.count() == num_recent_entries
+        assert not ReadEntry.objects.filter(user=user).exists()
+        assert not ArchivedEntry.objects.exists()
+        assert prune_expired_entries() == 0
+
+    def test_entry_created_again_is_kept(self):
+        feed, = _create_feeds_in_db(1)
+        entry = EntryFactory(guid='https://feed.nl/old', feed=feed)
+        # Test an old entry which was just created, e.g. still listed by its feed, is kept for a retention period
+        _age_entries([entry], RETENTION_DAYS + 1, created_days=0)
+        assert prune_expired_entries() == 0
+        # Test an entry without published time expires after its creation
+        Entry.objects.filter(id=entry.id).update(
+            published_time=None, created_time=timezone.now() - datetime.timedelta(days=RETENTION_DAYS + 1))
+        assert prune_expired_entries() == 1
+
+    def test_retention_per_feed(self):
+        short_feed = FeedFactory(feed_url='https://short.nl/rss', retention_days=1)
+        long_feed = FeedFactory(feed_url='https://long.nl/rss', retention_days=RETENTION_DAYS + 30)
+        short_entry = EntryFactory(guid='https://short.nl/0', feed=short_feed)
+        long_entry = EntryFactory(guid='https://long.nl/0', feed=long_feed)
+        _age_entries([short_entry, long_entry], 2)
+        _age_entries([EntryFactory(guid='https://long.nl/1', feed=long_feed)], RETENTION_DAYS + 1)
+
+        assert prune_expired_entries() == 1
+        assert not Entry.objects.filter(id=short_entry.id).exists()
+        assert set(long_feed.entries.values_list('guid', flat=True)) == {'https://long.nl/0', 'https://long.nl/1'}
+
+    def test_archive_expired_entries(self):
+        feed, = _create_feeds_in_db(1)
+        entry = EntryFactory(guid='https://feed.nl/archived', feed=feed)
+        _age_entries([entry], RETENTION_DAYS + 1)
+        with patch('rssfeedapi.tasks.RETENTION_ARCHIVE', True):
+            assert prune_expired_entries() == 1
+        archived_entry = ArchivedEntry.objects.get()
+        assert archived_entry.guid == entry.guid and archived_entry.title == entry.title
+        assert archived_entry.feed == feed
+        assert not Entry.objects.filter(guid=entry.guid).exists()
+
+    def test_runs_do_not_overlap(self):
+        feed, = _create_feeds_in_db(1)
+        _age_entries(feed.entries.all(), RETENTION_DAYS + 1)
+        with patch('rssfeedapi.tasks.cache.add', return_value=False):
+            assert prune_expired_entries() == 0
+        assert feed.entries.exists()
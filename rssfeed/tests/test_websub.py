@@ -0,0 +1,189 @@
+import hashlib
+import hmac
+import secrets
+from datetime import timedelta
+from email.utils import format_datetime
+from unittest.mock import patch, MagicMock
+from urllib.parse import urlsplit
+
+import pytest
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from rssfeed.settings import WEBSUB_POLL_INTERVAL, WEBSUB_LEASE_SECONDS, UPDATE_INTERVAL
+from rssfeedapi.fetcher import FetchResult
+from rssfeedapi.models import Feed, Entry
+from rssfeedapi.parsers import parse_fast, get_websub_hub
+from rssfeedapi.tasks import update_feed, acquire_update_lock, release_update_lock
+from .utils import _create_feeds_in_db
+
+FEED_URL = 'https://feed.nl/rss'
+HUB_URL = 'https://hub.nl/'
+
+
+def _rss(item_ids, hub=True):
+    links = (f'<atom:link rel="hub" href="{HUB_URL}"/><atom:link rel="self" href="{FEED_URL}"/>' if hub else '')
+    items = ''.join(f'<item><title>Item {i}</title><link>https://feed.nl/{i}</link><guid>https://feed.nl/{i}</guid>'
+                    f'<description>Text {i}</description><pubDate>{format_datetime(timezone.now())}</pubDate></item>'
+                    for i in item_ids)
+    return (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">'
+            f'<channel><title>Feed</title><link>https://feed.nl</link>{links}{items}</channel></rss>').encode()
+
+
+class StandInHub:
+    """
+    Local stand-in of a WebSub hub: verifies the intent of subscribers at their callback, and pushes signed
+    content to them
+    """
+    def __init__(self):
+        self.client = APIClient()
+        self.subscriptions = {}  # topic -> (callback path, secret)
+        self.post = MagicMock(side_effect=self.subscribe)
+
+    def subscribe(self, hub_url, data, **kwargs):
+        callback = urlsplit(data['hub.callback']).path
+        challenge = secrets.token_hex(8)
+        response = self.client.get(callback, {
+            'hub.mode': 'subscribe', 'hub.topic': data['hub.topic'], 'hub.challenge': challenge,
+            'hub.lease_seconds': data['hub.lease_seconds']})
+        if response.status_code == 200 and response.content.decode() == challenge:
+            self.subscriptions[data['hub.topic']] = (callback, data['hub.secret'])
+        return MagicMock(status_code=202)
+
+    def publish(self, topic, body, secret=None):
+        callback, subscription_secret = self.subscriptions[topic]
+        signature = hmac.new((secret or subscription_secret).encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post(callback, data=body, content_type='application/rss+xml',
+                                HTTP_X_HUB_SIGNATURE=f'sha256={signature}')
+
+
+class TestHubDiscovery:
+    def test_hub_in_feed(self):
+        d = parse_fast(_rss([0]))
+        assert get_websub_hub(d) == (HUB_URL, FEED_URL)
+        assert get_websub_hub(parse_fast(_rss([0], hub=False))) == (None, None)
+
+    def test_hub_in_link_header(self):
+        headers = {'link': f'<{HUB_URL}>; rel="hub", <{FEED_URL}>; rel="self"'}
+        assert get_websub_hub(parse_fast(_rss([0], hub=False)), headers) == (HUB_URL, FEED_URL)
+
+
+@pytest.mark.django_db
+class TestWebSub:
+    @pytest.fixture
+    def hub(self):
+        hub = StandInHub()
+        with patch('rssfeedapi.websub.WEBSUB_CALLBACK_BASE_URL', 'http://testserver'), \
+                patch('rssfeedapi.websub.get_session', return_value=hub):
+            yield hub
+
+    def _update(self, body):
+        result = FetchResult(url=FEED_URL, status=200, body=body, headers={})
+        with patch('rssfeedapi.fetcher.fetch_feed', return_value=result):
+            update_feed(FEED_URL)
+
+    def test_subscribe_and_push(self, hub, celery_app):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(feed_url=FEED_URL)
+
+        # Test the hub is detected while polling, and the subscription is verified
+        self._update(_rss([0, 1]))
+        feed = Feed.objects.get(id=feed.id)
+        assert feed.hub_url == HUB_URL and feed.websub_topic == FEED_URL
+        assert feed.is_push_enabled()
+        # Test the feed is only polled as a safety net
+        assert feed.poll_interval >= WEBSUB_POLL_INTERVAL
+
+        # Test pushed entries are stored
+        response = hub.publish(FEED_URL, _rss([2]))
+        assert response.status_code == 202
+        assert Entry.objects.filter(guid='https://feed.nl/2', feed=feed).exists()
+
+        # Test content with an invalid signature is ignored
+        response = hub.publish(FEED_URL, _rss([3]), secret='not the secret')
+        assert response.status_code == 202
+        assert not Entry.objects.filter(guid='https://feed.nl/3').exists()
+
+        # Test the subscription is not renewed while its lease lasts
+        cache.clear()
+        self._update(_rss([0, 1, 2]))
+        assert hub.post.call_count == 1
+
+    def test_push_waits_for_update(self, hub, celery_app):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(feed_url=FEED_URL)
+        self._update(_rss([0]))
+
+        # Test content pushed while the feed is being updated is stored after the update, not concurrently
+        assert acquire_update_lock(FEED_URL)
+        with patch('rssfeedapi.tasks.ingest_pushed_content.retry', side_effect=Retry()) as mock_retry:
+            response = hub.publish(FEED_URL, _rss([1]))
+        assert response.status_code == 202
+        assert mock_retry.call_count == 1
+        assert not Entry.objects.filter(guid='https://feed.nl/1').exists()
+        release_update_lock(FEED_URL)
+        hub.publish(FEED_URL, _rss([1]))
+        assert Entry.objects.filter(guid='https://feed.nl/1', feed=feed).exists()
+        # Test the lock is released once the pushed content is stored
+        assert acquire_update_lock(FEED_URL)
+
+    def test_verification_of_unknown_intent(self, hub):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(hub_url=HUB_URL, websub_topic=FEED_URL)
+        url = reverse('rssfeedapi:websub_callback', args=[feed.id])
+        response = hub.client.get(url, {'hub.mode': 'subscribe', 'hub.topic': 'https://other.nl/rss',
+                                        'hub.challenge': 'challenge'})
+        assert response.status_code == 404
+        # Test a verification of the right topic is refused if no subscription was requested
+        response = hub.client.get(url, {'hub.mode': 'subscribe', 'hub.topic': FEED_URL, 'hub.challenge': 'x',
+                                        'hub.lease_seconds': '999999999999'})
+        assert response.status_code == 404
+        response = hub.client.get(url, {'hub.mode': 'unsubscribe', 'hub.topic': FEED_URL, 'hub.challenge': 'x'})
+        assert response.status_code == 404
+        assert not Feed.objects.get(id=feed.id).is_push_enabled()
+
+        # Test a denied subscription falls back to polling, only for the topic of the feed
+        Feed.objects.get(id=feed.id).enable_push(3600)
+        response = hub.client.get(url, {'hub.mode': 'denied', 'hub.topic': 'https://other.nl/rss'})
+        assert response.status_code == 404
+        assert Feed.objects.get(id=feed.id).is_push_enabled()
+        response = hub.client.get(url, {'hub.mode': 'denied', 'hub.topic': FEED_URL, 'hub.reason': 'spam'})
+        assert response.status_code == 200
+        assert not Feed.objects.get(id=feed.id).is_push_enabled()
+
+    def test_lease_is_capped(self, hub, celery_app):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(feed_url=FEED_URL)
+        subscribe = hub.subscribe
+
+        def subscribe_with_huge_lease(hub_url, data, **kwargs):
+            return subscribe(hub_url, {**data, 'hub.lease_seconds': '999999999999'}, **kwargs)
+        hub.post.side_effect = subscribe_with_huge_lease
+        self._update(_rss([0]))
+        # Test the lease is at most the one asked for
+        feed = Feed.objects.get(id=feed.id)
+        assert feed.is_push_enabled()
+        assert feed.websub_expires_at <= timezone.now() + timedelta(seconds=WEBSUB_LEASE_SECONDS)
+
+        # Test a verified subscription cannot be verified again
+        response = hub.client.get(reverse('rssfeedapi:websub_callback', args=[feed.id]),
+                                  {'hub.mode': 'subscribe', 'hub.topic': FEED_URL, 'hub.challenge': 'x'})
+        assert response.status_code == 404
+
+    def test_websub_disabled(self, celery_app):
+        feed, = _create_feeds_in_db(1)
+        Feed.objects.filter(id=feed.id).update(feed_url=FEED_URL)
+        with patch('rssfeedapi.websub.get_session') as mock_session:
+            self._update(_rss([0]))
+        assert mock_session.call_count == 0
+        assert not Feed.objects.get(id=feed.id).hub_url
+
+    def test_push_enabled_before_first_poll(self):
+        feed, = _create_feeds_in_db(1)
+        # Test a feed which was never scheduled falls back to 'UPDATE_INTERVAL'
+        assert feed.poll_interval is None
+        feed.enable_push(WEBSUB_LEASE_SECONDS)
+        assert Feed.objects.get(id=feed.id).poll_interval == max(UPDATE_INTERVAL, WEBSUB_POLL_INTERVAL)
@@ -1,11 +1,15 @@
 import random
+from unittest.mock import MagicMock
 
 from faker import Faker
+from rest_framework.exceptions import ValidationError
 
 from .factories import FeedFactory, EntryFactory, UserFactory
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from rssfeedapi.fetcher import FetchResult
+
 
 def _create_feeds_in_db(n):
     feeds = []
@@ -35,3 +39,19 @@ def _create_authorized_users(n):
 
     return users,  clients
 
+
+def _mock_fetch_feed(url_to_file):
+    """
+    Simulate downloading feeds: the content of a local xml file is returned for each known feed url.
+    Downloading any other url fails as if its host was unreachable
+    :param url_to_file: dict of feed url to file path, or one file path returned for any feed url
+    """
+    def fetch_feed(feed_url, **kwargs):
+        if isinstance(url_to_file, str):
+            return FetchResult(url=feed_url, status=200, body=open(url_to_file, 'rb').read(), headers={})
+        if feed_url not in url_to_file:
+            raise ValidationError(f'Failed to fetch feed: {feed_url} is unreachable')
+        with open(url_to_file[feed_url], 'rb') as f:
+            return FetchResult(url=feed_url, status=200, body=f.read(), headers={})
+
+    return MagicMock(side_effect=fetch_feed)